@@ -2,16 +2,27 @@
 Defines classes for interacting with AZURE2.
 '''
 
-import os
-import shutil
+import threading
+from collections import OrderedDict
 import numpy as np
 import level
 import utility
+import tuning
+import grid
+import workspace
 from parameter import Parameter
-from output import Output
+from output import Output, Evaluation, XS_COM_FIT_INDEX
 from data import Data
 from nodata import Test
 from configuration import Config
+from runner import Runner, AZURE2Error, FailureMemo, Usage
+from executor import Executor
+
+'''
+Guards the reduced-width-amplitude cache, which the threads of a
+ThreadExecutor share. Module-level, so AZR instances stay picklable.
+'''
+_rwas_lock = threading.Lock()
 
 class AZR:
     '''
@@ -22,6 +33,7 @@ class AZR:
     parameters       : list of Parameter instances (sampled parameters)
     output_filenames : Which output files (AZUREOut_*.out) are read?
     extrap_filenames : Which output files (AZUREOut_*.extrap) are read?
+    document         : AzrDocument of input_filename (optional; see Config)
 
     Other attributes (given default values below):
     use_brune        : Bool that indicates the use of the Brune
@@ -31,9 +43,25 @@ class AZR:
     ext_capture_file : Filename where external capture integral results have
                        been stored.
     command          : Name of AZURE2 binary.
+    timeout          : wall-clock limit (s) for each AZURE2 run (None = none)
+    memory_limit     : address-space limit (bytes) for AZURE2 (None = none)
+    retries          : number of times a failed AZURE2 run is retried
+    failures         : FailureMemo of points at which AZURE2 failed
+                       deterministically (these fail immediately with
+                       AZURE2Error(memoized=True) the next time)
+    processes        : number of worker processes an Executor uses
+    omp_threads      : OMP_NUM_THREADS given to AZURE2 (set in the child's
+                       environment only)
+    processes and omp_threads are read from a previous calibration of this
+    input file on this host (see tune()), if there is one.
+    rwas_cache_size  : number of reduced-width-amplitude results (from
+                       rwas_array() or predict(full_output=True)) kept for
+                       reuse
+    usage            : runner.Usage of every AZURE2 run made for this instance
+                       (including those made by an Executor's workers)
     '''
     def __init__(self, input_filename, parameters=None, output_filenames=None,
-                 extrap_filenames=None):
+                 extrap_filenames=None, document=None):
         # Give default values to attributes that are not specified at
         # instantiation. These values must be changed *after* instantiation.
         self.use_brune = True
@@ -42,8 +70,22 @@ class AZR:
         self.ext_capture_file = '\n'
         self.command = 'AZURE2'
         self.root_directory = ''
-        
-        self.config = Config(input_filename, parameters=parameters)
+        self.timeout = None
+        self.memory_limit = None
+        self.retries = 0
+        self.failures = FailureMemo()
+        self.processes = None
+        self.omp_threads = None
+        self.rwas_cache_size = 1000
+        self.rwas_cache = OrderedDict()
+        self.usage = Usage()
+
+        self.config = Config(input_filename, parameters=parameters,
+                             document=document)
+
+        tuned = tuning.load(input_filename, digest=self.config.document.digest)
+        if tuned is not None:
+            tuning.apply(self, tuned)
 
         '''
         If parameters are not specified, they are inferred from the input file.
@@ -70,13 +112,91 @@ class AZR:
             self.extrap_filenames = extrap_filenames
 
 
-    def predict(self, theta, mod_data=None, dress_up=True, full_output=False):
+    def runner(self):
+        '''
+        Returns a Runner configured from the current attributes.
+        '''
+        env = {}
+        if self.omp_threads is not None:
+            env['OMP_NUM_THREADS'] = self.omp_threads
+        return Runner(command=self.command, timeout=self.timeout,
+                      memory_limit=self.memory_limit, retries=self.retries,
+                      env=env)
+
+
+    def tune(self, theta=None, objective='throughput', **kwargs):
+        '''
+        Finds the best split of this machine's cores between worker processes
+        and AZURE2 OpenMP threads for this input file (see
+        tuning.calibrate). The result is stored, so later AZR instances
+        built from the same file on the same host pick it up automatically.
+        '''
+        return tuning.calibrate(self, theta=theta, objective=objective,
+                                **kwargs)
+
+
+    def run(self, input_filename, choice=1, use_brune=None, use_gsl=None,
+            ext_capture_file=None):
+        '''
+        Runs AZURE2 on input_filename with the attributes of this instance
+        (unless overridden). Returns a RunResult; its resource usage is added
+        to self.usage.
+        '''
+        try:
+            result = self.runner().run(input_filename, choice=choice,
+                use_brune=use_brune if use_brune is not None else self.use_brune,
+                use_gsl=use_gsl if use_gsl is not None else self.use_gsl,
+                ext_par_file=self.ext_par_file,
+                ext_capture_file=(ext_capture_file if ext_capture_file is not
+                                  None else self.ext_capture_file))
+        except AZURE2Error as e:
+            if e.result is not None:
+                self.usage.add(e.result.usage)
+            raise
+        self.usage.add(result.usage)
+        return result
+
+
+    def output_files(self, segments=None):
+        '''
+        Returns the output files predict(theta, segments=segments) reads: the
+        files of self.output_filenames that AZURE2 writes for segments.
+        '''
+        if segments is None:
+            return self.output_filenames
+        written = self.config.data.subset(segments).output_files
+        return [of for of in self.output_filenames if of in written]
+
+
+    def concatenate(self, output, column=XS_COM_FIT_INDEX, segments=None):
+        '''
+        Returns one column of the output of predict(theta, segments=segments)
+        as a vector (see Data.concatenate and Subset.concatenate).
+        '''
+        filenames = self.output_files(segments)
+        if segments is None:
+            return self.config.data.concatenate(output, filenames,
+                                                column=column)
+        return self.config.data.subset(segments).concatenate(
+            output, filenames, column=column)
+
+
+    def predict(self, theta, mod_data=None, dress_up=True, full_output=False,
+                segments=None):
         '''
         Takes:
             * a point in parameter space, theta.
             * dress_up    : Use Output class.
             * full_output : Return reduced width amplitudes as well.
             * mod_data    : Do any parametes in theta modify the original data?
+            * segments    : indices (as in Data.all_segments) of the included
+                            segments to calculate (default: all of them).
+                            The others are left out of the input file, so
+                            AZURE2 does not calculate them. Only the output
+                            files of these segments are read (see
+                            output_files). Not allowed with a stored
+                            ext_capture_file, whose integrals are laid out
+                            for the full input.
         Does:
             * creates a random filename ([rand].azr)
             * creates a (similarly) random output directory (output_[rand]/)
@@ -89,50 +209,64 @@ class AZR:
             * deletes data_[rand]/
         Returns:
             * predicted values and (optionally) reduced width amplitudes.
+        Raises:
+            * AZURE2Error if AZURE2 fails (immediately, if it already failed
+              at theta).
         '''
-
-        workspace = self.config.generate_workspace(
+        assert segments is None or self.ext_capture_file == '\n', '''
+ext_capture_file holds the external capture integrals of the full input, which
+do not match a subset of the segments. Set ext_capture_file = '\\n' to predict
+on a subset.'''
+        # Modified data changes the calculation, so those failures are not
+        # attributed to theta alone.
+        memoize = mod_data is None
+        tag = 'predict' if segments is None else \
+            f'predict {tuple(sorted(set(segments)))}'
+        if memoize:
+            self.failures.check(theta, tag)
+
+        input_filename, output_dir, data_dir = self.config.generate_workspace(
             theta,
             prepend=self.root_directory,
-            mod_data=mod_data
+            mod_data=mod_data,
+            segments=segments
         )
-        input_filename, output_dir, data_dir = workspace
+        output_filenames = self.output_files(segments)
 
         try:
-            response = utility.run_AZURE2(input_filename, choice=1,
-                use_brune=self.use_brune, ext_par_file=self.ext_par_file,
-                ext_capture_file=self.ext_capture_file, use_gsl=self.use_gsl,
-                command=self.command)
-        except:
-            shutil.rmtree(output_dir)
-            shutil.rmtree(data_dir)
-            os.remove(input_filename)
+            response = self.run(input_filename, choice=1)
+        except BaseException as e:
+            workspace.discard(input_filename, output_dir, data_dir)
+            if isinstance(e, AZURE2Error) and memoize and not e.timed_out:
+                self.failures.add(theta, tag, str(e))
             print('AZURE2 did not execute properly.')
             raise
 
         try:
             if dress_up:
                 output = [Output(output_dir + '/' + of) for of in
-                          self.output_filenames]
+                          output_filenames]
             else:
                 output = [np.loadtxt(output_dir + '/' + of) for of in
-                          self.output_filenames]
+                          output_filenames]
 
             if full_output:
-                output = (output, utility.read_rwas_jpi(output_dir))
+                rwas = utility.read_rwas_structured(output_dir)
+                self.remember_rwas(theta, rwas)
+                output = (output, utility.rwas_to_list(rwas))
 
-            shutil.rmtree(output_dir)
-            shutil.rmtree(data_dir)
-            os.remove(input_filename)
+            workspace.discard(input_filename, output_dir, data_dir)
 
             return output
         except:
-            shutil.rmtree(output_dir)
-            shutil.rmtree(data_dir)
-            os.remove(input_filename)
+            workspace.discard(input_filename, output_dir, data_dir)
+            if memoize:
+                self.failures.add(theta, tag,
+                                  'Output files were not properly read.')
             print('Output files were not properly read.')
             print('AZURE output:')
-            print(response)
+            print(response.stdout)
+            print(response.stderr)
             raise
 
 
@@ -141,57 +275,368 @@ class AZR:
         '''
         See predict() documentation.
         '''
-        workspace = self.config.generate_workspace_extrap(theta,
-            segment_indices=segment_indices)
-        input_filename, output_dir, output_files = workspace
+        tag = f'extrapolate {segment_indices} {use_brune} {use_gsl}'
+        self.failures.check(theta, tag)
+
+        input_filename, output_dir, output_files = \
+            self.config.generate_workspace_extrap(theta,
+                segment_indices=segment_indices, prepend=self.root_directory)
 
         try:
-            response = utility.run_AZURE2(input_filename, choice=3,
-                use_brune=use_brune if use_brune is not None else self.use_brune,
-                use_gsl=use_gsl if use_gsl is not None else self.use_gsl,
-                ext_par_file=self.ext_par_file,
-                ext_capture_file=ext_capture_file,
-                command=self.command)
-        except:
-            shutil.rmtree(output_dir)
-            os.remove(input_filename)
+            response = self.run(input_filename, choice=3, use_brune=use_brune,
+                use_gsl=use_gsl, ext_capture_file=ext_capture_file)
+        except BaseException as e:
+            workspace.discard(input_filename, output_dir)
+            if isinstance(e, AZURE2Error) and not e.timed_out:
+                self.failures.add(theta, tag, str(e))
             print('AZURE2 did not execute properly.')
             raise
 
         try:
             output = [np.loadtxt(output_dir + '/' + of) for of in output_files]
-            shutil.rmtree(output_dir)
-            os.remove(input_filename)
+            workspace.discard(input_filename, output_dir)
             return output
         except:
-            shutil.rmtree(output_dir)
-            os.remove(input_filename)
+            workspace.discard(input_filename, output_dir)
+            self.failures.add(theta, tag, 'Output files could not be read.')
             print('Output files could not be read.')
             raise
 
 
+    def lab_energies(self, energies, channel_pair, frame='lab'):
+        '''
+        Converts energies in frame ('lab' or 'com') to lab energies of the
+        entrance pair of channel_pair (which is what <segmentsTest> takes).
+        '''
+        assert frame in ('lab', 'com'), 'frame must be "lab" or "com".'
+        energies = np.atleast_1d(np.asarray(energies, dtype=np.float64))
+        if frame == 'lab':
+            return energies
+        pair = self.config.document.pairs[channel_pair[0]]
+        return energies*(pair.light_mass + pair.heavy_mass)/pair.heavy_mass
+
+
+    def extrapolate_batch(self, theta, requests, frame='lab', use_brune=None,
+                          use_gsl=None, ext_capture_file='\n'):
+        '''
+        Takes:
+            * theta    : point in parameter space
+            * requests : list of (channel_pair, energies), where channel_pair
+                         is (entrance pair, exit pair) as in <segmentsTest>
+                         (exit pair -1 is total capture)
+            * frame    : 'lab' or 'com' energies
+        Does:
+            * replaces the test segments of the input file with one segment
+              per requested energy (see Test.write_synthesized)
+            * runs AZURE2 (choice 3) once for all of the requests
+        Returns:
+            * list with one array per request, rows in the order of its
+              energies (columns as in the .extrap files, see rates.py)
+        '''
+        requests = [(tuple(pair), self.lab_energies(energies, pair, frame))
+                    for (pair, energies) in requests]
+        input_filename, output_dir, layout = \
+            self.config.generate_workspace_energies(theta, requests,
+                prepend=self.root_directory)
+
+        try:
+            self.run(input_filename, choice=3, use_brune=use_brune,
+                     use_gsl=use_gsl, ext_capture_file=ext_capture_file)
+            files = {}
+            for (of, start, stop) in layout:
+                if of not in files:
+                    files[of] = np.loadtxt(output_dir + '/' + of, ndmin=2)
+            for (of, values) in files.items():
+                expected = max(stop for (f, _, stop) in layout if f == of)
+                assert values.shape[0] == expected, f'''
+{of} has {values.shape[0]} rows, but {expected} energies were requested.'''
+            return [files[of][start:stop] for (of, start, stop) in layout]
+        finally:
+            workspace.discard(input_filename, output_dir)
+
+
+    def extrapolate_at(self, theta, energies, channel_pair, frame='lab',
+                       **kwargs):
+        '''
+        Returns the extrapolation at theta for channel_pair at arbitrary
+        energies (rows in the order of energies). See extrapolate_batch.
+        '''
+        return self.extrapolate_batch(theta, [(channel_pair, energies)],
+                                      frame=frame, **kwargs)[0]
+
+
+    def extrapolate_adaptive(self, theta, channel_pairs, energy_range,
+                             column=3, tolerance=0.01, initial_points=17,
+                             max_points=1000, max_rounds=10, min_spacing=0.0,
+                             log=True, frame='lab', **kwargs):
+        '''
+        Takes:
+            * theta          : point in parameter space
+            * channel_pairs  : a channel pair or a list of them (see
+                               extrapolate_batch)
+            * energy_range   : (low, high) energies in frame
+            * column         : .extrap column that decides the refinement
+                               (default: cross section)
+            * tolerance      : largest accepted deviation (relative if log is
+                               True) from linear interpolation between
+                               neighbouring points
+            * initial_points : size of the starting grid (log-spaced if log is
+                               True)
+            * max_points     : stop refining a channel pair at this many points
+            * max_rounds     : maximum number of refinement rounds
+            * min_spacing    : intervals narrower than this are not split
+        Does:
+            * computes the starting grid, then bisects only the intervals
+              where the curve is not yet resolved. Every round is a single
+              AZURE2 run covering all channel pairs.
+        Returns:
+            * list with one array per channel pair (rows sorted by energy),
+              or a single array if one channel pair was given
+            * number of AZURE2 runs
+        Features narrower than the starting grid spacing can be missed
+        entirely, so initial_points should resolve the broadest structure of
+        interest.
+        '''
+        single = np.ndim(channel_pairs[0]) == 0
+        if single:
+            channel_pairs = [channel_pairs]
+
+        low, high = energy_range
+        x = [grid.initial_grid(low, high, initial_points, log=log)
+             for _ in channel_pairs]
+        y = self.extrapolate_batch(theta, list(zip(channel_pairs, x)),
+                                   frame=frame, **kwargs)
+        runs = 1
+
+        while runs <= max_rounds:
+            requests = []
+            for (k, pair) in enumerate(channel_pairs):
+                if x[k].size >= max_points:
+                    continue
+                errors = grid.interpolation_errors(x[k], y[k][:, column],
+                                                   log=log)
+                flags = grid.flag_intervals(errors, tolerance)
+                new = grid.midpoints(x[k], flags, log=log,
+                                     min_spacing=min_spacing)
+                new = new[:max_points - x[k].size]
+                if new.size > 0:
+                    requests.append((k, pair, new))
+            if not requests:
+                break
+
+            results = self.extrapolate_batch(theta,
+                [(pair, new) for (_, pair, new) in requests], frame=frame,
+                **kwargs)
+            runs += 1
+            for ((k, _, new), result) in zip(requests, results):
+                order = np.argsort(np.concatenate((x[k], new)), kind='stable')
+                x[k] = np.concatenate((x[k], new))[order]
+                y[k] = np.concatenate((y[k], result))[order]
+
+        return (y[0] if single else y), runs
+
+
+    '''
+    AZURE2 calculation mode (choice) that produces each product of evaluate().
+    The data, the reduced width amplitudes (parameters.out), and the external
+    capture integrals (intEC.dat) come from the same run.
+    '''
+    PRODUCT_CHOICES = {'data': 1, 'rwas': 1, 'ec': 1, 'extrap': 3}
+
+
+    def evaluate(self, theta, want=('data', 'extrap', 'rwas'), dress_up=True,
+                 use_brune=None, use_gsl=None):
+        '''
+        Takes:
+            * theta    : point in parameter space
+            * want     : products to calculate, any of 'data' (as predict),
+                         'extrap' (as extrapolate), 'rwas' (as rwas_array),
+                         and 'ec' (external capture integrals)
+            * dress_up : Use the Output class for the data?
+        Does:
+            * writes one input file and one output directory
+            * runs AZURE2 once per calculation mode the products need (at most
+              twice: choice 1 for data, rwas, and ec; choice 3 for extrap)
+            * reads every product from the shared output directory
+        Returns:
+            * Evaluation
+        Raises:
+            * AZURE2Error if AZURE2 fails (immediately, if it already failed
+              at theta).
+        '''
+        want = set(want)
+        unknown = want - set(self.PRODUCT_CHOICES)
+        assert not unknown, f'Unknown products: {unknown}.'
+        tag = f'evaluate {sorted(want)} {use_brune} {use_gsl}'
+        self.failures.check(theta, tag)
+
+        input_filename, output_dir, data_dir = self.config.generate_workspace(
+            theta, prepend=self.root_directory, test='extrap' in want)
+        choices = sorted({self.PRODUCT_CHOICES[p] for p in want})
+        usage = Usage()
+        try:
+            for choice in choices:
+                # The external capture integrals are only written when they
+                # are calculated (rather than read from ext_capture_file).
+                ext_capture_file = '\n' if choice == 3 or 'ec' in want \
+                    else None
+                try:
+                    response = self.run(input_filename, choice=choice,
+                                        use_brune=use_brune, use_gsl=use_gsl,
+                                        ext_capture_file=ext_capture_file)
+                except AZURE2Error as e:
+                    if not e.timed_out:
+                        self.failures.add(theta, tag, str(e))
+                    raise
+                usage.add(response.usage)
+
+            result = Evaluation(theta, runs=len(choices), usage=usage)
+            if 'data' in want:
+                if dress_up:
+                    result.data = [Output(output_dir + '/' + of) for of in
+                                   self.output_filenames]
+                else:
+                    result.data = [np.loadtxt(output_dir + '/' + of) for of
+                                   in self.output_filenames]
+            if 'extrap' in want:
+                result.extrap = [np.loadtxt(output_dir + '/' + of) for of in
+                                 self.extrap_filenames]
+            if 'rwas' in want:
+                result.rwas = utility.read_rwas_structured(output_dir)
+                self.remember_rwas(theta, result.rwas, use_brune=use_brune,
+                                   use_gsl=use_gsl)
+            if 'ec' in want:
+                result.ec = utility.read_ext_capture_file(output_dir +
+                                                          '/intEC.dat')
+            return result
+        finally:
+            workspace.discard(input_filename, output_dir, data_dir)
+
+
+    def rwas_key(self, theta, use_brune=None, use_gsl=None):
+        # Only the R-matrix parameters matter (not normalization factors), and
+        # the options that change what AZURE2 calculates from them (default:
+        # this instance's).
+        use_brune = self.use_brune if use_brune is None else use_brune
+        use_gsl = self.use_gsl if use_gsl is None else use_gsl
+        return (bool(use_brune), bool(use_gsl),
+                np.asarray(theta[:self.config.n1], dtype=np.float64).tobytes())
+
+
+    def remember_rwas(self, theta, rwas, use_brune=None, use_gsl=None):
+        key = self.rwas_key(theta, use_brune=use_brune, use_gsl=use_gsl)
+        with _rwas_lock:
+            self.rwas_cache[key] = rwas
+            self.rwas_cache.move_to_end(key)
+            while len(self.rwas_cache) > self.rwas_cache_size:
+                self.rwas_cache.popitem(last=False)
+
+
+    def rwas_array(self, theta):
+        '''
+        Returns the reduced width amplitudes at theta as a structured array
+        (dtype utility.RWA_DTYPE: J^pi, channel, g_int).
+        Results of earlier calculations at theta (including
+        predict(theta, full_output=True)) are reused.
+        '''
+        rwas = self.rwas_cache.get(self.rwas_key(theta))
+        if rwas is not None:
+            return rwas
+
+        tag = f'rwas {self.use_brune} {self.use_gsl}'
+        self.failures.check(theta, tag)
+
+        input_filename, output_dir = utility.random_output_dir_filename(
+            prepend=self.root_directory)
+        new_levels = self.config.generate_levels(theta[:self.config.n1])
+        contents, _ = self.config.compile_contents(
+            self.config.input_file_contents)
+        utility.write_input_file(contents, new_levels, input_filename,
+                                 output_dir)
+        try:
+            response = self.run(input_filename, choice=1)
+            rwas = utility.read_rwas_structured(output_dir)
+        except AZURE2Error as e:
+            if not e.timed_out:
+                self.failures.add(theta, tag, str(e))
+            raise
+        finally:
+            workspace.discard(input_filename, output_dir)
+
+        self.remember_rwas(theta, rwas)
+        return rwas
+
+
     def rwas(self, theta):
         '''
         Returns the reduced width amplitudes (rwas) and their corresponding J^pi
         at the point in parameter space, theta.
         '''
-        input_filename, output_dir = utility.random_output_dir_filename()
-        new_levels = self.config.generate_levels(theta)
-        utility.write_input_file(self.config.input_file_contents, new_levels,
-                                 input_filename, output_dir)
-        response = utility.run_AZURE2(input_filename, choice=1,
-            use_brune=self.use_brune, ext_par_file=self.ext_par_file,
-            ext_capture_file=self.ext_capture_file, use_gsl=self.use_gsl,
-            command=self.command)
+        return utility.rwas_to_list(self.rwas_array(theta))
+
+
+    def rwas_many(self, chain, executor=None, processes=None, filename=None):
+        '''
+        Takes:
+            * chain     : array of points in parameter space (e.g. a flattened
+                          MCMC chain)
+            * executor  : Executor to run the calculations on (default: a
+                          temporary one with the given number of processes)
+            * filename  : If given, the results are streamed into a .npy file
+                          (memory-mapped) as they arrive.
+        Returns:
+            * structured array (len(chain), number of channels) with fields
+              jpi, channel, and g_int (see utility.RWA_DTYPE)
+        Points already in the cache are not recalculated. If AZURE2 fails at a
+        point, its g_int values are NaN; if it fails at every point,
+        AZURE2Error is raised.
+        '''
+        chain = np.asarray(chain, dtype=np.float64)
+        cached = [self.rwas_cache.get(self.rwas_key(theta)) for theta in chain]
+        missing = [i for (i, rwas) in enumerate(cached) if rwas is None]
 
-        rwas = utility.read_rwas_jpi(output_dir)
+        own_executor = executor is None and len(missing) > 0
+        if own_executor:
+            executor = Executor(self, processes=processes)
 
-        shutil.rmtree(output_dir)
-        os.remove(input_filename)
+        results = None
+        failed = []
+        try:
+            computed = executor.imap_or_none('rwas_array',
+                [chain[i] for i in missing]) if missing else iter(())
+            # Results are written in chain order as they arrive.
+            for (i, rwas) in enumerate(cached):
+                if rwas is None:
+                    rwas = next(computed)
+                    if rwas is not None:
+                        self.remember_rwas(chain[i], rwas)
+                if rwas is None:
+                    failed.append(i)
+                    continue
+                if results is None:
+                    shape = (len(chain), rwas.size)
+                    if filename is not None:
+                        results = np.lib.format.open_memmap(filename,
+                            mode='w+', dtype=utility.RWA_DTYPE, shape=shape)
+                    else:
+                        results = np.empty(shape, dtype=utility.RWA_DTYPE)
+                    template = rwas
+                results[i] = rwas
+        finally:
+            if own_executor:
+                executor.close()
+
+        if results is None:
+            raise AZURE2Error('AZURE2 failed at every point.')
+        for i in failed:
+            results[i] = template
+            results[i]['g_int'] = np.nan
+
+        if filename is not None:
+            results.flush()
+        return results
 
-        return rwas
 
-    
     def ext_capture_integrals(self, use_gsl=False, mod_data=False):
         '''
         Returns the AZURE2 output of external capture integrals.
@@ -205,16 +650,12 @@ class AZR:
         new_levels = [l for sl in new_levels for l in sl]
         utility.write_input_file(self.config.input_file_contents, new_levels,
                                  input_filename, output_dir)
-        response = utility.run_AZURE2(input_filename, choice=1,
-            use_brune=self.use_brune, ext_par_file=self.ext_par_file,
-            ext_capture_file='\n', use_gsl=use_gsl,
-            command=self.command)
-
-        ec = utility.read_ext_capture_file(output_dir + '/intEC.dat')
-
-        shutil.rmtree(output_dir)
-        shutil.rmtree(data_dir)
-        os.remove(input_filename)
+        try:
+            response = self.run(input_filename, choice=1, use_gsl=use_gsl,
+                                ext_capture_file='\n')
+            ec = utility.read_ext_capture_file(output_dir + '/intEC.dat')
+        finally:
+            workspace.discard(input_filename, output_dir, data_dir)
 
         return ec
 
@@ -235,3 +676,4 @@ class AZR:
             self.config.data.segments[i].shift_energies(shift)
 
         return self.ext_capture_integrals(use_gsl=use_gsl, mod_data=True)
+
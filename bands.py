@@ -0,0 +1,281 @@
+'''
+Posterior bands of the prediction from representative subsamples of a chain.
+
+Quantile bands converge long before every sample of a chain has been
+evaluated. Band evaluates the chain in batches, in an order that spreads
+every prefix evenly over the chain (after thinning by the integrated
+autocorrelation time, so that consecutive draws are nearly independent), and
+stops once the bands are known well enough.
+
+Stopping rule: from n samples, the q-quantile at each point lies between the
+order statistics of rank n q -/+ z sqrt(n q (1 - q)) with confidence
+erf(z/sqrt(2)) (distribution-free). Half of that interval, relative to the
+width of the band at that point, is the error of the quantile. Band stops
+when the largest error over all points and quantiles is below the tolerance.
+The size of the next batch is set by how far the error is from the tolerance
+(it falls like 1/sqrt(n)).
+'''
+
+import numpy as np
+
+from executor import Executor
+from output import XS_COM_FIT_INDEX
+
+
+def autocorrelation(x):
+    '''
+    Normalized autocorrelation function of the series x (via FFT).
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    n = x.size
+    size = 2**int(np.ceil(np.log2(2*n)))
+    f = np.fft.rfft(x - x.mean(), n=size)
+    acf = np.fft.irfft(f*np.conjugate(f), n=size)[:n]
+    return acf/acf[0] if acf[0] > 0 else np.zeros(n)
+
+
+def integrated_time(chain, c=5.0):
+    '''
+    Integrated autocorrelation time of chain (nsteps, nwalkers, ndim), with
+    the autocorrelation averaged over walkers and Sokal's automatic window
+    (the smallest M >= c tau(M)), as in emcee. Returns the largest time over
+    the parameters.
+    '''
+    chain = np.asarray(chain, dtype=np.float64)
+    nsteps, nwalkers, ndim = chain.shape
+    taus = []
+    for k in range(ndim):
+        rho = np.mean([autocorrelation(chain[:, w, k]) for w in
+                       range(nwalkers)], axis=0)
+        tau = 2*np.cumsum(rho) - 1
+        window = np.arange(nsteps) >= c*tau
+        m = np.argmax(window) if np.any(window) else nsteps - 1
+        taus.append(tau[m])
+    return float(max(max(taus), 1.0))
+
+
+def stratified_order(n, seed=None):
+    '''
+    Returns a permutation of range(n) in which every prefix is spread evenly
+    over range(n): position m is drawn from the stratum given by the
+    base-2 radical inverse of m (van der Corput), shifted by a random offset.
+    '''
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    bits = max(1, int(np.ceil(np.log2(n))))
+    m = np.arange(2**bits)
+    reversed_m = np.zeros_like(m)
+    for b in range(bits):
+        reversed_m |= ((m >> b) & 1) << (bits - 1 - b)
+    offset = np.random.default_rng(seed).integers(n)
+    positions = (reversed_m*n // 2**bits + offset) % n
+    _, first = np.unique(positions, return_index=True)
+    return positions[np.sort(first)]
+
+
+def quantile_errors(values, quantiles, z=1.0):
+    '''
+    Takes:
+        * values    : array (n, npoints)
+        * quantiles : q values in (0, 1)
+        * z         : half-width of the interval in standard deviations
+    Returns:
+        * quantiles of values (len(quantiles), npoints)
+        * half-widths of their distribution-free confidence intervals
+          (same shape)
+    '''
+    values = np.sort(values, axis=0)
+    n = values.shape[0]
+    estimates = np.quantile(values, quantiles, axis=0)
+    errors = np.zeros_like(estimates)
+    for (i, q) in enumerate(quantiles):
+        spread = z*np.sqrt(n*q*(1 - q))
+        lo = int(np.clip(np.floor(n*q - spread), 0, n - 1))
+        hi = int(np.clip(np.ceil(n*q + spread), 0, n - 1))
+        errors[i] = (values[hi] - values[lo])/2
+    return estimates, errors
+
+
+def stack_batches(values):
+    '''
+    Stacks the prediction arrays of the batches. A batch in which every
+    evaluation failed has no columns (its width is unknown); its rows become
+    NaN rows as wide as the others.
+    '''
+    width = max(v.shape[1] for v in values)
+    return np.vstack([v if v.shape[1] == width else
+                      np.full((v.shape[0], width), np.nan) for v in values])
+
+
+class BandResult:
+    '''
+    Output of Band.run.
+
+    quantiles : the q values
+    bands     : quantiles of the prediction (len(quantiles), npoints)
+    errors    : half-widths of the confidence intervals of bands
+    error     : largest error relative to the band width (what the tolerance
+                is compared with)
+    converged : Was the tolerance reached?
+    samples   : indices (rows of the flattened, burned-in chain) of the
+                evaluated samples, in evaluation order
+    values    : predictions at samples (NaN rows where AZURE2 failed)
+    runs      : AZURE2 runs it took
+    tau, thin : autocorrelation time and thinning of the chain
+    history   : (samples evaluated, error) after each batch
+    '''
+    def __init__(self, quantiles, bands, errors, error, converged, samples,
+                 values, runs, tau, thin, history):
+        self.quantiles = quantiles
+        self.bands = bands
+        self.errors = errors
+        self.error = error
+        self.converged = converged
+        self.samples = samples
+        self.values = values
+        self.runs = runs
+        self.tau = tau
+        self.thin = thin
+        self.history = history
+
+
+class Band:
+    '''
+    Quantile bands of the prediction over a posterior chain.
+
+    azr          : AZR instance
+    chain        : samples, either (nsteps, nwalkers, ndim) (e.g.
+                   get_chain()), whose autocorrelation time sets the
+                   thinning, or flat (nsamples, ndim) (not thinned unless
+                   thin is given)
+    quantiles    : q values of the bands (at least two; the error is
+                   relative to the spread between them)
+    tolerance    : largest acceptable error of a quantile, relative to the
+                   band width at that point (see the module docstring)
+    z            : confidence of the error intervals in standard deviations
+    column       : output column of the prediction (see output.py)
+    function     : picklable function of theta that returns the prediction
+                   vector (None on failure), used instead of
+                   predict_matrix(column) (e.g. to apply a normalization
+                   factor that is not AZURE2's)
+    discard      : burn-in steps dropped (3D chains)
+    thin         : keep every thin-th step (default: the integrated
+                   autocorrelation time, for 3D chains)
+    batch_size   : size of the first batch (default: 4 per worker)
+    min_samples  : never stop before this many samples are evaluated
+    max_samples  : never evaluate more (default: all of the thinned chain)
+    executor     : Executor or ThreadExecutor (default: a temporary
+                   Executor with processes workers)
+    seed         : seed of the random offset of the stratified order
+    '''
+    def __init__(self, azr, chain, quantiles=(0.16, 0.5, 0.84),
+                 tolerance=0.05, z=1.0, column=XS_COM_FIT_INDEX,
+                 function=None, discard=0, thin=None, batch_size=None,
+                 min_samples=32, max_samples=None, executor=None,
+                 processes=None, seed=None):
+        chain = np.asarray(chain, dtype=np.float64)
+        assert chain.ndim in (2, 3), \
+            'chain must be (nsteps, nwalkers, ndim) or (nsamples, ndim).'
+        assert len(quantiles) >= 2, 'At least two quantiles are required.'
+        self.azr = azr
+        self.quantiles = np.asarray(quantiles, dtype=np.float64)
+        self.tolerance = tolerance
+        self.z = z
+        self.column = column
+        self.function = function
+        self.batch_size = batch_size
+        self.min_samples = min_samples
+        self.executor = executor
+        self.processes = processes
+        self.seed = seed
+
+        if chain.ndim == 3:
+            chain = chain[discard:]
+            self.tau = integrated_time(chain)
+            self.thin = thin or max(1, int(np.ceil(self.tau)))
+            steps = np.arange(chain.shape[0] - 1, -1, -self.thin)[::-1]
+            self.chain = chain.reshape(-1, chain.shape[2])
+            nwalkers = chain.shape[1]
+            self.candidates = (steps[:, None]*nwalkers +
+                               np.arange(nwalkers)[None, :]).ravel()
+        else:
+            self.tau = None
+            self.thin = thin or 1
+            self.chain = chain
+            self.candidates = np.arange(0, chain.shape[0], self.thin)
+        self.max_samples = min(max_samples or self.candidates.size,
+                               self.candidates.size)
+
+
+    def evaluate(self, executor, thetas):
+        '''
+        Returns the predictions at thetas (array, NaN rows on failure).
+        '''
+        if self.function is None:
+            return executor.predict_matrix(thetas, column=self.column)
+        results = executor.map(self.function, thetas)
+        width = max((np.size(r) for r in results if r is not None), default=0)
+        return np.array([np.full(width, np.nan) if r is None else r for r in
+                         results], dtype=np.float64).reshape(len(results),
+                                                             width)
+
+
+    def summarize(self, values):
+        '''
+        Returns the bands, their errors, and the largest relative error.
+        '''
+        ok = values[~np.any(np.isnan(values), axis=1)]
+        if ok.shape[0] < 2 or values.shape[1] == 0:
+            return None, None, np.inf
+        bands, errors = quantile_errors(ok, self.quantiles, z=self.z)
+        width = bands.max(axis=0) - bands.min(axis=0)
+        scale = np.maximum(width, 1e-12*np.abs(bands).max(axis=0))
+        relative = np.where(scale > 0, errors/np.where(scale > 0, scale, 1),
+                            0)
+        return bands, errors, float(relative.max())
+
+
+    def run(self, verbose=False):
+        '''
+        Evaluates batches of samples until the bands are within the
+        tolerance (or max_samples are used up). Returns a BandResult.
+        '''
+        order = self.candidates[stratified_order(self.candidates.size,
+                                                 self.seed)]
+        order = order[:self.max_samples]
+
+        own_executor = self.executor is None
+        executor = (Executor(self.azr, processes=self.processes) if
+                    own_executor else self.executor)
+        calls = executor.usage.calls
+        batch = self.batch_size or 4*executor.processes
+        values = []
+        history = []
+        n = 0
+        bands = errors = None
+        error = np.inf
+        try:
+            while n < order.size:
+                indices = order[n:n+batch]
+                values.append(self.evaluate(executor, self.chain[indices]))
+                n += indices.size
+                bands, errors, error = self.summarize(stack_batches(values))
+                history.append((n, error))
+                if verbose:
+                    print(f'{n} samples: error {error:.3g} (tolerance '
+                          f'{self.tolerance:.3g})')
+                if n >= self.min_samples and error <= self.tolerance:
+                    break
+                # error ~ 1/sqrt(n): aim for the tolerance, but at most
+                # double the samples at once.
+                if np.isfinite(error) and error > 0:
+                    needed = n*(error/self.tolerance)**2 - n
+                    batch = int(min(max(np.ceil(needed), batch), n))
+        finally:
+            if own_executor:
+                executor.close()
+
+        return BandResult(self.quantiles, bands, errors, error,
+                          error <= self.tolerance, order[:n],
+                          stack_batches(values), executor.usage.calls - calls,
+                          self.tau, self.thin, history)
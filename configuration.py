@@ -3,32 +3,68 @@ Class to read and write the contents of an AZURE2 input file.
 The purpose is to remove as much of this work from AZR as possible.
 '''
 
+import re
+import copy
+
 import utility
-from data import Data
+import data
+import nodata
 from nodata import Test
 from parameter import Parameter
+from document import AzrDocument, find_sections
+
+'''
+The segment list (e.g. "3-20") of a row in <targetInt>.
+'''
+SEGMENT_LIST_PATTERN = re.compile(r'"([^"]*)"')
+
+class State:
+    '''
+    Everything that depends on theta in one evaluation:
+    theta        : the point in parameter space
+    levels       : Levels (flattened) with the values of theta
+    norm_factors : segment index -> normalization factor
+    Config, Data, and their Levels and Segments are never modified by an
+    evaluation; only States are. So one Config (and one AZR) can serve
+    several threads at once.
+    '''
+    def __init__(self, theta, levels, norm_factors):
+        self.theta = theta
+        self.levels = levels
+        self.norm_factors = norm_factors
+
 
 class Config:
-    def __init__(self, input_filename, parameters=None):
-        self.input_filename = input_filename
+    '''
+    document : AzrDocument of input_filename (optional; if it's not provided,
+               it's loaded, using a snapshot if one matches)
+
+    Config is read-only once built: evaluations work on a State (see
+    state()). (The caches of compiled inputs only ever gain entries.)
+    '''
+    def __init__(self, input_filename, parameters=None, document=None):
+        if document is None:
+            document = AzrDocument.load(input_filename)
         self.input_filename = input_filename
-        self.input_file_contents = utility.read_input_file(input_filename)
-        self.initial_levels = utility.read_levels(input_filename)
-        self.data = Data(self.input_filename)
-        self.test = Test(self.input_filename)
+        self.document = document
+        self.input_file_contents = document.contents
+        self.initial_levels = document.levels
+        self.data = document.data
+        self.test = document.test
 
         if parameters is None:
             self.parameters = []
-            jpis = []
+            # number of levels with each J^pi so far
+            jpis = {}
             for group in self.initial_levels:
                 # grab the J^pi from the first row in the group
                 jpi = group[0].spin*group[0].parity
-                # add it to the list
-                jpis.append(jpi)
+                # count it
+                jpis[jpi] = jpis.get(jpi, 0) + 1
                 for (i, sublevel) in enumerate(group):
                     spin = sublevel.spin
                     parity = sublevel.parity
-                    rank = jpis.count(jpi)
+                    rank = jpis[jpi]
                     if i == 0:
                         if not sublevel.energy_fixed:
                             self.parameters.append(Parameter(spin, parity, 'energy', i+1, rank=rank))
@@ -45,11 +81,14 @@ class Config:
         else:
             self.parameters = parameters
 
-        Jpi = [l[0].spin*l[0].parity for l in self.initial_levels]
+        # index of the first level with each J^pi
+        first = {}
+        for (i, l) in enumerate(self.initial_levels):
+            first.setdefault(l[0].spin*l[0].parity, i)
         self.addresses = []
         for p in self.parameters:
             jpi = p.spin*p.parity
-            i = Jpi.index(jpi)
+            i = first[jpi]
             i += p.rank-1 # convert from one-based count to zero-based index
             j = p.channel-1 # convert from one-based count to zero-based index
             self.addresses.append([i, j, p.kind])
@@ -59,6 +98,9 @@ class Config:
         # number of free parameters
         self.nd = self.n1 + self.n2
 
+        # Compiled inputs (see variant), built on first use.
+        self.variants = {}
+
         self.labels = []
         for i in range(self.n1):
             self.labels.append(self.parameters[i].label)
@@ -67,7 +109,12 @@ class Config:
 
 
     def generate_levels(self, theta):
-        levels = self.initial_levels.copy()
+        '''
+        Returns new Levels (flattened) with the values of theta. The Levels of
+        the input file (self.initial_levels) are copied, not modified.
+        '''
+        levels = [[copy.copy(l) for l in group] for group in
+                  self.initial_levels]
         for (theta_i, address) in zip(theta, self.addresses):
             i, j, kind = address
             if kind == 'energy':
@@ -77,11 +124,28 @@ class Config:
                 '''
                 for sl in levels[i]:
                     sl.energy = theta_i
+            elif kind == 'channel_radius':
+                '''
+                The channel radius belongs to the channel pair, so every row
+                of that pair gets it.
+                '''
+                pair = levels[i][j].channel
+                for sl in [l for group in levels for l in group]:
+                    if sl.channel == pair:
+                        sl.channel_radius = theta_i
             else:
                 setattr(levels[i][j], kind, theta_i)
         return [l for sublevel in levels for l in sublevel]
 
 
+    def state(self, theta):
+        '''
+        Returns the State of an evaluation at theta.
+        '''
+        return State(theta, self.generate_levels(theta[:self.n1]),
+                     self.data.norm_factors(theta[self.n1:self.n1+self.n2]))
+
+
     def get_input_values(self):
         '''
         Returns the values of the sampled parameters in the input file.
@@ -103,17 +167,114 @@ class Config:
         return self.data.write_segments(contents)
 
 
-    def generate_workspace(self, theta, prepend='', mod_data=None):
+    def compile_contents(self, contents, test=False, segments=None):
+        '''
+        Returns the smallest input AZURE2 needs for a calculation:
+            * excluded rows of <segmentsData> are dropped, and so are the
+              rows not in segments (indices as in Data.all_segments; None
+              keeps every included row)
+            * rows of <segmentsTest> are dropped, except the included ones if
+              test is True (extrapolations)
+            * the segment lists of <targetInt> are renumbered to match (rows
+              left without segments are dropped)
+        and a dictionary mapping 'data' and 'test' to the indices (in the
+        original file) of the segment rows that were kept.
+        AZURE2 writes output only for included segments, in order, so the
+        output of the compiled input lines up with the original one (see
+        Data.layout).
+        '''
+        contents = contents.copy()
+        sections = find_sections(contents)
+        kept = {'data': [], 'test': []}
+
+        def prune(name, include_index, keep_included, wanted=None):
+            start, stop = sections[name]
+            rows = []
+            index = 0
+            for row in contents[start:stop]:
+                if row == '':
+                    continue
+                if (keep_included and int(row.split()[include_index]) == 1
+                        and (wanted is None or index in wanted)):
+                    rows.append(row)
+                    kept['data' if name == 'segmentsData' else 'test'].append(
+                        index)
+                index += 1
+            return rows
+
+        replacements = {
+            'segmentsData': prune('segmentsData', data.INCLUDE_INDEX, True,
+                                  None if segments is None else
+                                  set(segments)),
+            'segmentsTest': prune('segmentsTest', nodata.INCLUDE_INDEX, test)
+        }
+
+        if 'targetInt' in sections:
+            # Segment numbers in <targetInt> are one-based.
+            numbering = {old+1: new+1 for (new, old) in
+                         enumerate(kept['data'])}
+            rows = []
+            start, stop = sections['targetInt']
+            for row in contents[start:stop]:
+                match = SEGMENT_LIST_PATTERN.search(row)
+                if match is None:
+                    rows.append(row)
+                    continue
+                numbers = [numbering[n] for n in
+                           utility.parse_ranges(match.group(1))
+                           if n in numbering]
+                if numbers:
+                    rows.append(row[:match.start(1)] +
+                                utility.format_ranges(numbers) +
+                                row[match.end(1):])
+            replacements['targetInt'] = rows
+
+        # Replace from the bottom up so that the line indices of the sections
+        # above stay valid.
+        for name in sorted(replacements, key=lambda n: sections[n][0],
+                           reverse=True):
+            start, stop = sections[name]
+            contents[start:stop] = replacements[name]
+
+        return contents, kept
+
+
+    def variant(self, segments=None, test=False):
+        '''
+        Returns the input file compiled (see compile_contents) for a
+        calculation of segments (None: all included segments), and the
+        (line, segment index) of each of its <segmentsData> rows, whose
+        normalization factors are filled in per evaluation. Variants are
+        compiled once and cached.
+        '''
+        key = (None if segments is None else tuple(sorted(set(segments))),
+               test)
+        if key not in self.variants:
+            contents, kept = self.compile_contents(self.input_file_contents,
+                                                   test=test,
+                                                   segments=segments)
+            start, _ = find_sections(contents)['segmentsData']
+            self.variants[key] = (contents, [(start + j, k) for (j, k) in
+                                             enumerate(kept['data'])])
+        return self.variants[key]
+
+
+    def generate_workspace(self, theta, prepend='', mod_data=None, test=False,
+                           segments=None):
         '''
         Config handles the configuration of the calculation. That includes:
         * mapping theta to the relevant values in the input file
         * setting up the appropriate workspace for AZR to operate in
+        The input file is the compiled variant (see variant) for segments;
+        test determines whether the included test segments are kept.
         '''
-        contents = self.input_file_contents.copy()
-
-        new_levels = self.generate_levels(theta[:self.n1])
-        contents = self.data.update_norm_factors(theta[self.n1:self.n1+self.n2],
-            contents)
+        state = self.state(theta)
+        new_levels = state.levels
+        contents, rows = self.variant(segments, test=test)
+        contents = contents.copy()
+        for (line, k) in rows:
+            contents[line] = self.data.all_segments[k].string(
+                state.norm_factors.get(k))
 
         input_filename, output_dir, data_dir = utility.random_workspace(prepend=prepend)
 
@@ -121,16 +282,22 @@ class Config:
         if mod_data is not None:
             utility.write_input_file(contents, new_levels, input_filename,
                 output_dir, data_dir=data_dir)
-            self.data.update_all_dir(data_dir, contents)
-            for (i, data) in mod_data:
-                self.data.segments[i].update_dir(data_dir, data)
+            # Only the segments in the compiled input are staged.
+            staged = {k for (_, k) in rows}
+            for seg in self.data.segments:
+                if seg.index in staged:
+                    seg.update_dir(data_dir)
+            for (i, values) in mod_data:
+                if self.data.segments[i].index in staged:
+                    self.data.segments[i].update_dir(data_dir, values)
         else:
             utility.write_input_file(contents, new_levels, input_filename,
                 output_dir)
 
         return input_filename, output_dir, data_dir
 
-    def generate_workspace_extrap(self, theta, segment_indices=None):
+    def generate_workspace_extrap(self, theta, segment_indices=None,
+                                  prepend=''):
         '''
         Similar to generate_workspace, except the test segments are updated
         rather than the data segments.
@@ -149,9 +316,34 @@ class Config:
             for (i, test_segment) in enumerate(t.all_segments):
                 test_segment.include = i in segment_indices
             t.write_segments(contents)
+        contents, _ = self.compile_contents(contents, test=True)
 
         # Write the updated contents to the input file and run.
-        input_filename, output_dir = utility.random_output_dir_filename()
+        input_filename, output_dir = utility.random_output_dir_filename(
+            prepend=prepend)
         utility.write_input_file(contents, new_levels, input_filename,
                                  output_dir)
         return input_filename, output_dir, t.get_output_files()
+
+
+    def generate_workspace_energies(self, theta, requests, prepend=''):
+        '''
+        Like generate_workspace_extrap, except the test segments are replaced
+        by single-energy segments synthesized from requests (list of
+        ((in_channel, out_channel), lab energies); see
+        Test.write_synthesized).
+        Returns the input filename, the output directory, and the layout of
+        each request in the output files.
+        '''
+        contents = self.input_file_contents.copy()
+        new_levels = self.generate_levels(theta[:self.n1])
+
+        t = Test('', contents=contents)
+        contents, layout = t.write_synthesized(contents, requests)
+        contents, _ = self.compile_contents(contents, test=True)
+
+        input_filename, output_dir = utility.random_output_dir_filename(
+            prepend=prepend)
+        utility.write_input_file(contents, new_levels, input_filename,
+                                 output_dir)
+        return input_filename, output_dir, layout
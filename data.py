@@ -5,24 +5,87 @@ Classes to hold Data segments as found in .azr files.
 import numpy as np
 import utility
 from parameter import NormFactor
+import output
+from output import XS_COM_FIT_INDEX, XS_COM_DATA_INDEX
 
 INCLUDE_INDEX = 0
 IN_CHANNEL_INDEX = 1
 OUT_CHANNEL_INDEX = 2
+MIN_ENERGY_INDEX = 3
+MAX_ENERGY_INDEX = 4
+MIN_ANGLE_INDEX = 5
+MAX_ANGLE_INDEX = 6
+DATA_TYPE_INDEX = 7
 NORM_FACTOR_INDEX = 8
 VARY_NORM_FACTOR_INDEX = 9
 FILEPATH_INDEX = 11
 
+'''
+Data types (DATA_TYPE_INDEX). Only differential cross sections change under
+the lab -> center-of-mass transformation of the angle.
+'''
+ANGLE_INTEGRATED = 0
+DIFFERENTIAL = 1
+
+'''
+Number of columns of the AZURE2 output files (see output.py).
+'''
+OUTPUT_COLUMNS = 9
+
+'''
+2*pi*eta = SOMMERFELD_FACTOR*Z1*Z2*sqrt(mu/E), with the reduced mass mu in amu
+and the center-of-mass energy E in MeV.
+'''
+SOMMERFELD_FACTOR = 0.989534
+
+
+def output_layout(segments):
+    '''
+    Takes the included segments of a calculation (in order) and returns the
+    output files AZURE2 writes for them (sorted, as np.unique sorts them:
+    1, 2, 3, ..., TOTAL_CAPTURE) and where each segment's points are found in
+    them. AZURE2 writes the segments sharing an output file one after
+    another (in segment order). layout[k] = (output file, start row, stop
+    row) for segments[k].
+    '''
+    output_files = list(np.unique([seg.output_filename for seg in segments]))
+    layout = []
+    rows = {of: 0 for of in output_files}
+    for seg in segments:
+        start = rows[seg.output_filename]
+        rows[seg.output_filename] += seg.n_selected
+        layout.append((seg.output_filename, start, rows[seg.output_filename]))
+    return output_files, layout
+
+
+def concatenate_layout(layout, outputs, filenames, column):
+    '''
+    Returns the column of the outputs (read from filenames) at the points of
+    layout (see output_layout), concatenated.
+    '''
+    columns = {}
+    for (of, out) in zip(filenames, outputs):
+        contents = out.contents if hasattr(out, 'contents') else out
+        columns[of] = np.atleast_2d(contents)[:, column]
+    if not layout:
+        return np.zeros(0)
+    return np.concatenate([columns[of][start:stop] for (of, start, stop) in
+                           layout])
+
+
 class Segment:
     '''
     Structure to organize the information contained in a line in the
     <segmentsData> section of an AZURE2 input file.
+
+    values : data already read from the segment's file (optional)
     '''
-    def __init__(self, row, index):
+    def __init__(self, row, index, values=None):
         self.row = row.split()
         self.include = (int(self.row[INCLUDE_INDEX]) == 1)
         self.in_channel = int(self.row[IN_CHANNEL_INDEX])
         self.out_channel = int(self.row[OUT_CHANNEL_INDEX])
+        self.data_type = int(self.row[DATA_TYPE_INDEX])
         self.norm_factor = float(self.row[NORM_FACTOR_INDEX])
         self.vary_norm_factor = int(self.row[VARY_NORM_FACTOR_INDEX])
         self.index = index
@@ -36,32 +99,112 @@ class Segment:
         else:
             self.nf = None
         
-        self.values_original = np.loadtxt(self.filepath)
-        self.values = np.copy(self.values_original)
+        if values is None:
+            values = np.loadtxt(self.filepath)
+        self.values_original = values
+        # Read-only arrays (e.g. views into shared memory) can't be modified
+        # in place, so there's no need for a private copy.
+        if values.flags.writeable:
+            self.values = np.copy(self.values_original)
+        else:
+            self.values = self.values_original
         self.n = self.values.shape[0]
 
+        # AZURE2 only uses (and writes out) the points inside the segment's
+        # energy (lab) and angle windows.
+        self.min_energy = float(self.row[MIN_ENERGY_INDEX])
+        self.max_energy = float(self.row[MAX_ENERGY_INDEX])
+        self.min_angle = float(self.row[MIN_ANGLE_INDEX])
+        self.max_angle = float(self.row[MAX_ANGLE_INDEX])
+        v = np.atleast_2d(self.values_original)
+        self.selection = ((v[:, 0] >= self.min_energy) &
+                          (v[:, 0] <= self.max_energy) &
+                          (v[:, 1] >= self.min_angle) &
+                          (v[:, 1] <= self.max_angle))
+        self.n_selected = int(np.count_nonzero(self.selection))
+
         if self.out_channel != -1:
             self.output_filename = f'AZUREOut_aa={self.in_channel}_R={self.out_channel}.out'
         else:
             self.output_filename = f'AZUREOut_aa={self.in_channel}_TOTAL_CAPTURE.out'
 
     
-    def string(self):
+    def string(self, norm_factor=None):
         '''
-        Returns a string of the text in the segment line.
+        Returns a string of the text in the segment line, with norm_factor
+        (default: self.norm_factor) as the normalization factor.
         '''
+        if norm_factor is None:
+            norm_factor = self.norm_factor
         row = self.row.copy()
         # Are these lines...
         row[INCLUDE_INDEX] = '1' if self.include else '0'
         row[IN_CHANNEL_INDEX] = str(self.in_channel)
         row[OUT_CHANNEL_INDEX] = str(self.out_channel)
         row[FILEPATH_INDEX] = str(self.filepath)
-        row[NORM_FACTOR_INDEX] = str(self.norm_factor)
+        row[NORM_FACTOR_INDEX] = str(norm_factor)
         # necessary?
         
         return ' '.join(row)
 
 
+    def observed(self, pairs):
+        '''
+        Transforms the segment's (selected) data from the lab frame to the
+        center-of-mass frame, non-relativistically, with the masses and
+        separation energies of the particle pairs (see utility.read_pairs).
+        Returns an array laid out like the segment's rows of the AZURE2 output
+        file (see output.py), with NaN in the calculated columns. Like
+        AZURE2, the data are multiplied by the normalization factor given in
+        the input file (not the one in theta).
+        '''
+        v = np.atleast_2d(self.values)[self.selection]
+        norm_factor = float(self.row[NORM_FACTOR_INDEX])
+        e_lab, angle_lab = v[:, 0], v[:, 1]
+        xs, xs_err = v[:, 2]*norm_factor, v[:, 3]*norm_factor
+
+        entrance = pairs[self.in_channel]
+        m1, m2 = entrance.light_mass, entrance.heavy_mass
+        e_com = e_lab*m2/(m1 + m2)
+
+        # gamma: speed of the center of mass over the speed of the outgoing
+        # light particle in the center-of-mass frame (zero for photons).
+        gamma = np.zeros(e_com.size)
+        exit = pairs.get(self.out_channel)
+        if exit is not None and exit.light_mass > 0:
+            m3, m4 = exit.light_mass, exit.heavy_mass
+            e_out = e_com + entrance.separation_energy - exit.separation_energy
+            with np.errstate(divide='ignore', invalid='ignore'):
+                gamma = np.sqrt(m1*m3/(m2*m4)*e_com/e_out)
+
+        theta_lab = np.radians(angle_lab)
+        theta_com = theta_lab + np.arcsin(np.clip(gamma*np.sin(theta_lab),
+                                                  -1, 1))
+        if self.data_type == DIFFERENTIAL:
+            cos = np.cos(theta_com)
+            # dOmega_lab/dOmega_com
+            jacobian = (np.abs(1 + gamma*cos) /
+                        (1 + gamma**2 + 2*gamma*cos)**1.5)
+        else:
+            jacobian = np.ones(e_com.size)
+
+        z = entrance.light_charge*entrance.heavy_charge
+        with np.errstate(divide='ignore', over='ignore'):
+            penetrability = np.exp(SOMMERFELD_FACTOR*z*
+                                   np.sqrt(entrance.reduced_mass/e_com))
+
+        observed = np.full((e_com.size, OUTPUT_COLUMNS), np.nan)
+        observed[:, output.E_COM_INDEX] = e_com
+        observed[:, output.E_X_INDEX] = e_com + entrance.separation_energy
+        observed[:, output.ANGLE_COM_INDEX] = np.degrees(theta_com)
+        observed[:, output.XS_COM_DATA_INDEX] = xs*jacobian
+        observed[:, output.XS_ERR_COM_DATA_INDEX] = xs_err*jacobian
+        observed[:, output.SF_COM_DATA_INDEX] = xs*jacobian*e_com*penetrability
+        observed[:, output.SF_ERR_COM_DATA_INDEX] = \
+            xs_err*jacobian*e_com*penetrability
+        return observed
+
+
     def update_dir(self, new_dir, values=None):
         '''
         Updates the path directory of the segment.
@@ -86,8 +229,20 @@ class Data:
     '''
     Structure to hold all of the data segments in a provided AZURE2 input file.
     '''
-    def __init__(self, filename):
-        self.contents = utility.read_input_file(filename)
+    def __init__(self, filename, contents=None, values=None):
+        '''
+        Takes:
+            * filename : input filename (.azr)
+            * contents : list of strings (generated from the input file)
+            * values   : dict mapping data file paths to arrays already read
+        '''
+        # If contents is provided, don't try to read the input file.
+        if contents is not None:
+            self.contents = contents.copy()
+        else:
+            self.contents = utility.read_input_file(filename)
+        if values is None:
+            values = {}
         i = self.contents.index('<segmentsData>')+1
         j = self.contents.index('</segmentsData>')
 
@@ -96,7 +251,9 @@ class Data:
         k = 0
         for row in self.contents[i:j]:
             if row != '':
-                self.all_segments.append(Segment(row, k))
+                filepath = row.split()[FILEPATH_INDEX]
+                self.all_segments.append(Segment(row, k,
+                                                 values=values.get(filepath)))
                 k += 1
 
         # All segments included in the calculation.
@@ -114,13 +271,116 @@ class Data:
         # Number of data points for each included segment.
         self.ns = [seg.n for seg in self.segments] 
 
-        # Output files that need to be read.
-        self.output_files = []
+        # Output files that need to be read, and where each included
+        # segment's points are found in them (see output_layout).
+        self.output_files, self.layout = output_layout(self.segments)
+
+        # Total number of points AZURE2 calculates (segment order).
+        self.n_points = sum(seg.n_selected for seg in self.segments)
+
+        # Where each included segment's points are found in the concatenated
+        # vector (see concatenate). slices[k] is for self.segments[k].
+        self.slices = []
+        start = 0
         for seg in self.segments:
-            self.output_files.append(seg.output_filename)
-        # Eliminates repeated output files AND SORTS them:
-        # (1, 2, 3, ..., TOTAL_CAPTURE)
-        self.output_files = list(np.unique(self.output_files))
+            self.slices.append(slice(start, start + seg.n_selected))
+            start += seg.n_selected
+
+        # Observed data in the center-of-mass frame (see observed_matrix),
+        # computed on first use.
+        self.observed_cache = None
+
+        # Subsets of the included segments (see subset), built on first use.
+        self.subsets = {}
+
+
+    def segment_slice(self, index):
+        '''
+        Returns the slice of the concatenated vector (see concatenate) that
+        holds the points of segment index (as in self.all_segments).
+        '''
+        slices = {seg.index: s for (seg, s) in zip(self.segments, self.slices)}
+        assert index in slices, \
+            f'Segment {index} is not included in the calculation.'
+        return slices[index]
+
+
+    def subset(self, indices=None):
+        '''
+        Returns the Subset of the included segments with indices (as in
+        self.all_segments; None means all of them). Subsets are cached.
+        '''
+        key = None if indices is None else tuple(sorted(set(indices)))
+        if key not in self.subsets:
+            self.subsets[key] = Subset(self, key)
+        return self.subsets[key]
+
+
+    def observed_matrix(self, pairs=None):
+        '''
+        Returns the observed data of the included segments in the
+        center-of-mass frame (see Segment.observed), one row per point, in
+        Data order (as concatenate). The array is computed once and cached.
+        Takes:
+            * pairs : particle pairs (default: read from the input file)
+        '''
+        if self.observed_cache is None:
+            if pairs is None:
+                pairs = utility.read_pairs(None, contents=self.contents)
+            if self.segments:
+                matrix = np.concatenate([seg.observed(pairs) for seg in
+                                         self.segments])
+            else:
+                matrix = np.zeros((0, OUTPUT_COLUMNS))
+            matrix.flags.writeable = False
+            self.observed_cache = matrix
+        return self.observed_cache
+
+
+    def observed(self, column=XS_COM_DATA_INDEX, pairs=None):
+        '''
+        Returns one column (see output.py) of the observed data, aligned with
+        concatenate, without running AZURE2.
+        '''
+        return self.observed_matrix(pairs)[:, column]
+
+
+    def observed_outputs(self, filenames=None, pairs=None):
+        '''
+        Returns the observed data laid out like the AZURE2 output files
+        (default: self.output_files): one array per file, with the data
+        columns filled in and NaN in the calculated ones. They can stand in
+        for the output of a previous AZURE2 run, e.g.
+            scat, capt = data.observed_outputs(azr.output_filenames)
+        '''
+        if filenames is None:
+            filenames = self.output_files
+        matrix = self.observed_matrix(pairs)
+        rows = {of: 0 for of in self.output_files}
+        for (of, start, stop) in self.layout:
+            rows[of] = max(rows[of], stop)
+        outputs = {of: np.full((rows[of], OUTPUT_COLUMNS), np.nan) for of in
+                   self.output_files}
+        for ((of, start, stop), s) in zip(self.layout, self.slices):
+            outputs[of][start:stop] = matrix[s]
+        return [outputs[of] for of in filenames]
+
+
+    def concatenate(self, outputs, filenames=None, column=XS_COM_FIT_INDEX):
+        '''
+        Takes:
+            * outputs   : list of Output instances or arrays (as returned by
+                          AZR.predict)
+            * filenames : output files corresponding to outputs (default:
+                          self.output_files)
+            * column    : which column of the output (see output.py)
+        Returns:
+            * 1D array of that column for every point, with the segments in
+              Data order (self.segments)
+        '''
+        if filenames is None:
+            filenames = self.output_files
+        return concatenate_layout(self.layout, outputs, filenames, column)
 
 
     def update_all_dir(self, new_dir, contents):
@@ -146,29 +406,93 @@ class Data:
 
 
 
-    def write_segments(self, contents):
+    def write_segments(self, contents, norm_factors=None):
         '''
         Writes the segments to contents.
         "contents" is a representation of the .azr file (list of strings)
         This is typically done in preparation for writing a new .azr file.
+        norm_factors maps segment indices (as in self.all_segments) to the
+        normalization factors to write instead of the segments' own.
         '''
+        if norm_factors is None:
+            norm_factors = {}
         start = contents.index('<segmentsData>')+1
         stop = contents.index('</segmentsData>')
 
-        for (i, segment) in zip(range(start, stop), self.all_segments):
-            contents[i] = segment.string()
+        for (i, (k, segment)) in zip(range(start, stop),
+                                     enumerate(self.all_segments)):
+            contents[i] = segment.string(norm_factors.get(k))
 
         return contents
 
 
-    def update_norm_factors(self, theta_norm, contents):
+    def norm_factors(self, theta_norm):
+        '''
+        Returns a dictionary mapping the indices of the segments with varied
+        normalization factors to their values in theta_norm.
+        '''
         assert len(theta_norm) == len(self.norm_segment_indices), '''
 Number of normalization factors does not match the number of data segments
 indicating the normalization factor should be varied.
 '''
-        for (f, i) in zip(theta_norm, self.norm_segment_indices):
-            self.all_segments[i].norm_factor = f
+        return dict(zip(self.norm_segment_indices, theta_norm))
 
-        self.write_segments(contents)
-        
-        return contents
+
+    def update_norm_factors(self, theta_norm, contents):
+        '''
+        Writes the normalization factors theta_norm to contents. The segments
+        themselves are not modified, so Data can be shared between threads.
+        '''
+        return self.write_segments(contents, self.norm_factors(theta_norm))
+
+
+class Subset:
+    '''
+    Some of the included segments of Data, as AZURE2 sees them when only
+    they are included (see AZR.predict(theta, segments=...)).
+
+    indices      : indices (as in Data.all_segments) of the segments, sorted
+                   (None: all included segments)
+    segments     : the Segments, in Data order
+    output_files : output files AZURE2 writes for them
+    layout       : where their points are found in those files (see
+                   output_layout)
+    n_points     : number of points
+    selection    : indices of their points in Data's concatenated vector
+                   (see Data.concatenate), so full vectors (e.g.
+                   Data.observed) can be restricted to the subset
+    '''
+    def __init__(self, data, indices=None):
+        if indices is None:
+            indices = [seg.index for seg in data.segments]
+        included = {seg.index for seg in data.segments}
+        missing = set(indices) - included
+        assert not missing, \
+            f'Segments {sorted(missing)} are not included in the calculation.'
+        self.indices = sorted(indices)
+        self.segments = [seg for seg in data.segments if seg.index in
+                         self.indices]
+        self.output_files, self.layout = output_layout(self.segments)
+        self.n_points = sum(seg.n_selected for seg in self.segments)
+        self.selection = np.concatenate(
+            [np.arange(s.start, s.stop) for (seg, s) in
+             zip(data.segments, data.slices) if seg.index in self.indices] +
+            [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+
+
+    def concatenate(self, outputs, filenames=None, column=XS_COM_FIT_INDEX):
+        '''
+        Like Data.concatenate, for the output of a calculation with only the
+        subset included.
+        '''
+        if filenames is None:
+            filenames = self.output_files
+        return concatenate_layout(self.layout, outputs, filenames, column)
+
+
+    def restrict(self, vector):
+        '''
+        Returns the subset's points of a vector (or of the rows of an array)
+        aligned with Data.concatenate.
+        '''
+        return np.asarray(vector)[..., self.selection]
@@ -0,0 +1,468 @@
+'''
+Delayed-acceptance MCMC (Christen & Fox 2005) with the affine-invariant
+stretch move of emcee (Goodman & Weare 2010).
+
+Every proposal is first screened with a cheap approximation of the
+log-posterior. Only the proposals that pass are evaluated with the full
+log-posterior (a complete AZURE2 run), and the second stage corrects for the
+approximation:
+
+    stage 1: accept with min(1, z^(d-1) P*(y)/P*(x))
+    stage 2: accept with min(1, P(y) P*(x) / (P(x) P*(y)))
+
+so the chain samples the exact posterior P, whatever the quality of the
+approximation P*. A poor approximation only costs efficiency.
+
+Two approximations are provided:
+    * DecimatedPosterior: the same model on every factor-th point of each
+      included data segment (a reduced .azr written by decimate), with the
+      log-likelihood scaled up to the full number of points
+    * LinearSurrogate: a local linear fit of the prediction vector to the
+      full evaluations already made (no AZURE2 run at all)
+'''
+
+import os
+
+import numpy as np
+
+from azr import AZR
+from data import FILEPATH_INDEX
+from document import find_sections
+from output import XS_COM_FIT_INDEX, XS_COM_DATA_INDEX, XS_ERR_COM_DATA_INDEX
+from runner import AZURE2Error
+
+
+def decimate(azr, factor, directory=None):
+    '''
+    Writes a reduced copy of azr's input file in which every included data
+    segment keeps only every factor-th point inside its energy and angle
+    windows (the first point is always kept), in a file of its own. Excluded
+    segments are left alone, so the sampled parameters are the same as azr's.
+    Takes:
+        * azr       : AZR instance
+        * factor    : keep one point in factor
+        * directory : where the reduced data files go (default:
+                      decimated<factor>)
+    Returns:
+        * filename of the reduced .azr file
+    '''
+    assert factor >= 1, 'factor must be at least 1.'
+    if directory is None:
+        directory = f'decimated{factor}'
+    os.makedirs(directory, exist_ok=True)
+
+    config = azr.config
+    contents = config.input_file_contents.copy()
+    start, stop = find_sections(contents)['segmentsData']
+    rows = [i for i in range(start, stop) if contents[i] != '']
+    for (i, seg) in zip(rows, config.data.all_segments):
+        if not seg.include:
+            continue
+        # Segments may share a data file (with different windows), so each
+        # gets its own reduced file.
+        filepath = os.path.join(directory, f'{seg.index}_{seg.filename}')
+        kept = seg.values[seg.selection][::factor]
+        assert kept.shape[0] > 0, \
+            f'Segment {seg.index} has no points inside its windows.'
+        np.savetxt(filepath, kept)
+        row = contents[i].split()
+        row[FILEPATH_INDEX] = filepath
+        contents[i] = ' '.join(row)
+
+    stem = os.path.splitext(os.path.basename(config.input_filename))[0]
+    filename = os.path.join(directory, f'{stem}.azr')
+    with open(filename, 'w') as f:
+        f.write('\n'.join(contents))
+    return filename
+
+
+class DecimatedPosterior:
+    '''
+    Cheap log-posterior: log_prior plus the Gaussian log-likelihood of the
+    points of a decimated copy of azr's input (see decimate). Each segment's
+    terms are weighted by (points in the segment)/(points kept), so the
+    log-likelihood has the scale of the full one.
+
+    azr       : AZR instance of the full input
+    factor    : keep one point in factor
+    log_prior : function of theta
+    column    : output column compared to the data (see output.py)
+    directory : where the reduced input goes (see decimate)
+
+    The data and their uncertainties are read from AZURE2's output, so
+    normalization factors in theta are accounted for. External capture
+    integrals are computed by AZURE2 for the reduced points
+    (ext_capture_file='\\n'); integrals stored for the full data do not match
+    them.
+    '''
+    def __init__(self, azr, factor, log_prior, column=XS_COM_FIT_INDEX,
+                 directory=None):
+        self.factor = factor
+        self.log_prior = log_prior
+        self.column = column
+        self.azr = AZR(decimate(azr, factor, directory),
+                       parameters=azr.parameters,
+                       output_filenames=azr.output_filenames)
+        for attribute in ('use_brune', 'use_gsl', 'command', 'root_directory',
+                          'timeout', 'memory_limit', 'retries'):
+            setattr(self.azr, attribute, getattr(azr, attribute))
+
+        full = azr.config.data.segments
+        reduced = self.azr.config.data
+        self.weights = np.ones(reduced.n_points)
+        for (seg, s, original) in zip(reduced.segments, reduced.slices, full):
+            if seg.n_selected > 0:
+                self.weights[s] = original.n_selected/seg.n_selected
+
+
+    def __call__(self, theta):
+        lnpi = self.log_prior(theta)
+        if lnpi == -np.inf:
+            return -np.inf
+        try:
+            output = self.azr.predict(theta, dress_up=False)
+        except AZURE2Error:
+            return -np.inf
+        data = self.azr.config.data
+        filenames = self.azr.output_filenames
+        mu = data.concatenate(output, filenames, column=self.column)
+        y = data.concatenate(output, filenames, column=XS_COM_DATA_INDEX)
+        dy = data.concatenate(output, filenames, column=XS_ERR_COM_DATA_INDEX)
+        return lnpi + float(np.sum(self.weights*(
+            -np.log(np.sqrt(2*np.pi)*dy) - 0.5*((y - mu)/dy)**2)))
+
+
+class LinearSurrogate:
+    '''
+    Cheap log-posterior from a local linearization of the prediction vector:
+    the neighbors nearest to theta among the stored full evaluations (see
+    add) are fitted with mu(theta) ~ a + J theta, and the fitted prediction
+    goes into log_likelihood.
+
+    log_prior      : function of theta
+    log_likelihood : function of theta and the prediction vector (e.g.
+                     reweight.GaussianLikelihood)
+    neighbors      : number of stored points in each fit (default: 2(d+1))
+    capacity       : largest number of stored points (the oldest are
+                     dropped)
+
+    The surrogate runs in the main process (local = True), so it is never
+    pickled to a pool. Until enough points are stored it returns NaN, and the
+    sampler falls back to plain Metropolis. DelayedAcceptanceSampler stores
+    points only while learning is True; set it to False after burn-in so the
+    approximation (and hence the Markov kernel) stops changing. version counts
+    the points added, so the sampler knows when the values it screened
+    earlier are stale.
+    '''
+    local = True
+
+    def __init__(self, log_prior, log_likelihood, neighbors=None,
+                 capacity=5000):
+        self.log_prior = log_prior
+        self.log_likelihood = log_likelihood
+        self.neighbors = neighbors
+        self.capacity = capacity
+        self.learning = True
+        self.version = 0
+        self.thetas = []
+        self.predictions = []
+
+
+    def add(self, theta, mu):
+        mu = np.asarray(mu, dtype=np.float64)
+        if not np.all(np.isfinite(mu)):
+            return
+        self.thetas.append(np.asarray(theta, dtype=np.float64))
+        self.predictions.append(mu)
+        self.version += 1
+        if len(self.thetas) > self.capacity:
+            del self.thetas[0], self.predictions[0]
+
+
+    def predict(self, theta):
+        '''
+        Returns the linearized prediction vector at theta (None if too few
+        points are stored).
+        '''
+        theta = np.asarray(theta, dtype=np.float64)
+        k = self.neighbors or 2*(theta.size + 1)
+        if len(self.thetas) < k:
+            return None
+        x = np.array(self.thetas)
+        # Distances in units of the spread of the stored points.
+        spread = np.std(x, axis=0)
+        spread[spread == 0] = 1
+        nearest = np.argsort(np.sum(((x - theta)/spread)**2, axis=1))[:k]
+        design = np.column_stack((np.ones(k), (x[nearest] - theta)/spread))
+        coefficients, *_ = np.linalg.lstsq(
+            design, np.array([self.predictions[i] for i in nearest]),
+            rcond=None)
+        # At theta the centered design is zero, so the fit is the intercept.
+        return coefficients[0]
+
+
+    def __call__(self, theta):
+        lnpi = self.log_prior(theta)
+        if lnpi == -np.inf:
+            return -np.inf
+        mu = self.predict(theta)
+        if mu is None:
+            return np.nan
+        return lnpi + float(self.log_likelihood(theta, mu))
+
+
+class DelayedAcceptanceStatistics:
+    '''
+    Counts kept by DelayedAcceptanceSampler.
+
+    proposals : proposals made
+    screened  : proposals rejected by the cheap first stage
+    full_runs : full log-posterior evaluations of proposals (each an AZURE2
+                run; the evaluations of the starting points are not counted)
+    accepted  : proposals accepted by both stages
+    fallbacks : proposals decided by plain Metropolis because the cheap
+                log-posterior was unavailable (NaN)
+    '''
+    def __init__(self):
+        self.proposals = 0
+        self.screened = 0
+        self.full_runs = 0
+        self.accepted = 0
+        self.fallbacks = 0
+
+
+    def saved(self):
+        '''
+        Number of full evaluations avoided (compared with evaluating every
+        proposal).
+        '''
+        return self.proposals - self.full_runs
+
+
+    def as_dict(self):
+        n = max(self.proposals, 1)
+        return {'proposals': self.proposals, 'screened': self.screened,
+                'full_runs': self.full_runs, 'saved': self.saved(),
+                'saved_fraction': self.saved()/n,
+                'acceptance': self.accepted/n,
+                'second_stage_acceptance':
+                    self.accepted/max(self.full_runs, 1),
+                'fallbacks': self.fallbacks}
+
+
+class DelayedAcceptanceSampler:
+    '''
+    Takes:
+        * log_prob        : full log-posterior, a picklable function of theta
+                            (e.g. model.lnP); it may return (log_prob, blob),
+                            like reweight.Recorder
+        * cheap_log_prob  : approximation of log_prob (e.g.
+                            DecimatedPosterior or LinearSurrogate); NaN means
+                            "not available"
+        * nwalkers        : number of walkers (even, more than 2 ndim is
+                            advisable)
+        * ndim            : number of parameters
+        * pool            : object with a map method (e.g. an Executor;
+                            default: serial)
+        * a               : scale of the stretch move
+        * surrogate       : LinearSurrogate to feed with the blobs of
+                            log_prob (default: cheap_log_prob if it has an
+                            add method)
+
+    Each half of the ensemble takes at most two pool.map calls per step: one
+    over the cheap approximation (skipped if it is local) and one over the
+    proposals that pass the first stage.
+    '''
+    def __init__(self, log_prob, cheap_log_prob, nwalkers, ndim, pool=None,
+                 a=2.0, seed=None, surrogate=None):
+        assert nwalkers % 2 == 0, 'nwalkers must be even.'
+        self.log_prob = log_prob
+        self.cheap_log_prob = cheap_log_prob
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.pool = pool
+        self.a = a
+        self.rng = np.random.default_rng(seed)
+        if surrogate is None and hasattr(cheap_log_prob, 'add'):
+            surrogate = cheap_log_prob
+        self.surrogate = surrogate
+        self.statistics = DelayedAcceptanceStatistics()
+
+        self.x = None
+        self.lnp = None
+        self.cheap = None
+        self.cheap_versions = None
+        self.blobs = None
+        self.chain = []
+        self.log_probs = []
+        self.blob_chain = []
+
+
+    def map(self, fn, thetas):
+        if self.pool is None or getattr(fn, 'local', False):
+            return list(map(fn, thetas))
+        return self.pool.map(fn, list(thetas))
+
+
+    def full(self, thetas):
+        '''
+        Returns the full log-posteriors (and blobs) at thetas.
+        '''
+        results = self.map(self.log_prob, thetas)
+        lnp = np.empty(len(thetas))
+        blobs = [None]*len(thetas)
+        for (i, result) in enumerate(results):
+            if isinstance(result, tuple):
+                lnp[i], blobs[i] = result[0], result[1]
+            else:
+                lnp[i] = result
+            if (blobs[i] is not None and self.surrogate is not None and
+                    self.surrogate.learning and np.isfinite(lnp[i])):
+                self.surrogate.add(thetas[i], blobs[i])
+        return lnp, blobs
+
+
+    def screen(self, thetas):
+        return np.array(self.map(self.cheap_log_prob, thetas),
+                        dtype=np.float64)
+
+
+    def initialize(self, p0):
+        self.x = np.array(p0, dtype=np.float64)
+        assert self.x.shape == (self.nwalkers, self.ndim), \
+            f'p0 must have shape ({self.nwalkers}, {self.ndim}).'
+        self.lnp, self.blobs = self.full(self.x)
+        self.cheap = self.screen(self.x)
+        self.cheap_versions = np.full(self.nwalkers, self.cheap_version())
+
+
+    def cheap_version(self):
+        '''
+        Version of the approximation (see LinearSurrogate.version; 0 if it
+        never changes).
+        '''
+        return getattr(self.cheap_log_prob, 'version', 0)
+
+
+    def refresh(self, active):
+        '''
+        Screens the walkers in active again if their cheap log-posterior came
+        from an earlier version of the approximation, so both stages of a
+        move use the same one.
+        '''
+        version = self.cheap_version()
+        stale = active[self.cheap_versions[active] != version]
+        if stale.size > 0:
+            self.cheap[stale] = self.screen(self.x[stale])
+            self.cheap_versions[stale] = version
+        return version
+
+
+    def move(self, active, complement):
+        '''
+        Stretch move of the walkers in active using the walkers in
+        complement.
+        '''
+        n = len(active)
+        stats = self.statistics
+        version = self.refresh(active)
+        z = ((self.a - 1)*self.rng.random(n) + 1)**2/self.a
+        partners = self.x[self.rng.choice(complement, size=n)]
+        y = partners + z[:, None]*(self.x[active] - partners)
+        log_z = (self.ndim - 1)*np.log(z)
+        stats.proposals += n
+
+        cheap_y = self.screen(y)
+        cheap_x = self.cheap[active]
+        # Where the approximation is unavailable (at x or y), the proposal is
+        # decided by plain Metropolis on the full log-posterior.
+        fallback = ~(np.isfinite(cheap_x) & ~np.isnan(cheap_y))
+        stats.fallbacks += int(np.count_nonzero(fallback))
+
+        with np.errstate(invalid='ignore'):
+            log_alpha1 = np.where(fallback, 0.0, log_z + cheap_y - cheap_x)
+        log_alpha1 = np.nan_to_num(log_alpha1, nan=-np.inf)
+        passed = np.log(self.rng.random(n)) < log_alpha1
+        stats.screened += int(np.count_nonzero(~passed))
+
+        candidates = np.flatnonzero(passed)
+        if candidates.size == 0:
+            return
+        lnp_y, blobs_y = self.full(y[candidates])
+        stats.full_runs += candidates.size
+        rows = active[candidates]
+        with np.errstate(invalid='ignore'):
+            log_alpha2 = np.where(
+                fallback[candidates],
+                log_z[candidates] + lnp_y - self.lnp[rows],
+                (lnp_y - self.lnp[rows]) -
+                (cheap_y[candidates] - cheap_x[candidates]))
+        log_alpha2 = np.nan_to_num(log_alpha2, nan=-np.inf)
+        accept = np.log(self.rng.random(candidates.size)) < log_alpha2
+        stats.accepted += int(np.count_nonzero(accept))
+
+        for (j, i) in enumerate(rows):
+            if accept[j]:
+                self.x[i] = y[candidates[j]]
+                self.lnp[i] = lnp_y[j]
+                self.cheap[i] = cheap_y[candidates[j]]
+                self.cheap_versions[i] = version
+                self.blobs[i] = blobs_y[j]
+
+
+    def step(self):
+        walkers = np.arange(self.nwalkers)
+        halves = (walkers[:self.nwalkers//2], walkers[self.nwalkers//2:])
+        for (active, complement) in (halves, halves[::-1]):
+            self.move(active, complement)
+        self.chain.append(self.x.copy())
+        self.log_probs.append(self.lnp.copy())
+        self.blob_chain.append(list(self.blobs))
+
+
+    def run(self, nsteps, p0=None, verbose=False):
+        '''
+        Advances the walkers nsteps steps, starting from p0 (array (nwalkers,
+        ndim)) or, if p0 is None, from where the previous run stopped.
+        Returns the positions of the walkers.
+        '''
+        if p0 is not None:
+            self.initialize(p0)
+        assert self.x is not None, 'p0 is required for the first run.'
+        for _ in range(nsteps):
+            self.step()
+            if verbose:
+                s = self.statistics.as_dict()
+                print(f'{len(self.chain):6d} | acceptance = \
+{s["acceptance"]:.3f} | full runs = {s["full_runs"]} | saved = {s["saved"]}')
+        return self.x.copy()
+
+
+    def get_chain(self, flat=False, discard=0, thin=1):
+        chain = np.array(self.chain)[discard::thin]
+        return chain.reshape(-1, self.ndim) if flat else chain
+
+
+    def get_log_prob(self, flat=False, discard=0, thin=1):
+        lnp = np.array(self.log_probs)[discard::thin]
+        return lnp.reshape(-1) if flat else lnp
+
+
+    def save(self, filename, name='mcmc'):
+        '''
+        Stores the chain in an emcee HDF5 backend, so it can be analyzed like
+        the chains of the MCMC scripts.
+        '''
+        import emcee
+
+        backend = emcee.backends.HDFBackend(filename, name=name)
+        backend.reset(self.nwalkers, self.ndim)
+        backend.grow(len(self.chain), None)
+        accepted = np.ones(self.nwalkers, dtype=bool)
+        # save_step stores the random state too, so State needs one.
+        random_state = np.random.get_state()
+        for (x, lnp) in zip(self.chain, self.log_probs):
+            backend.save_step(emcee.State(x, log_prob=lnp,
+                                          random_state=random_state),
+                              accepted)
+        return backend
@@ -0,0 +1,181 @@
+'''
+Single-pass model of an AZURE2 input file (.azr).
+
+The input file is read once and split into its sections. The data files
+listed in <segmentsData> are read once as well. Because np.loadtxt is by far
+the slowest part of setting up an AZR instance (and every pool worker does
+it), the data arrays are stored in a binary snapshot keyed by the hashes of
+the input file and of every data file. Building the same AZR again (e.g. in a
+worker) loads the snapshot instead of parsing text.
+'''
+
+import os
+import pickle
+import hashlib
+
+import numpy as np
+
+import utility
+from data import Data, FILEPATH_INDEX
+from nodata import Test
+
+SECTIONS = ('config', 'levels', 'segmentsData', 'segmentsTest', 'targetInt',
+            'lastRun')
+
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_dir():
+    '''
+    Where snapshots are stored. Override with $PYAZR_SNAPSHOT_DIR.
+    '''
+    return os.environ.get('PYAZR_SNAPSHOT_DIR',
+        os.path.join(os.path.expanduser('~'), '.pyazr', 'snapshots'))
+
+
+def snapshot_filename(input_filename):
+    name = hashlib.sha1(os.path.abspath(input_filename).encode()).hexdigest()
+    return os.path.join(snapshot_dir(), name + '.snap')
+
+
+def find_sections(contents):
+    '''
+    Returns a dictionary mapping each section name to the (start, stop) line
+    indices of its rows (i.e. contents[start:stop] are the rows between the
+    tags).
+    '''
+    sections = {}
+    for name in SECTIONS:
+        try:
+            start = contents.index(f'<{name}>')+1
+            stop = contents.index(f'</{name}>')
+        except ValueError:
+            continue
+        sections[name] = (start, stop)
+    return sections
+
+
+def data_filepaths(contents, sections=None):
+    '''
+    Returns the data file paths listed in <segmentsData> (in order).
+    '''
+    if sections is None:
+        sections = find_sections(contents)
+    start, stop = sections['segmentsData']
+    return [row.split()[FILEPATH_INDEX] for row in contents[start:stop]
+            if row != '']
+
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class AzrDocument:
+    '''
+    Contents of an AZURE2 input file organized by section.
+
+    filename   : input filename (.azr)
+    contents   : list of strings (see utility.read_input_file)
+    sections   : section name -> (start, stop) line indices
+    config     : rows of <config>
+    levels     : Levels, grouped as in utility.read_levels
+    pairs      : particle pairs (see utility.read_pairs)
+    data       : Data built from <segmentsData>
+    test       : Test built from <segmentsTest>
+    target_int : rows of <targetInt>
+    last_run   : rows of <lastRun>
+    values     : data file path -> array read from that file
+    digest     : hash of the input file
+    key        : hash of the input file and its data files
+    '''
+    def __init__(self, filename, contents, values=None, digest=None,
+                 key=None):
+        self.filename = filename
+        self.digest = digest
+        self.contents = contents
+        self.values = {} if values is None else values
+        self.key = key
+        self.sections = find_sections(contents)
+
+        self.config = self.rows('config')
+        self.levels = utility.read_levels(filename, contents=contents)
+        self.pairs = utility.read_pairs(filename, contents=contents)
+        self.data = Data(filename, contents=contents, values=self.values)
+        self.test = Test(filename, contents=contents)
+        self.target_int = self.rows('targetInt')
+        self.last_run = self.rows('lastRun')
+
+
+    def rows(self, name):
+        '''
+        Returns the rows of section name (empty if the section is missing).
+        '''
+        if name not in self.sections:
+            return []
+        start, stop = self.sections[name]
+        return self.contents[start:stop]
+
+
+    @classmethod
+    def load(cls, filename, snapshot=True):
+        '''
+        Reads the input file (once) and its data files.
+        If snapshot is True, the data arrays are loaded from (or saved to) a
+        snapshot whose key matches the current files.
+        '''
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        contents = raw.decode('utf-8').split('\n')
+        filepaths = list(dict.fromkeys(data_filepaths(contents)))
+
+        digest = hashlib.sha1(raw).hexdigest()
+        hasher = hashlib.sha1(digest.encode())
+        for path in filepaths:
+            hasher.update(path.encode())
+            hasher.update(file_hash(path).encode())
+        key = hasher.hexdigest()
+
+        values = read_snapshot(filename, key) if snapshot else None
+        if values is None:
+            values = {path: np.loadtxt(path) for path in filepaths}
+            if snapshot:
+                write_snapshot(filename, key, values)
+
+        return cls(filename, contents, values=values, digest=digest, key=key)
+
+
+def read_snapshot(input_filename, key):
+    '''
+    Returns the data arrays stored for input_filename if the snapshot's key
+    matches key. Otherwise, returns None.
+    '''
+    try:
+        with open(snapshot_filename(input_filename), 'rb') as f:
+            snap = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if snap.get('version') != SNAPSHOT_VERSION or snap.get('key') != key:
+        return None
+    return snap['values']
+
+
+def write_snapshot(input_filename, key, values):
+    '''
+    Stores the data arrays for input_filename under key. Failing to write the
+    snapshot is not an error (it's only a cache).
+    '''
+    filename = snapshot_filename(input_filename)
+    tmp = f'{filename}.{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': SNAPSHOT_VERSION, 'key': key,
+                         'values': values}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        # Write-then-rename so that concurrent readers never see a partial
+        # snapshot.
+        os.replace(tmp, filename)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
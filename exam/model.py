@@ -15,6 +15,7 @@ i = pwd.find('/exam')
 sys.path.append(pwd[:i])
 from azr import AZR
 from parameter import Parameter
+from runner import AZURE2Error
 ########################################
 # Set up AZR object and data.
 
@@ -88,10 +89,9 @@ ECintfile = ['intEC.dat']
 # We have all of the information we need to instantiate our AZR object.
 azr = AZR('12C+p.azr', parameters, output_files, ECintfile)
 
-# We'll read the data from the output file since it's already in the
-# center-of-mass frame.
-scat_data = np.loadtxt('output/' + output_files[0])
-capt_data = np.loadtxt('output/' + output_files[1])
+# The data in the center-of-mass frame, laid out like the output files
+# (computed from the data files; no AZURE2 run needed).
+scat_data, capt_data = azr.config.data.observed_outputs(output_files)
 
 x_scat = scat_data[:, 0] # energies
 y_scat = scat_data[:, 5] # cross sections
@@ -282,5 +282,10 @@ def lnP(theta):
     # calling it with a parameter value that will throw an error.
     if lnpi == -np.inf:
         return lnpi
-    return lnL(theta) + lnpi
+    # AZURE2 failures (including points already known to fail) are treated as
+    # having zero posterior probability.
+    try:
+        return lnL(theta) + lnpi
+    except AZURE2Error:
+        return -np.inf
 
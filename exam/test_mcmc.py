@@ -9,13 +9,13 @@
 
 import os
 import sys
-from multiprocessing import Pool
 
 import emcee
 import numpy as np
 from scipy import stats
 
 import model
+from executor import Executor
 
 ########################################
 # We'll set up the sampler and get it started.
@@ -38,15 +38,15 @@ backend.reset(nw, model.nd)
 
 nsteps = 1000 # How many steps should each walker take?
 nthin = 10 # How often should the walker save a step?
-nprocs = 4 # How many Python processes do you want to allocate?
-# AZURE2 and emcee are both parallelized. We'll restrict AZURE2 to 1 thread to
-# simplify things.
-os.environ['OMP_NUM_THREADS'] = '1'
+# AZURE2 and emcee are both parallelized. The Executor splits the cores between
+# Python processes and AZURE2 OpenMP threads. Run model.azr.tune() once to
+# calibrate that split for this machine; it's remembered afterwards.
+nprocs = model.azr.processes # None => one process per core
 
 # emcee allows the user to specify the way the ensemble generates proposals.
 moves = [(emcee.moves.DESnookerMove(), 0.8), (emcee.moves.DEMove(), 0.2)]
 
-with Pool(processes=nprocs) as pool:
+with Executor(model.azr, processes=nprocs) as pool:
     sampler = emcee.EnsembleSampler(nw, model.nd, model.lnP, moves=moves, pool=pool,
             backend=backend)
     state = sampler.run_mcmc(p0, nsteps, thin_by=nthin, progress=True, tune=True)
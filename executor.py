@@ -0,0 +1,574 @@
+'''
+Evaluates AZR at many points in parameter space in parallel.
+'''
+
+import os
+import copy
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+import runner
+import schedule
+from runner import AZURE2Error, Usage
+from schedule import CostModel, BatchReport
+from output import XS_COM_FIT_INDEX
+from shared import SharedAZR, SharedMatrix
+
+'''
+Modules imported once by the forkserver, so forked workers start with them
+already loaded.
+'''
+PRELOAD = ['numpy', 'utility', 'level', 'parameter', 'data', 'nodata',
+           'output', 'document', 'configuration', 'runner', 'schedule',
+           'shared', 'azr']
+
+'''
+AZR instance of a worker process (set by the pool initializer).
+'''
+_azr = None
+
+'''
+Result matrix the worker is currently attached to.
+'''
+_results = None
+
+
+def _initialize(azr, omp_threads):
+    '''
+    Runs once in every worker. AZURE2 children launched by the worker get
+    OMP_NUM_THREADS=omp_threads in their environment; the worker's own
+    environment is left alone.
+    '''
+    global _azr
+    _azr = azr
+    if omp_threads is not None:
+        runner.DEFAULT_ENV['OMP_NUM_THREADS'] = str(omp_threads)
+        # The worker has its own copy of azr.
+        if azr is not None:
+            azr.omp_threads = omp_threads
+
+
+def _initialize_shared(handle, omp_threads):
+    '''
+    Like _initialize, but the worker's AZR instance is attached to the data
+    the parent published in shared memory.
+    '''
+    _initialize(handle.attach(), omp_threads)
+
+
+def _run_chunk(args):
+    '''
+    Runs fn(x) for the (i, x) of a chunk. Returns (i, fn(x), Usage of the
+    AZURE2 runs it made, wall time) for each.
+    '''
+    fn, items = args
+    results = []
+    for (i, x) in items:
+        start = time.perf_counter()
+        with runner.collect() as usage:
+            result = fn(x)
+        results.append((i, result, usage, time.perf_counter() - start))
+    return results
+
+
+def _evaluate(args):
+    method, theta, kwargs = args
+    return getattr(_azr, method)(theta, **kwargs)
+
+
+def _evaluate_or_none(args):
+    '''
+    Like _evaluate, but AZURE2 failures give None instead of an exception.
+    '''
+    try:
+        return _evaluate(args)
+    except AZURE2Error:
+        return None
+
+
+def _attach_results(matrix):
+    '''
+    Keeps the worker attached to the current result matrix (and lets go of
+    the previous one).
+    '''
+    global _results
+    if _results is None or _results.name != matrix.name:
+        if _results is not None:
+            _results.close()
+        _results = matrix
+    return _results.array
+
+
+def _predict_into(args):
+    '''
+    Writes the prediction at theta into row i of the shared result matrix.
+    Returns the error message if AZURE2 failed (the row is NaN), else None.
+    '''
+    i, theta, matrix, column, kwargs = args
+    results = _attach_results(matrix)
+    try:
+        output = _azr.predict(theta, dress_up=False, **kwargs)
+    except AZURE2Error as e:
+        results[i] = np.nan
+        return str(e)
+    results[i] = _azr.concatenate(output, column=column,
+                                  segments=kwargs.get('segments'))
+    return None
+
+
+def features(x):
+    '''
+    x as a feature vector for the CostModel (None unless it's a 1D array of
+    numbers, e.g. theta).
+    '''
+    try:
+        f = np.asarray(x, dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+    return f if f.ndim == 1 else None
+
+
+def job_type(fn, x):
+    '''
+    Returns the job type and the features of the task fn(x). Evaluations of
+    AZR methods ((method, theta, kwargs)) are typed by the method and the
+    names of the keyword arguments, anything else by fn.
+    '''
+    if isinstance(x, tuple) and len(x) == 3 and isinstance(x[0], str):
+        method, theta, kwargs = x
+        return (method,) + tuple(sorted(kwargs)), features(theta)
+    name = getattr(fn, '__qualname__', type(fn).__qualname__)
+    return (getattr(fn, '__module__', None), name), features(x)
+
+
+def preload_modules():
+    '''
+    Returns the modules the forkserver should import.
+    The forkserver does not inherit sys.path (only its working directory and
+    $PYTHONPATH), so the pyazr modules are only preloaded if it can find them.
+    Otherwise "data" would resolve to the data/ directory next to an .azr
+    file and break every worker.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    search = [os.getcwd()] + os.environ.get('PYTHONPATH', '').split(os.pathsep)
+    if any(os.path.abspath(p) == here for p in search if p):
+        return PRELOAD
+    return PRELOAD[:1]
+
+
+def default_omp_threads(processes, ncpu=None):
+    '''
+    Splits the available cores evenly among the processes.
+    '''
+    ncpu = ncpu or os.cpu_count()
+    return max(1, ncpu // processes)
+
+
+class Batches:
+    '''
+    Cost-balanced batches (see schedule.py), shared by Executor and
+    ThreadExecutor. Subclasses provide processes, cost_model, batches,
+    record(i, usage), and submit(tasks) (an iterator over the results of
+    _run_chunk(task) for the tasks, in any order).
+    '''
+    def run_batch(self, fn, items, job=None, task_features=None):
+        '''
+        Evaluates fn(x) for x in items in cost-balanced chunks. Yields
+        (i, fn(items[i]), usage) as the tasks finish, learns their costs,
+        and appends a BatchReport to self.batches once the batch is done.
+        '''
+        if job is None and items:
+            job, _ = job_type(fn, items[0])
+        if task_features is None:
+            task_features = [job_type(fn, x)[1] for x in items]
+        costs = self.cost_model.predict(job, task_features)
+        chunks = schedule.plan(costs, self.processes)
+
+        tasks = [(fn, [(i, items[i]) for i in chunk]) for chunk in chunks]
+        start = time.monotonic()
+        busy = 0.0
+        for results in self.submit(tasks):
+            for (i, result, usage, seconds) in results:
+                busy += seconds
+                self.cost_model.add(job, task_features[i], seconds)
+                self.record(i, usage)
+                yield i, result, usage
+        self.batches.append(BatchReport(job, len(items), len(chunks),
+                                        self.processes,
+                                        time.monotonic() - start, busy,
+                                        float(costs.sum())))
+
+
+    @property
+    def last_batch(self):
+        return self.batches[-1] if self.batches else None
+
+
+    def map(self, fn, iterable):
+        items = list(iterable)
+        self.task_usage = [None]*len(items)
+        results = [None]*len(items)
+        for (i, result, _) in self.run_batch(fn, items):
+            results[i] = result
+        return results
+
+
+    def in_order(self, finished, n):
+        '''
+        Yields the results of run_batch in task order, as soon as each one
+        and all those before it are done.
+        '''
+        self.task_usage = [None]*n
+        pending = {}
+        k = 0
+        for (i, result, _) in finished:
+            pending[i] = result
+            while k in pending:
+                yield pending.pop(k)
+                k += 1
+
+
+    def predict_rows(self, fn, thetas, tasks, kwargs):
+        '''
+        Runs the predict_matrix tasks (fn returns an error message or None).
+        '''
+        n = len(thetas)
+        job = ('predict',) + tuple(sorted(kwargs))
+        self.failed = {}
+        self.task_usage = [None]*n
+        for (i, error, _) in self.run_batch(fn, tasks, job=job,
+                task_features=[features(theta) for theta in thetas]):
+            if error is not None:
+                self.failed[i] = error
+
+
+class Executor(Batches):
+    '''
+    Pool of worker processes, each of which runs AZURE2 with a fixed number of
+    OpenMP threads.
+
+    azr         : AZR instance evaluated by predict()/extrapolate() (optional;
+                  map() works with any picklable function, e.g. lnP)
+    processes   : number of worker processes
+    omp_threads : OMP_NUM_THREADS given to each AZURE2 child
+    shared      : Publish azr's data arrays in shared memory and attach the
+                  workers to them (instead of giving each worker a copy)?
+    context     : multiprocessing start method ('fork', 'spawn',
+                  'forkserver'; None = platform default). With 'forkserver',
+                  the pyazr modules are imported once by the server rather
+                  than by every worker.
+
+    If processes or omp_threads are not given, they are taken from azr (which
+    picks them up from a previous calibration, see tuning.py), and otherwise
+    the cores are split evenly.
+
+    Executor.map has the same signature as Pool.map, so an Executor can be
+    handed to emcee as its pool.
+
+    Tasks are not split into equal chunks: the Executor learns how long each
+    kind of task takes (cost_model, see schedule.py), hands out the
+    longest-expected tasks first, and sizes the chunks so that they shrink
+    towards the end of a batch. batches holds a BatchReport (with the idle
+    percentage) for every call. Pass the cost_model of another Executor to
+    start from its history.
+
+    predict_matrix() avoids pickling predictions altogether: workers write
+    into a result matrix in shared memory and only send back row indices.
+
+    Every task reports the resources its AZURE2 runs used (runner.Usage).
+    task_usage holds them for the tasks of the latest call (in task order),
+    usage is the total over the Executor's lifetime, and they are also added
+    to azr.usage.
+    '''
+    def __init__(self, azr=None, processes=None, omp_threads=None,
+                 shared=False, context=None, cost_model=None):
+        if azr is not None:
+            processes = processes or azr.processes
+            omp_threads = omp_threads or azr.omp_threads
+        self.azr = azr
+        self.processes = processes or os.cpu_count()
+        self.omp_threads = (omp_threads if omp_threads is not None else
+                            default_omp_threads(self.processes))
+
+        ctx = multiprocessing.get_context(context)
+        if context == 'forkserver':
+            ctx.set_forkserver_preload(preload_modules())
+
+        self.results = None
+        self.failed = {}
+        self.usage = Usage()
+        self.task_usage = []
+        self.cost_model = cost_model or CostModel()
+        self.batches = []
+
+        self.shared = None
+        if azr is not None and shared:
+            self.shared = SharedAZR(azr)
+            initializer, initargs = _initialize_shared, (self.shared,
+                                                         self.omp_threads)
+        else:
+            initializer, initargs = _initialize, (azr, self.omp_threads)
+
+        try:
+            self.pool = ctx.Pool(self.processes, initializer=initializer,
+                                 initargs=initargs)
+        except:
+            self.release()
+            raise
+
+
+    def record(self, i, usage):
+        self.task_usage[i] = usage
+        self.usage.add(usage)
+        if self.azr is not None:
+            self.azr.usage.add(usage)
+
+
+    def submit(self, tasks):
+        return self.pool.imap_unordered(_run_chunk, tasks)
+
+
+    def predict(self, thetas, **kwargs):
+        '''
+        Returns [azr.predict(theta, **kwargs) for theta in thetas].
+        '''
+        return self.map(_evaluate,
+                        [('predict', theta, kwargs) for theta in thetas])
+
+
+    def predict_matrix(self, thetas, column=XS_COM_FIT_INDEX, **kwargs):
+        '''
+        Takes:
+            * thetas : points in parameter space
+            * column : output column to collect (see output.py; default is
+                       the calculated cross section)
+        Returns:
+            * array (len(thetas), azr.config.data.n_points); row i is the
+              prediction at thetas[i], with the points of the included data
+              segments concatenated in Data order (see Data.concatenate).
+              With segments=[...] (see AZR.predict), only the points of
+              those segments (see Subset.concatenate).
+        Rows at which AZURE2 failed are NaN; the messages are stored in
+        self.failed (row index -> message).
+        The workers write into shared memory owned by the Executor, which is
+        reused by the next call and released by close(); the array returned
+        is a copy, so it stays valid after either.
+        '''
+        assert self.azr is not None, 'Executor needs an AZR instance.'
+        n = len(thetas)
+        m = self.azr.config.data.subset(kwargs.get('segments')).n_points
+        if (self.results is None or self.results.shape[0] < n or
+                self.results.shape[1] != m):
+            if self.results is not None:
+                self.results.unlink()
+            self.results = SharedMatrix.create((n, m))
+
+        tasks = [(i, theta, self.results, column, kwargs) for (i, theta) in
+                 enumerate(thetas)]
+        self.predict_rows(_predict_into, thetas, tasks, kwargs)
+        return self.results.array[:n].copy()
+
+
+    def imap_or_none(self, method, thetas, **kwargs):
+        '''
+        Lazily yields azr.<method>(theta, **kwargs) for theta in thetas, in
+        order, with None wherever AZURE2 failed.
+        '''
+        items = [(method, theta, kwargs) for theta in thetas]
+        return self.in_order(self.run_batch(_evaluate_or_none, items),
+                             len(items))
+
+
+    def extrapolate(self, thetas, **kwargs):
+        '''
+        Returns [azr.extrapolate(theta, **kwargs) for theta in thetas].
+        '''
+        return self.map(_evaluate,
+                        [('extrapolate', theta, kwargs) for theta in thetas])
+
+
+    def release(self):
+        '''
+        Frees the shared memory (if any). Called after the pool is shut down.
+        '''
+        if self.shared is not None:
+            self.shared.unlink()
+            self.shared = None
+        if self.results is not None:
+            self.results.unlink()
+            self.results = None
+
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.release()
+
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.release()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+class ThreadExecutor(Batches):
+    '''
+    Pool of threads in this process, each of which runs AZURE2 with a fixed
+    number of OpenMP threads. Same interface as Executor.
+
+    azr         : AZR instance evaluated by predict()/extrapolate() (optional)
+    threads     : number of threads (concurrent AZURE2 runs)
+    omp_threads : OMP_NUM_THREADS given to each AZURE2 child
+
+    Python mostly waits on AZURE2 while evaluating a point, so threads do as
+    well as processes without starting workers or pickling azr and the
+    results. Sharing azr between threads is safe: Config and Data are not
+    modified by evaluations (every evaluation has its own
+    configuration.State), the caches and Usage that azr does modify are
+    locked, and AZURE2 is launched without running Python in the forked child
+    (the memory limit is set by the shell, see runner.limit_memory).
+    Functions passed to map() must be thread-safe themselves (lnP of the
+    examples is). CPU-bound Python in fn (e.g. an expensive prior) holds the
+    GIL, so it is better off in an Executor.
+
+    The threads share one copy of azr (with omp_threads set), whose runs are
+    added to azr.usage directly. usage, task_usage, and the load balancing
+    (cost_model, batches) are as in Executor.
+    '''
+    def __init__(self, azr=None, threads=None, omp_threads=None,
+                 cost_model=None):
+        if azr is not None:
+            threads = threads or azr.processes
+            omp_threads = omp_threads or azr.omp_threads
+        self.azr = azr
+        self.processes = threads or os.cpu_count()
+        self.omp_threads = (omp_threads if omp_threads is not None else
+                            default_omp_threads(self.processes))
+
+        self.worker_azr = None
+        if azr is not None:
+            self.worker_azr = copy.copy(azr)
+            self.worker_azr.omp_threads = self.omp_threads
+
+        self.results = None
+        self.failed = {}
+        self.usage = Usage()
+        self.task_usage = []
+        self.cost_model = cost_model or CostModel()
+        self.batches = []
+        self.pool = ThreadPoolExecutor(max_workers=self.processes)
+
+
+    def record(self, i, usage):
+        # azr.usage already has the runs (worker_azr shares it).
+        self.task_usage[i] = usage
+        self.usage.add(usage)
+
+
+    def submit(self, tasks):
+        futures = [self.pool.submit(_run_chunk, task) for task in tasks]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+    def evaluate(self, args):
+        method, theta, kwargs = args
+        return getattr(self.worker_azr, method)(theta, **kwargs)
+
+
+    def evaluate_or_none(self, args):
+        try:
+            return self.evaluate(args)
+        except AZURE2Error:
+            return None
+
+
+    def predict(self, thetas, **kwargs):
+        '''
+        Returns [azr.predict(theta, **kwargs) for theta in thetas].
+        '''
+        return self.map(self.evaluate,
+                        [('predict', theta, kwargs) for theta in thetas])
+
+
+    def predict_into(self, args):
+        i, theta, column, kwargs = args
+        try:
+            output = self.worker_azr.predict(theta, dress_up=False, **kwargs)
+        except AZURE2Error as e:
+            self.results[i] = np.nan
+            return str(e)
+        self.results[i] = self.worker_azr.concatenate(
+            output, column=column, segments=kwargs.get('segments'))
+        return None
+
+
+    def predict_matrix(self, thetas, column=XS_COM_FIT_INDEX, **kwargs):
+        '''
+        Like Executor.predict_matrix (the threads write into an ordinary
+        array owned by the ThreadExecutor; a copy is returned).
+        '''
+        assert self.azr is not None, 'ThreadExecutor needs an AZR instance.'
+        n = len(thetas)
+        m = self.azr.config.data.subset(kwargs.get('segments')).n_points
+        if (self.results is None or self.results.shape[0] < n or
+                self.results.shape[1] != m):
+            self.results = np.empty((n, m))
+
+        tasks = [(i, theta, column, kwargs) for (i, theta) in
+                 enumerate(thetas)]
+        self.predict_rows(self.predict_into, thetas, tasks, kwargs)
+        return self.results[:n].copy()
+
+
+    def imap_or_none(self, method, thetas, **kwargs):
+        '''
+        Lazily yields azr.<method>(theta, **kwargs) for theta in thetas, in
+        order, with None wherever AZURE2 failed.
+        '''
+        items = [(method, theta, kwargs) for theta in thetas]
+        return self.in_order(self.run_batch(self.evaluate_or_none, items),
+                             len(items))
+
+
+    def extrapolate(self, thetas, **kwargs):
+        '''
+        Returns [azr.extrapolate(theta, **kwargs) for theta in thetas].
+        '''
+        return self.map(self.evaluate,
+                        [('extrapolate', theta, kwargs) for theta in thetas])
+
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+    def terminate(self):
+        # Running AZURE2 children finish (or hit azr.timeout); queued tasks
+        # are dropped.
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
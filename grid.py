@@ -0,0 +1,75 @@
+'''
+Energy grids that are refined where a curve needs them.
+
+Resolving a narrow resonance on a uniform grid means over-sampling the whole
+range. Instead, start with a coarse grid and repeatedly bisect only the
+intervals where the curve deviates from linear interpolation between its
+neighbours (i.e. where its curvature is large). See AZR.extrapolate_adaptive.
+'''
+
+import numpy as np
+
+
+def initial_grid(low, high, n, log=True):
+    '''
+    Returns n energies from low to high, evenly spaced in log(E) if log is
+    True.
+    '''
+    if log:
+        return np.geomspace(low, high, n)
+    return np.linspace(low, high, n)
+
+
+def interpolation_errors(x, y, log=True):
+    '''
+    Takes:
+        * x   : sorted energies
+        * y   : curve at x
+        * log : Compare in log(x), log(y)? (Falls back to linear y if y is
+                not positive.)
+    Returns:
+        * array of len(x): for each interior point, the difference between
+          the curve and the straight line through its two neighbours
+          (relative if log is True); zero at the end points.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    errors = np.zeros(x.size)
+    if x.size < 3:
+        return errors
+    if log and np.all(x > 0):
+        x = np.log(x)
+    if log and np.all(y > 0):
+        y = np.log(y)
+    else:
+        # Absolute differences are measured relative to the curve's scale.
+        scale = np.max(np.abs(y))
+        y = y/scale if scale > 0 else y
+    t = (x[1:-1] - x[:-2])/(x[2:] - x[:-2])
+    line = (1-t)*y[:-2] + t*y[2:]
+    errors[1:-1] = np.abs(y[1:-1] - line)
+    return errors
+
+
+def flag_intervals(errors, tolerance):
+    '''
+    Returns a boolean array (one entry per interval between consecutive
+    points) marking the intervals next to a point whose error exceeds the
+    tolerance.
+    '''
+    bad = errors > tolerance
+    return bad[:-1] | bad[1:]
+
+
+def midpoints(x, flags, log=True, min_spacing=0.0):
+    '''
+    Returns the midpoints (geometric if log is True) of the flagged intervals
+    of the sorted energies x, skipping intervals narrower than min_spacing.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    low, high = x[:-1][flags], x[1:][flags]
+    keep = (high - low) > min_spacing
+    low, high = low[keep], high[keep]
+    if log and np.all(low > 0):
+        return np.sqrt(low*high)
+    return (low + high)/2
@@ -26,3 +26,23 @@ class Level:
         sign = '+' if self.parity > 0 else '-'
         print(f'{self.spin}{sign} | \
 {self.energy} MeV | {self.width} eV | channel {self.channel}')
+
+
+class Pair:
+    '''
+    Particle pair (channel pair in AZURE2) as described by the rows of the
+    <levels> section: masses (amu) and charges of the light and heavy
+    particles, and the separation energy (MeV).
+    '''
+    def __init__(self, index, light_mass, heavy_mass, light_charge,
+                 heavy_charge, separation_energy):
+        self.index = index
+        self.light_mass = light_mass
+        self.heavy_mass = heavy_mass
+        self.light_charge = light_charge
+        self.heavy_charge = heavy_charge
+        self.separation_energy = separation_energy
+        if light_mass + heavy_mass > 0:
+            self.reduced_mass = light_mass*heavy_mass/(light_mass + heavy_mass)
+        else:
+            self.reduced_mass = 0.0
@@ -0,0 +1,227 @@
+'''
+Joint evaluation of several AZURE2 input files that share parameters (e.g.
+mirror systems, or reaction channels kept in separate .azr files).
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import runner
+from azr import AZR
+from output import XS_COM_FIT_INDEX
+from runner import Usage
+
+
+def parameter_key(parameter):
+    '''
+    Parameters of one input file with the same key are the same level
+    parameter. Channel pair numbers are local to the file, so the key does not
+    identify parameters across files (see shared_key).
+    '''
+    return (parameter.spin, parameter.parity, parameter.kind, parameter.rank,
+            parameter.channel)
+
+
+def pair_key(pair):
+    '''
+    Identifies a particle pair by its particles (masses and charges) rather
+    than by its number, which is local to each input file.
+    '''
+    return (round(pair.light_mass, 4), round(pair.heavy_mass, 4),
+            pair.light_charge, pair.heavy_charge)
+
+
+def shared_key(config, k):
+    '''
+    Returns the key under which shared_mapping ties sampled parameter k of
+    config to the parameters of other input files, or None if it is never
+    tied automatically:
+        * widths: J^pi, rank, the particle pair of the level row (see
+          pair_key), and which row of that pair in the level it is
+        * channel radii: the particle pair
+        * energies: None (mirror levels, for example, do not have equal
+          energies)
+    '''
+    parameter = config.parameters[k]
+    if parameter.kind == 'energy':
+        return None
+    i, j, kind = config.addresses[k]
+    rows = config.initial_levels[i]
+    pairs = config.document.pairs
+    pair = pair_key(pairs[rows[j].channel])
+    if kind == 'channel_radius':
+        return (kind, pair)
+    occurrence = sum(pair_key(pairs[row.channel]) == pair for row in rows[:j])
+    return (kind, parameter.spin, parameter.parity, parameter.rank, pair,
+            occurrence)
+
+
+def shared_mapping(azrs):
+    '''
+    Builds the mapping for MultiAZR by tying the level parameters of
+    different members that have the same shared_key: widths of the same
+    J^pi, rank, and particle pair, and channel radii of the same particle
+    pair. Energies and normalization factors are never shared.
+    Returns:
+        * mapping : one list per member; mapping[m][k] is the index in the
+                    global theta of parameter k of member m
+        * labels  : labels of the global parameters
+    '''
+    mapping = []
+    labels = []
+    keys = {}
+    for azr in azrs:
+        config = azr.config
+        indices = []
+        for k in range(config.n1):
+            key = shared_key(config, k)
+            # Never tie two parameters of the same member.
+            if key is None or key not in keys or keys[key] in indices:
+                index = len(labels)
+                labels.append(config.labels[k])
+                if key is not None and key not in keys:
+                    keys[key] = index
+            else:
+                index = keys[key]
+            indices.append(index)
+        for k in range(config.n1, config.nd):
+            indices.append(len(labels))
+            labels.append(config.labels[k])
+        mapping.append(indices)
+    return mapping, labels
+
+
+class MultiAZR:
+    '''
+    Several AZR instances evaluated together at one (global) point in
+    parameter space.
+
+    azrs    : list of AZR instances or input filenames (relative paths are
+              resolved from the working directory, as for AZR)
+    mapping : one list per member; mapping[m][k] is the index in the global
+              theta of sampled parameter k of member m (its Config.addresses,
+              followed by its normalization factors). Default: shared_mapping
+              (widths of the same J^pi, rank, and particle pair, and radii of
+              the same particle pair, are shared; energies are not). Give a
+              mapping to tie anything else.
+    labels  : labels of the global parameters (default: taken from the
+              members)
+
+    The member calculations for a theta run concurrently (in threads, since
+    the work happens in the AZURE2 child processes), so a joint evaluation
+    takes as long as the slowest member rather than the sum.
+
+    usage   : runner.Usage of every AZURE2 run made through this instance (the
+              members' own usage attributes count their runs too)
+    '''
+    def __init__(self, azrs, mapping=None, labels=None):
+        self.azrs = [a if isinstance(a, AZR) else AZR(a) for a in azrs]
+        if mapping is None:
+            mapping, default_labels = shared_mapping(self.azrs)
+            labels = labels or default_labels
+        self.mapping = [np.asarray(m, dtype=int) for m in mapping]
+
+        for (azr, m) in zip(self.azrs, self.mapping):
+            assert m.size == azr.config.nd, f'''
+{azr.config.input_filename} has {azr.config.nd} sampled parameters, but the
+mapping gives {m.size}.'''
+        self.nd = int(max(m.max() for m in self.mapping if m.size) + 1)
+        self.labels = labels
+
+        # Where each member's points are in the combined prediction vector.
+        self.layout = []
+        start = 0
+        for azr in self.azrs:
+            stop = start + azr.config.data.n_points
+            self.layout.append((start, stop))
+            start = stop
+        self.n_points = start
+
+        self.usage = Usage()
+
+        # Used by Executor, like the attributes of the same name in AZR.
+        self.processes = None
+        self.omp_threads = None
+
+
+    def member_thetas(self, theta):
+        '''
+        Maps the global theta to the theta of each member.
+        '''
+        theta = np.asarray(theta, dtype=np.float64)
+        return [theta[m] for m in self.mapping]
+
+
+    def get_input_values(self):
+        '''
+        Returns the global theta given by the input files (where members share
+        a parameter, the first member's value is used).
+        '''
+        values = np.full(self.nd, np.nan)
+        for (azr, m) in reversed(list(zip(self.azrs, self.mapping))):
+            values[m] = azr.config.get_input_values()
+        return values
+
+
+    def map_members(self, method, theta, **kwargs):
+        '''
+        Calls azr.<method>(member theta, **kwargs) for every member,
+        concurrently. Returns the results in member order. If a member fails,
+        its exception is raised once all of the members have finished.
+        The AZURE2 runs are added to self.usage and to the collectors of the
+        calling thread (see runner.collect).
+        '''
+        def call(azr, t):
+            with runner.collect() as usage:
+                try:
+                    return getattr(azr, method)(t, **kwargs)
+                finally:
+                    usages.append(usage)
+
+        usages = []
+        thetas = self.member_thetas(theta)
+        with ThreadPoolExecutor(max_workers=len(self.azrs)) as pool:
+            futures = [pool.submit(call, azr, t) for (azr, t) in
+                       zip(self.azrs, thetas)]
+        for usage in usages:
+            self.usage.add(usage)
+            runner.report(usage)
+        return [f.result() for f in futures]
+
+
+    def predict(self, theta, **kwargs):
+        '''
+        Returns the list of AZR.predict results (one per member) at the
+        global theta.
+        '''
+        return self.map_members('predict', theta, **kwargs)
+
+
+    def extrapolate(self, theta, **kwargs):
+        '''
+        Returns the list of AZR.extrapolate results (one per member) at the
+        global theta.
+        '''
+        return self.map_members('extrapolate', theta, **kwargs)
+
+
+    def predict_vector(self, theta, column=XS_COM_FIT_INDEX):
+        '''
+        Returns the predictions of every member at the global theta as one
+        1D array: the points of each member's included data segments (in Data
+        order, see Data.concatenate), with the members in order. The slice of
+        member m is self.layout[m].
+        '''
+        outputs = self.predict(theta, dress_up=False)
+        return self.concatenate(outputs, column=column)
+
+
+    def concatenate(self, outputs, column=XS_COM_FIT_INDEX):
+        '''
+        Combines the results of predict() into one vector (see
+        predict_vector).
+        '''
+        return np.concatenate([azr.config.data.concatenate(output,
+                               azr.output_filenames, column=column) for
+                               (azr, output) in zip(self.azrs, outputs)])
@@ -0,0 +1,340 @@
+'''
+Nested sampling for Bayesian evidence (e.g. to compare level schemes with and
+without a background pole).
+
+Live points are replaced in batches: the lowest-likelihood batch_size live
+points are discarded together, and their replacements are found by
+random walks inside the likelihood constraint that advance in lockstep. Every
+step of the walks is a single pool.map over the batch, so an Executor with
+batch_size processes keeps all of its workers (and their AZURE2 runs) busy.
+
+The sampler checkpoints its complete state and resumes from the checkpoint if
+one exists. Posterior samples can be stored in the same emcee HDF5 format as
+the MCMC scripts (see save_samples).
+'''
+
+import os
+import pickle
+
+import numpy as np
+
+CHECKPOINT_VERSION = 1
+
+
+class PriorTransform:
+    '''
+    Maps the unit cube to parameter space with the inverse CDFs of a list of
+    (frozen scipy.stats) prior distributions, like model.priors in test/.
+    '''
+    def __init__(self, priors):
+        self.priors = priors
+
+
+    def __call__(self, u):
+        return np.array([pi.ppf(ui) for (pi, ui) in zip(self.priors, u)])
+
+
+class NestedResult:
+    '''
+    Output of NestedSampler.run.
+
+    samples    : dead points followed by the final live points
+    logl       : their log-likelihoods
+    logwt      : their log posterior weights (unnormalized)
+    logz       : log-evidence
+    logz_err   : its uncertainty, sqrt(H/nlive)
+    information: H, the information (nats)
+    ncall      : number of likelihood evaluations
+    '''
+    def __init__(self, samples, logl, logwt, logz, logz_err, information,
+                 ncall):
+        self.samples = samples
+        self.logl = logl
+        self.logwt = logwt
+        self.logz = logz
+        self.logz_err = logz_err
+        self.information = information
+        self.ncall = ncall
+
+
+    def weights(self):
+        '''
+        Normalized posterior weights of the samples.
+        '''
+        w = np.exp(self.logwt - np.max(self.logwt))
+        return w/np.sum(w)
+
+
+    def posterior(self, n=None, seed=None):
+        '''
+        Returns equally weighted posterior samples (systematic resampling)
+        and their log-likelihoods.
+        '''
+        w = self.weights()
+        n = n or len(w)
+        rng = np.random.default_rng(seed)
+        positions = (rng.random() + np.arange(n))/n
+        indices = np.minimum(np.searchsorted(np.cumsum(w), positions),
+                             len(w) - 1)
+        return self.samples[indices], self.logl[indices]
+
+
+def save_samples(filename, samples, log_prob, name='mcmc'):
+    '''
+    Stores samples in an emcee HDF5 backend (one step, one walker per sample),
+    so backend.get_chain(flat=True) and backend.get_log_prob(flat=True) read
+    them back like an MCMC chain.
+    '''
+    import emcee
+
+    samples = np.atleast_2d(samples)
+    backend = emcee.backends.HDFBackend(filename, name=name)
+    backend.reset(*samples.shape)
+    backend.grow(1, None)
+    # save_step stores the random state too, so State needs one.
+    state = emcee.State(samples, log_prob=np.asarray(log_prob),
+                        random_state=np.random.get_state())
+    backend.save_step(state, np.ones(len(samples), dtype=bool))
+    return backend
+
+
+class NestedSampler:
+    '''
+    Takes:
+        * log_likelihood   : picklable function of theta (e.g. model.lnL);
+                             it should return -np.inf where AZURE2 fails
+        * priors           : list of frozen scipy.stats distributions, or a
+                             function mapping the unit cube to theta
+        * ndim             : number of parameters (default: len(priors))
+        * nlive            : number of live points
+        * batch_size       : live points replaced per iteration (default: the
+                             pool's number of processes)
+        * pool             : object with a map method (e.g. an Executor;
+                             default: serial)
+        * walks            : random-walk steps per replacement
+        * checkpoint       : filename of the checkpoint (optional); if it
+                             exists, the sampler resumes from it
+        * checkpoint_every : iterations between checkpoints
+    '''
+    def __init__(self, log_likelihood, priors, ndim=None, nlive=500,
+                 batch_size=None, pool=None, walks=25, seed=None,
+                 checkpoint=None, checkpoint_every=10):
+        self.log_likelihood = log_likelihood
+        if callable(priors):
+            self.prior_transform = priors
+        else:
+            self.prior_transform = PriorTransform(priors)
+            ndim = ndim or len(priors)
+        assert ndim is not None, 'ndim is required with a prior transform.'
+        self.ndim = ndim
+        self.nlive = nlive
+        self.pool = pool
+        if batch_size is None:
+            batch_size = getattr(pool, 'processes', None) or 1
+        assert batch_size < nlive, 'batch_size must be smaller than nlive.'
+        self.batch_size = batch_size
+        self.walks = walks
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.rng = np.random.default_rng(seed)
+
+        self.u = None
+        self.theta = None
+        self.logl = None
+        self.dead_theta = []
+        self.dead_logl = []
+        self.dead_logwt = []
+        self.logvol = 0.0
+        self.logz = -np.inf
+        self.information = 0.0
+        self.scale = 0.5
+        self.iteration = 0
+        self.ncall = 0
+
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load(checkpoint)
+
+
+    def map(self, fn, iterable):
+        if self.pool is None:
+            return list(map(fn, iterable))
+        return self.pool.map(fn, iterable)
+
+
+    def evaluate(self, u):
+        '''
+        Returns the parameters and log-likelihoods at the unit-cube points u
+        (one pool.map).
+        '''
+        theta = np.array([self.prior_transform(ui) for ui in u])
+        logl = np.array(self.map(self.log_likelihood, list(theta)),
+                        dtype=np.float64)
+        self.ncall += len(u)
+        return theta, logl
+
+
+    def initialize(self):
+        self.u = self.rng.random((self.nlive, self.ndim))
+        self.theta, self.logl = self.evaluate(self.u)
+
+
+    def accumulate(self, logl, logdx):
+        '''
+        Adds a point with log-likelihood logl and log prior mass logdx to the
+        evidence and information (Skilling 2006).
+        '''
+        logwt = logl + logdx
+        logz = np.logaddexp(self.logz, logwt)
+        if np.isfinite(logz):
+            h = np.exp(logwt - logz)*logl - logz
+            if np.isfinite(self.logz):
+                h += np.exp(self.logz - logz)*(self.information + self.logz)
+            self.information = h
+        self.logz = logz
+        return logwt
+
+
+    def walk(self, u, logl, logl_star):
+        '''
+        Random walks (one per row of u) in the unit cube, constrained to
+        log-likelihood > logl_star. All walkers step together, so every step
+        is one batch of evaluations.
+        '''
+        u = u.copy()
+        theta = np.array([self.prior_transform(ui) for ui in u])
+        logl = logl.copy()
+        # Step sizes follow the current spread of the live points.
+        sigma = self.scale*np.std(self.u, axis=0)
+        accepted = 0
+        for _ in range(self.walks):
+            proposal = u + sigma*self.rng.normal(size=u.shape)
+            inside = np.all((proposal > 0) & (proposal < 1), axis=1)
+            if not np.any(inside):
+                continue
+            new_theta, new_logl = self.evaluate(proposal[inside])
+            ok = new_logl > logl_star
+            rows = np.flatnonzero(inside)[ok]
+            u[rows] = proposal[rows]
+            theta[rows] = new_theta[ok]
+            logl[rows] = new_logl[ok]
+            accepted += len(rows)
+        # Aim for an acceptance fraction of about one half.
+        rate = accepted/(self.walks*len(u))
+        self.scale = float(np.clip(self.scale*np.exp(rate - 0.5), 1e-3, 2.0))
+        return u, theta, logl
+
+
+    def step(self):
+        '''
+        Replaces the batch_size worst live points.
+        '''
+        k = self.batch_size
+        worst = np.argsort(self.logl)[:k]
+        for (j, i) in enumerate(worst):
+            # Removing points one after the other shrinks the volume by
+            # 1/(number of live points left).
+            shrink = 1/(self.nlive - j)
+            logdx = self.logvol + np.log(-np.expm1(-shrink))
+            self.logvol -= shrink
+            self.dead_theta.append(self.theta[i].copy())
+            self.dead_logl.append(self.logl[i])
+            self.dead_logwt.append(self.accumulate(self.logl[i], logdx))
+
+        logl_star = self.logl[worst[-1]]
+        survivors = np.setdiff1d(np.arange(self.nlive), worst)
+        starts = self.rng.choice(survivors, size=k)
+        u, theta, logl = self.walk(self.u[starts], self.logl[starts],
+                                   logl_star)
+        self.u[worst] = u
+        self.theta[worst] = theta
+        self.logl[worst] = logl
+        self.iteration += 1
+
+
+    def remaining(self):
+        '''
+        Upper bound on the log-evidence still held by the live points.
+        '''
+        return np.max(self.logl) + self.logvol
+
+
+    def run(self, dlogz=0.1, max_iterations=None, verbose=False):
+        '''
+        Iterates until the live points could add less than dlogz to the
+        log-evidence (or max_iterations is reached). Returns a NestedResult.
+        '''
+        if self.u is None:
+            self.initialize()
+            self.save()
+
+        while True:
+            delta = np.logaddexp(self.logz, self.remaining()) - self.logz
+            if delta < dlogz:
+                break
+            if max_iterations is not None and self.iteration >= max_iterations:
+                break
+            self.step()
+            if verbose:
+                print(f'{self.iteration:6d} | logz = {self.logz:10.4f} | \
+dlogz = {delta:8.4f} | ncall = {self.ncall}')
+            if self.iteration % self.checkpoint_every == 0:
+                self.save()
+
+        self.save()
+        return self.result()
+
+
+    def result(self):
+        '''
+        Returns the result, with the live points added as if they were
+        removed in order of likelihood (the state of the sampler is not
+        changed).
+        '''
+        logz, information = self.logz, self.information
+        logwt = list(self.dead_logwt)
+        order = np.argsort(self.logl)
+        for i in order:
+            logwt.append(self.accumulate(self.logl[i],
+                                         self.logvol - np.log(self.nlive)))
+        result = NestedResult(
+            np.concatenate((np.reshape(self.dead_theta, (-1, self.ndim)),
+                            self.theta[order])),
+            np.concatenate((self.dead_logl, self.logl[order])),
+            np.array(logwt), self.logz,
+            np.sqrt(max(self.information, 0.0)/self.nlive), self.information,
+            self.ncall)
+        self.logz, self.information = logz, information
+        return result
+
+
+    STATE = ('u', 'theta', 'logl', 'dead_theta', 'dead_logl', 'dead_logwt',
+             'logvol', 'logz', 'information', 'scale', 'iteration', 'ncall',
+             'rng')
+
+
+    def save(self):
+        '''
+        Writes the checkpoint (if a checkpoint filename was given).
+        '''
+        if self.checkpoint is None:
+            return
+        state = {key: getattr(self, key) for key in self.STATE}
+        state['version'] = CHECKPOINT_VERSION
+        state['settings'] = (self.ndim, self.nlive, self.batch_size)
+        tmp = f'{self.checkpoint}.{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Write-then-rename so that an interrupted save never corrupts the
+        # previous checkpoint.
+        os.replace(tmp, self.checkpoint)
+
+
+    def load(self, filename):
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+        assert state.get('version') == CHECKPOINT_VERSION, \
+            f'{filename} is not a compatible checkpoint.'
+        assert state['settings'][:2] == (self.ndim, self.nlive), \
+            f'{filename} was written with a different ndim or nlive.'
+        for key in self.STATE:
+            setattr(self, key, state[key])
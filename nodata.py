@@ -8,6 +8,25 @@ import utility
 INCLUDE_INDEX = 0
 IN_CHANNEL_INDEX = 1
 OUT_CHANNEL_INDEX = 2
+LOW_ENERGY_INDEX = 3
+HIGH_ENERGY_INDEX = 4
+ENERGY_STEP_INDEX = 5
+LOW_ANGLE_INDEX = 6
+HIGH_ANGLE_INDEX = 7
+ANGLE_STEP_INDEX = 8
+DATA_TYPE_INDEX = 9
+
+'''
+Data types that give one output row per energy and angle: angle-integrated
+and differential cross sections.
+'''
+CROSS_SECTION_TYPES = ('0', '1')
+
+'''
+Row used for synthesized test segments when the input file has no test
+segment for the requested channel pair to copy from (angle-integrated).
+'''
+DEFAULT_ROW = '1 {in_channel} {out_channel} 0 0 0 0 0 0 0'
 
 class TestSegment:
     '''
@@ -36,6 +55,25 @@ class TestSegment:
         return ' '.join(row)
 
 
+    def at_energy(self, energy):
+        '''
+        Returns a copy of this segment that computes a single (lab) energy at
+        a single angle (its low angle), so AZURE2 writes exactly one row for
+        it. Data types other than cross sections (e.g. phase shifts) become
+        angle-integrated cross sections.
+        '''
+        segment = TestSegment(self.string())
+        segment.include = True
+        segment.row[LOW_ENERGY_INDEX] = f'{energy:.10g}'
+        segment.row[HIGH_ENERGY_INDEX] = f'{energy:.10g}'
+        segment.row[ENERGY_STEP_INDEX] = '0'
+        segment.row[HIGH_ANGLE_INDEX] = segment.row[LOW_ANGLE_INDEX]
+        segment.row[ANGLE_STEP_INDEX] = '0'
+        if segment.row[DATA_TYPE_INDEX] not in CROSS_SECTION_TYPES:
+            segment.row = segment.row[:DATA_TYPE_INDEX] + ['0']
+        return segment
+
+
 class Test:
     '''
     Structure to hold all of the test segments in a provided AZURE2 input file.
@@ -99,6 +137,57 @@ class Test:
         return list(np.unique(output_files))
 
 
+    def template(self, in_channel, out_channel):
+        '''
+        Returns a test segment for the channel pair (in_channel, out_channel)
+        from which single-energy segments can be made (see
+        TestSegment.at_energy). The first segment in the input file with that
+        channel pair is used, so its (low) angle and cross-section type carry
+        over.
+        '''
+        for seg in self.all_segments:
+            if seg.in_channel == in_channel and seg.out_channel == out_channel:
+                return seg
+        return TestSegment(DEFAULT_ROW.format(in_channel=in_channel,
+                                              out_channel=out_channel))
+
+
+    def write_synthesized(self, contents, requests):
+        '''
+        Replaces the test segments in contents with single-energy segments.
+        Takes:
+            * contents : representation of the .azr file (list of strings)
+            * requests : list of ((in_channel, out_channel), lab energies)
+        Returns:
+            * contents
+            * list of (output file, start, stop): the rows of each request in
+              its output file (AZURE2 writes the segments of an output file
+              in order, one row per synthesized segment)
+        The original test segments are kept, but excluded.
+        '''
+        start = contents.index('<segmentsTest>')+1
+        stop = contents.index('</segmentsTest>')
+
+        rows = []
+        for seg in self.all_segments:
+            excluded = TestSegment(seg.string())
+            excluded.include = False
+            rows.append(excluded.string())
+
+        layout = []
+        counts = {}
+        for ((in_channel, out_channel), energies) in requests:
+            template = self.template(in_channel, out_channel)
+            n = counts.get(template.output_filename, 0)
+            for energy in energies:
+                rows.append(template.at_energy(energy).string())
+            counts[template.output_filename] = n + len(energies)
+            layout.append((template.output_filename, n, n + len(energies)))
+
+        contents[start:stop] = rows
+        return contents, layout
+
+
     def show_test_segments(self):
         print('index | test segment')
         print('--------------------')
@@ -1,5 +1,18 @@
 import numpy as np
 
+'''
+Columns of the AZURE2 output files (AZUREOut_*.out).
+'''
+E_COM_INDEX = 0
+E_X_INDEX = 1
+ANGLE_COM_INDEX = 2
+XS_COM_FIT_INDEX = 3
+SF_COM_FIT_INDEX = 4
+XS_COM_DATA_INDEX = 5
+XS_ERR_COM_DATA_INDEX = 6
+SF_COM_DATA_INDEX = 7
+SF_ERR_COM_DATA_INDEX = 8
+
 class Output:
     '''
     Packages AZURE2 output.
@@ -23,15 +36,15 @@ class Output:
             self.contents = filename
         else:
             self.contents = np.loadtxt(filename)
-        self.e_com = self.contents[:, 0]
-        self.e_x = self.contents[:, 1]
-        self.angle_com = self.contents[:, 2]
-        self.xs_com_fit = self.contents[:, 3]
-        self.sf_com_fit = self.contents[:, 4]
-        self.xs_com_data = self.contents[:, 5]
-        self.xs_err_com_data = self.contents[:, 6]
-        self.sf_com_data = self.contents[:, 7]
-        self.sf_err_com_data = self.contents[:, 8]
+        self.e_com = self.contents[:, E_COM_INDEX]
+        self.e_x = self.contents[:, E_X_INDEX]
+        self.angle_com = self.contents[:, ANGLE_COM_INDEX]
+        self.xs_com_fit = self.contents[:, XS_COM_FIT_INDEX]
+        self.sf_com_fit = self.contents[:, SF_COM_FIT_INDEX]
+        self.xs_com_data = self.contents[:, XS_COM_DATA_INDEX]
+        self.xs_err_com_data = self.contents[:, XS_ERR_COM_DATA_INDEX]
+        self.sf_com_data = self.contents[:, SF_COM_DATA_INDEX]
+        self.sf_err_com_data = self.contents[:, SF_ERR_COM_DATA_INDEX]
 
 
 class OutputList:
@@ -55,3 +68,29 @@ class OutputList:
 
         self.ns = list(map(lambda d: d.shape[0], self.data))
         self.ntot = sum(self.ns)
+
+
+class Evaluation:
+    '''
+    Everything AZR.evaluate calculated at one point in parameter space.
+    Products that were not requested are None.
+
+    theta  : point in parameter space
+    data   : list of Output instances (or arrays), one per output file
+             (AZUREOut_*.out)
+    extrap : list of arrays, one per extrapolation file (AZUREOut_*.extrap)
+    rwas   : reduced width amplitudes (structured array, see
+             utility.RWA_DTYPE)
+    ec     : external capture integrals (see utility.read_ext_capture_file)
+    runs   : number of AZURE2 invocations it took
+    usage  : runner.Usage of those invocations
+    '''
+    def __init__(self, theta, data=None, extrap=None, rwas=None, ec=None,
+                 runs=0, usage=None):
+        self.theta = theta
+        self.data = data
+        self.extrap = extrap
+        self.rwas = rwas
+        self.ec = ec
+        self.runs = runs
+        self.usage = usage
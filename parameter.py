@@ -2,9 +2,11 @@ class Parameter:
     '''
     Defines a sampled (or "free") parameter by spin, parity, channel,
     rank, and whether it's an energy or width (kind).
-    kind    : "energy" or "width"
+    kind    : "energy", "width", or "channel_radius"
               "width" can be the partial width or ANC (depending on how it was
               set up in AZURE2)
+              "channel_radius" is the radius (fm) of the channel pair; it is
+              set in every level row of that pair
     channel : channel pair (defined in AZURE2; consistent with AZURE2,
               these are one-based)
     rank    : Which spin^{parity} level is this? (There are frequently
@@ -28,8 +30,11 @@ class Parameter:
                 self.label = r'$C_{%s}^{%s}$' % (subscript, superscript)
             else:
                 self.label = r'$\Gamma_{%s}^{%s}$' % (subscript, superscript)
+        elif self.kind == 'channel_radius':
+            self.label = r'$a_{%d}$' % (self.channel)
         else:
-            print('"kind" attribute must be either "energy" or "width"')
+            print('"kind" attribute must be "energy", "width", or \
+"channel_radius"')
 
 
     def string(self):
@@ -0,0 +1,224 @@
+'''
+Command-line batch evaluation of AZR over many points in parameter space.
+
+    python pyazr.py evaluate 12C+p.azr thetas.npy --shard 3/16 --what extrapolate
+    python pyazr.py merge thetas.extrapolate --out extrapolations.npy
+
+evaluate computes one shard (a contiguous block) of the thetas on a local
+Executor and writes it chunk by chunk to <output>.shard<i>of<N>/. Chunks are
+written atomically and skipped if they already exist, so a preempted job
+picks up where it stopped. merge assembles the shards into one array, in the
+order of the thetas (rows at which AZURE2 failed are NaN).
+
+Run it from the directory the .azr file's data paths are relative to (as with
+AZR). Thetas are read from a .npy file (n, nd) or an HDF5 file: either the
+dataset given by --dataset or, by default, the flattened chain of an emcee
+backend.
+'''
+
+import os
+import sys
+import glob
+import argparse
+
+import numpy as np
+
+from azr import AZR
+from executor import Executor
+from output import XS_COM_FIT_INDEX
+
+WHAT = ('predict', 'extrapolate', 'rwas')
+
+'''
+Default output column for each kind of evaluation (cross section).
+'''
+DEFAULT_COLUMNS = {'predict': XS_COM_FIT_INDEX, 'extrapolate': 3,
+                   'rwas': None}
+
+
+def read_thetas(filename, dataset=None, discard=0):
+    '''
+    Reads points in parameter space from a .npy or HDF5 file.
+    '''
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    import h5py
+    with h5py.File(filename, 'r') as f:
+        if dataset is not None:
+            return f[dataset][...]
+        # emcee HDFBackend: chain is (steps, walkers, nd).
+        chain = f['mcmc']['chain'][discard:]
+        return chain.reshape(-1, chain.shape[-1])
+
+
+def parse_shard(text):
+    i, n = (int(x) for x in text.split('/'))
+    assert 0 <= i < n, f'Shard must be i/N with 0 <= i < N (got {text}).'
+    return i, n
+
+
+def shard_indices(n_thetas, shard, n_shards):
+    '''
+    Returns the (contiguous) indices of the thetas in shard.
+    '''
+    bounds = np.linspace(0, n_thetas, n_shards + 1).astype(int)
+    return np.arange(bounds[shard], bounds[shard + 1])
+
+
+def shard_directory(output, shard, n_shards):
+    return f'{output}.shard{shard}of{n_shards}'
+
+
+def chunk_filename(directory, start):
+    return os.path.join(directory, f'chunk_{start:012d}.npz')
+
+
+def write_chunk(filename, **arrays):
+    # Write-then-rename, so a chunk file is either complete or absent.
+    tmp = f'{filename}.{os.getpid()}.tmp.npz'
+    np.savez(tmp, **arrays)
+    os.replace(tmp, filename)
+
+
+def evaluate_chunk(executor, azr, what, thetas, column):
+    '''
+    Returns an array (len(thetas), n) of results (NaN where AZURE2 failed).
+    '''
+    if what == 'predict':
+        return executor.predict_matrix(thetas, column=column)
+
+    results = list(executor.imap_or_none(
+        'extrapolate' if what == 'extrapolate' else 'rwas_array', thetas))
+    rows = []
+    for result in results:
+        if result is None:
+            rows.append(None)
+        elif what == 'extrapolate':
+            rows.append(np.concatenate([np.atleast_2d(r)[:, column] for r in
+                                        result]))
+        else:
+            rows.append(result['g_int'])
+    n = max((r.size for r in rows if r is not None), default=0)
+    values = np.full((len(thetas), n), np.nan)
+    for (i, row) in enumerate(rows):
+        if row is not None:
+            values[i] = row
+    return values
+
+
+def evaluate(args):
+    thetas = read_thetas(args.thetas, dataset=args.dataset,
+                         discard=args.discard)
+    shard, n_shards = args.shard
+    indices = shard_indices(len(thetas), shard, n_shards)
+    output = args.output or \
+        f'{os.path.splitext(os.path.basename(args.thetas))[0]}.{args.what}'
+    directory = shard_directory(output, shard, n_shards)
+    os.makedirs(directory, exist_ok=True)
+    column = args.column if args.column is not None else \
+        DEFAULT_COLUMNS[args.what]
+
+    azr = AZR(args.input)
+    if args.root_directory is not None:
+        azr.root_directory = args.root_directory
+    if args.timeout is not None:
+        azr.timeout = args.timeout
+
+    with Executor(azr, processes=args.processes) as executor:
+        for start in range(0, len(indices), args.chunk_size):
+            chunk = indices[start:start + args.chunk_size]
+            filename = chunk_filename(directory, chunk[0])
+            if os.path.exists(filename):
+                continue
+            values = evaluate_chunk(executor, azr, args.what,
+                                    np.asarray(thetas[chunk]), column)
+            write_chunk(filename, indices=chunk, values=values,
+                        total=len(thetas))
+            if args.verbose:
+                print(f'{chunk[-1] + 1 - indices[0]}/{len(indices)} done')
+    return 0
+
+
+def merge(args):
+    directories = sorted(glob.glob(f'{args.output}.shard*of*'))
+    assert directories, f'No shards found for {args.output}.'
+
+    chunks = []
+    for directory in directories:
+        for filename in sorted(glob.glob(os.path.join(directory,
+                                                      'chunk_*.npz'))):
+            if filename.endswith('.tmp.npz'):
+                continue
+            with np.load(filename) as f:
+                chunks.append((f['indices'], f['values'], int(f['total'])))
+
+    if not chunks:
+        print(f'No chunks found in the shards of {args.output}.')
+        return 1
+    totals = sorted({total for (_, _, total) in chunks})
+    if len(totals) > 1:
+        print(f'The chunks of {args.output} come from evaluations of \
+different numbers of thetas ({", ".join(str(t) for t in totals)}). Remove \
+the stale shards and merge again.')
+        return 1
+    total = totals[0]
+    width = max(values.shape[1] for (_, values, _) in chunks)
+    merged = np.full((total, width), np.nan)
+    done = np.zeros(total, dtype=bool)
+    for (indices, values, _) in chunks:
+        merged[indices, :values.shape[1]] = values
+        done[indices] = True
+
+    missing = np.flatnonzero(~done)
+    if missing.size > 0 and not args.allow_missing:
+        print(f'{missing.size} of {total} thetas have not been evaluated \
+(first: {missing[0]}). Use --allow-missing to merge anyway.')
+        return 1
+
+    out = args.out or f'{args.output}.npy'
+    np.save(out, merged)
+    failed = np.count_nonzero(np.all(np.isnan(merged), axis=1) & done)
+    print(f'{total} rows ({failed} failed, {missing.size} missing) -> {out}')
+    return 0
+
+
+def parser():
+    p = argparse.ArgumentParser(prog='pyazr',
+        description='Batch evaluation of AZURE2 input files.')
+    sub = p.add_subparsers(dest='command', required=True)
+
+    e = sub.add_parser('evaluate', help='evaluate one shard of thetas')
+    e.add_argument('input', help='.azr file')
+    e.add_argument('thetas', help='.npy or HDF5 file of thetas')
+    e.add_argument('--what', choices=WHAT, default='predict')
+    e.add_argument('--shard', type=parse_shard, default=(0, 1),
+                   help='i/N: evaluate the i-th of N shards (default 0/1)')
+    e.add_argument('--output', help='output prefix (default: <thetas>.<what>)')
+    e.add_argument('--column', type=int, help='output column to keep')
+    e.add_argument('--dataset', help='HDF5 dataset holding the thetas')
+    e.add_argument('--discard', type=int, default=0,
+                   help='steps of the emcee chain to discard')
+    e.add_argument('--processes', type=int, help='worker processes')
+    e.add_argument('--chunk-size', type=int, default=256)
+    e.add_argument('--root-directory', help='where workspaces are created')
+    e.add_argument('--timeout', type=float,
+                   help='wall-clock limit (s) per AZURE2 run')
+    e.add_argument('--verbose', action='store_true')
+    e.set_defaults(run=evaluate)
+
+    m = sub.add_parser('merge', help='assemble the shards of an evaluation')
+    m.add_argument('output', help='output prefix used by evaluate')
+    m.add_argument('--out', help='merged .npy file (default: <output>.npy)')
+    m.add_argument('--allow-missing', action='store_true',
+                   help='merge even if some thetas were not evaluated')
+    m.set_defaults(run=merge)
+    return p
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,344 @@
+'''
+Thermonuclear reaction rates, N_A<sigma v>(T9), from extrapolated cross
+sections or S-factors over many posterior samples.
+
+    N_A<sigma v> = 3.7318e10 / (sqrt(mu) T9^(3/2))
+                   * integral[ sigma(E) E exp(-11.605 E / T9) dE ]
+
+(cm^3 mol^-1 s^-1, with E in MeV (center of mass), sigma in b, and mu, the
+reduced mass, in amu.)
+
+The integral is a fixed linear map of the values at the extrapolation
+energies, so RateEngine folds quadrature weights, interpolation, and the
+S-factor/cross-section conversion into one matrix. The rates of a batch of
+samples at every temperature are then a single matrix product. Quantiles are
+accumulated on the fly (StreamingQuantiles), so chains with millions of
+samples never need to be held in memory.
+'''
+
+import numpy as np
+
+from executor import Executor
+
+'''
+N_A * sqrt(8/(pi amu)) / k^(3/2) in units where E is in MeV, sigma in b, and
+the rate is in cm^3 mol^-1 s^-1.
+'''
+RATE_CONSTANT = 3.7318e10
+
+'''
+E/kT = 11.605 E/T9 for E in MeV.
+'''
+INVERSE_KT = 11.605
+
+'''
+2 pi eta = 0.989534 Z1 Z2 sqrt(mu/E) for E in MeV and mu in amu.
+'''
+SOMMERFELD_CONSTANT = 0.989534
+
+'''
+Commonly tabulated temperatures (T9).
+'''
+T9_GRID = np.array([
+    0.001, 0.002, 0.003, 0.004, 0.005, 0.006, 0.007, 0.008, 0.009, 0.01,
+    0.011, 0.012, 0.013, 0.014, 0.015, 0.016, 0.018, 0.02, 0.025, 0.03, 0.04,
+    0.05, 0.06, 0.07, 0.08, 0.09, 0.1, 0.11, 0.12, 0.13, 0.14, 0.15, 0.16,
+    0.18, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.25,
+    1.5, 1.75, 2.0, 2.5, 3.0, 3.5, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0
+])
+
+'''
+Columns of the AZURE2 extrapolation files (AZUREOut_*.extrap).
+'''
+EXTRAP_E_COM_INDEX = 0
+EXTRAP_XS_INDEX = 3
+EXTRAP_SF_INDEX = 4
+
+
+def two_pi_eta(energies, reduced_mass, z1z2):
+    energies = np.asarray(energies, dtype=np.float64)
+    return SOMMERFELD_CONSTANT*z1z2*np.sqrt(reduced_mass/energies)
+
+
+def trapezoid_weights(x):
+    '''
+    Weights w such that sum(w*f(x)) is the trapezoid rule on the grid x.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    w = np.zeros_like(x)
+    if x.size > 1:
+        dx = np.diff(x)
+        w[:-1] += dx/2
+        w[1:] += dx/2
+    return w
+
+
+def interpolation_matrix(x, xq):
+    '''
+    Matrix M such that M @ f(x) is the linear interpolation of f at xq
+    (constant beyond the ends of x).
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    xq = np.asarray(xq, dtype=np.float64)
+    M = np.zeros((xq.size, x.size))
+    if x.size == 1:
+        M[:, 0] = 1
+        return M
+    j = np.clip(np.searchsorted(x, xq) - 1, 0, x.size - 2)
+    t = np.clip((xq - x[j])/(x[j+1] - x[j]), 0, 1)
+    rows = np.arange(xq.size)
+    M[rows, j] = 1 - t
+    M[rows, j+1] += t
+    return M
+
+
+class StreamingQuantiles:
+    '''
+    Approximate quantiles of many columns, accumulated batch by batch.
+
+    Values are binned in log10 (rates span many orders of magnitude). The bin
+    range of each column is set by the first batch, widened by margin
+    decades; values beyond it land in the end bins (and the exact extremes
+    are tracked separately). The resolution is roughly
+    (range + 2 margin)/bins decades.
+    '''
+    def __init__(self, ncols, bins=4000, margin=2.0, floor=1e-300):
+        self.ncols = ncols
+        self.bins = bins
+        self.margin = margin
+        self.floor = floor
+        self.counts = np.zeros((ncols, bins), dtype=np.int64)
+        self.lo = None
+        self.hi = None
+        self.n = 0
+        self.sum = np.zeros(ncols)
+        self.sum_sq = np.zeros(ncols)
+        self.min = np.full(ncols, np.inf)
+        self.max = np.full(ncols, -np.inf)
+
+
+    def update(self, values):
+        '''
+        values : array (nsamples, ncols); rows containing NaN are skipped
+        '''
+        values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+        values = values[~np.any(np.isnan(values), axis=1)]
+        if values.shape[0] == 0:
+            return
+        logs = np.log10(np.maximum(values, self.floor))
+        if self.lo is None:
+            self.lo = logs.min(axis=0) - self.margin
+            self.hi = logs.max(axis=0) + self.margin
+            self.hi = np.where(self.hi > self.lo, self.hi, self.lo + 1)
+        width = (self.hi - self.lo)/self.bins
+        k = np.clip(((logs - self.lo)/width).astype(np.int64), 0,
+                    self.bins - 1)
+        flat = (k + self.bins*np.arange(self.ncols)).ravel()
+        self.counts += np.bincount(flat, minlength=self.ncols*self.bins
+                                   ).reshape(self.ncols, self.bins)
+        self.n += values.shape[0]
+        self.sum += values.sum(axis=0)
+        self.sum_sq += (values**2).sum(axis=0)
+        self.min = np.minimum(self.min, values.min(axis=0))
+        self.max = np.maximum(self.max, values.max(axis=0))
+
+
+    def quantiles(self, q):
+        '''
+        Returns an array (len(q), ncols).
+        '''
+        q = np.atleast_1d(q)
+        assert self.n > 0, 'No values have been accumulated.'
+        cdf = np.cumsum(self.counts, axis=1)/self.n
+        width = (self.hi - self.lo)/self.bins
+        result = np.zeros((q.size, self.ncols))
+        for (i, qi) in enumerate(q):
+            for c in range(self.ncols):
+                k = min(np.searchsorted(cdf[c], qi), self.bins - 1)
+                below = cdf[c, k-1] if k > 0 else 0.0
+                inside = cdf[c, k] - below
+                t = (qi - below)/inside if inside > 0 else 0.5
+                log = self.lo[c] + (k + t)*width[c]
+                result[i, c] = 10**log
+        return np.clip(result, self.min, self.max)
+
+
+    @property
+    def mean(self):
+        return self.sum/self.n
+
+
+    @property
+    def std(self):
+        return np.sqrt(np.maximum(self.sum_sq/self.n - self.mean**2, 0))
+
+
+class RateEngine:
+    '''
+    Computes N_A<sigma v> at the temperatures for batches of samples.
+
+    energies     : extrapolation energies (MeV, center of mass); every sample
+                   must be given on these energies
+    temperatures : T9 (default: T9_GRID)
+    reduced_mass : reduced mass (amu) of the entrance pair
+    z1z2         : product of the charges of the entrance pair
+    kind         : 'xs' if samples are cross sections (b), 'sf' if they are
+                   S-factors (MeV b)
+    quadrature   : energies (MeV) at which the integrand is evaluated
+                   (default: energies). Values are interpolated to them
+                   linearly in the S-factor, which is smooth where the cross
+                   section is not.
+    bins         : resolution of the streaming quantiles
+    '''
+    def __init__(self, energies, temperatures=None, reduced_mass=1.0, z1z2=0,
+                 kind='xs', quadrature=None, bins=4000):
+        assert kind in ('xs', 'sf'), 'kind must be "xs" or "sf"'
+        self.energies = np.asarray(energies, dtype=np.float64)
+        self.temperatures = np.asarray(T9_GRID if temperatures is None else
+                                       temperatures, dtype=np.float64)
+        self.reduced_mass = reduced_mass
+        self.z1z2 = z1z2
+        self.kind = kind
+        self.quadrature = (self.energies if quadrature is None else
+                           np.asarray(quadrature, dtype=np.float64))
+        self.matrix = self.build_matrix()
+        self.bins = bins
+        self.reset()
+
+
+    def build_matrix(self):
+        '''
+        Returns W (len(energies), len(temperatures)) such that
+        values @ W are the rates.
+        '''
+        E = self.energies
+        Eq = self.quadrature
+        T9 = self.temperatures
+
+        # values at energies -> S-factor at energies
+        if self.kind == 'xs':
+            to_sf = E*np.exp(two_pi_eta(E, self.reduced_mass, self.z1z2))
+        else:
+            to_sf = np.ones_like(E)
+        # S-factor at energies -> cross section at quadrature energies
+        interpolate = interpolation_matrix(E, Eq)
+        to_xs = np.exp(-two_pi_eta(Eq, self.reduced_mass, self.z1z2))/Eq
+        values_to_xs = (to_xs[:, None]*interpolate)*to_sf[None, :]
+
+        # cross section at quadrature energies -> rates
+        boltzmann = np.exp(-INVERSE_KT*np.outer(1/T9, Eq))
+        prefactor = RATE_CONSTANT/(np.sqrt(self.reduced_mass)*T9**1.5)
+        xs_to_rates = (prefactor[:, None]*boltzmann*
+                       (trapezoid_weights(Eq)*Eq)[None, :])
+
+        return (xs_to_rates @ values_to_xs).T
+
+
+    def rates(self, values):
+        '''
+        values : array (nsamples, len(energies)) of cross sections or
+                 S-factors
+        Returns rates (nsamples, len(temperatures)).
+        '''
+        return np.atleast_2d(values) @ self.matrix
+
+
+    def reset(self):
+        self.summary = StreamingQuantiles(self.temperatures.size,
+                                          bins=self.bins)
+
+
+    def update(self, values):
+        '''
+        Adds the rates of a batch of samples to the running summary.
+        Returns the rates of the batch.
+        '''
+        rates = self.rates(values)
+        self.summary.update(rates)
+        return rates
+
+
+    def table(self, quantiles=(0.16, 0.5, 0.84)):
+        '''
+        Returns an array (len(temperatures), 1 + len(quantiles)): T9 followed
+        by the requested quantiles of the rate.
+        '''
+        return np.column_stack([self.temperatures,
+                                self.summary.quantiles(quantiles).T])
+
+
+def extrapolation_values(outputs, file_index=0, column=EXTRAP_XS_INDEX):
+    '''
+    Takes the results of AZR.extrapolate for several samples (a list of
+    lists of arrays) and returns (energies, values (nsamples, nenergies)),
+    with NaN rows wherever a sample is None (failed).
+    '''
+    arrays = [None if out is None else np.atleast_2d(out[file_index]) for out
+              in outputs]
+    template = next(a for a in arrays if a is not None)
+    energies = template[:, EXTRAP_E_COM_INDEX]
+    values = np.full((len(arrays), energies.size), np.nan)
+    for (i, a) in enumerate(arrays):
+        if a is not None:
+            values[i] = a[:, column]
+    return energies, values
+
+
+def rate_table(azr, chain, temperatures=None, extrap_file=None, kind='xs',
+               quantiles=(0.16, 0.5, 0.84), batch_size=1000, executor=None,
+               processes=None, quadrature=None, **kwargs):
+    '''
+    Takes:
+        * azr          : AZR instance (its test segments define the
+                         extrapolation energies)
+        * chain        : samples (points in parameter space)
+        * temperatures : T9 (default: T9_GRID)
+        * extrap_file  : which extrapolation file (default: the first one)
+        * kind         : integrate the cross section ('xs') or the S-factor
+                         ('sf') column
+        * batch_size   : number of samples extrapolated per batch
+        * executor     : Executor to run AZR.extrapolate on (default: a
+                         temporary one)
+        * kwargs       : passed to AZR.extrapolate
+    Returns:
+        * rate table (see RateEngine.table)
+        * the RateEngine (with the running summary, e.g. mean and std)
+    '''
+    own_executor = executor is None
+    if own_executor:
+        executor = Executor(azr, processes=processes)
+
+    engine = None
+    try:
+        for start in range(0, len(chain), batch_size):
+            batch = chain[start:start+batch_size]
+            outputs = list(executor.imap_or_none('extrapolate', batch,
+                                                 **kwargs))
+            if all(out is None for out in outputs):
+                continue
+            if engine is None:
+                indices = kwargs.get('segment_indices')
+                segments = (azr.config.test.segments if indices is None else
+                            [azr.config.test.all_segments[i] for i in indices])
+                files = list(np.unique([seg.output_filename for seg in
+                                        segments]))
+                if extrap_file is None:
+                    extrap_file = files[0]
+                file_index = files.index(extrap_file)
+                pair = azr.config.document.pairs[
+                    [seg.in_channel for seg in segments
+                     if seg.output_filename == extrap_file][0]]
+                column = EXTRAP_XS_INDEX if kind == 'xs' else EXTRAP_SF_INDEX
+                energies, _ = extrapolation_values(outputs, file_index, column)
+                engine = RateEngine(energies, temperatures=temperatures,
+                    reduced_mass=pair.reduced_mass,
+                    z1z2=pair.light_charge*pair.heavy_charge, kind=kind,
+                    quadrature=quadrature)
+            _, values = extrapolation_values(outputs, file_index, column)
+            engine.update(values)
+    finally:
+        if own_executor:
+            executor.close()
+
+    assert engine is not None, 'AZURE2 failed at every sample.'
+    return engine.table(quantiles), engine
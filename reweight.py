@@ -0,0 +1,288 @@
+'''
+Posterior reweighting from stored predictions.
+
+Changing a prior, the uncertainties of a data set, or which segments enter
+the likelihood does not change the R-matrix predictions at the samples of an
+existing chain. If the predictions were stored while sampling, the new
+posterior is reached by importance reweighting, without running AZURE2:
+
+    w_i = P_new(theta_i) / P_old(theta_i)
+
+Storing the predictions: Recorder is a log-posterior for emcee that returns
+the prediction vector (aligned with Data, see Data.concatenate) as a blob, so
+the emcee backend stores it next to the chain (see from_backend). Predictions
+can also be stored with save_predictions.
+
+The reweighted posterior is only as good as the overlap of the two
+distributions. Reweighting reports the effective sample size and the Pareto
+k-hat diagnostic of the weights (Vehtari et al., "Pareto Smoothed Importance
+Sampling") and flags the result as degenerate when a new run is needed.
+'''
+
+import numpy as np
+
+from output import XS_COM_FIT_INDEX, XS_COM_DATA_INDEX, XS_ERR_COM_DATA_INDEX
+from runner import AZURE2Error
+
+'''
+Above this k-hat, importance-sampling estimates are unreliable.
+'''
+MAX_KHAT = 0.7
+
+
+def observed(azr):
+    '''
+    Returns the data and their uncertainties as vectors aligned with the
+    predictions (in the center-of-mass frame, see Data.observed_matrix).
+    '''
+    data = azr.config.data
+    return (data.observed(XS_COM_DATA_INDEX),
+            data.observed(XS_ERR_COM_DATA_INDEX))
+
+
+class GaussianLikelihood:
+    '''
+    Gaussian log-likelihood of prediction vectors, vectorized over samples.
+
+    y, dy          : data and uncertainties (see observed)
+    data           : Data instance (needed to exclude segments or apply
+                     normalizations)
+    exclude        : indices (as in Data.all_segments) of segments to leave
+                     out
+    normalizations : maps segment indices (as in Data.all_segments) to the
+                     index in theta of a factor applied to that segment's
+                     predictions (as lnL in exam/model.py does)
+    '''
+    def __init__(self, y, dy, data=None, exclude=None, normalizations=None):
+        self.y = np.asarray(y, dtype=np.float64)
+        self.dy = np.asarray(dy, dtype=np.float64)
+        self.mask = np.ones(self.y.size, dtype=bool)
+        for index in exclude or []:
+            assert data is not None, 'data is needed to exclude segments.'
+            self.mask[data.segment_slice(index)] = False
+        self.normalizations = []
+        for (index, k) in (normalizations or {}).items():
+            assert data is not None, 'data is needed to apply normalizations.'
+            self.normalizations.append((data.segment_slice(index), k))
+
+
+    def __call__(self, thetas, predictions):
+        '''
+        thetas      : array (n_samples, nd) or (nd,)
+        predictions : array (n_samples, n_points) or (n_points,)
+        '''
+        mu = np.array(predictions, dtype=np.float64)
+        thetas = np.asarray(thetas, dtype=np.float64)
+        for (s, k) in self.normalizations:
+            mu[..., s] *= thetas[..., k, None]
+        mu = mu[..., self.mask]
+        y, dy = self.y[self.mask], self.dy[self.mask]
+        return np.sum(-np.log(np.sqrt(2*np.pi)*dy) - 0.5*((y - mu)/dy)**2,
+                      axis=-1)
+
+
+class Recorder:
+    '''
+    Log-posterior that also returns the prediction vector, for use with emcee:
+
+        sampler = emcee.EnsembleSampler(nw, nd, Recorder(azr, lnPi, y, dy),
+                                        backend=backend, pool=executor)
+
+    emcee stores the returned vectors as blobs in the backend.
+
+    azr            : AZR instance
+    log_prior      : function of theta
+    log_likelihood : function of theta and the prediction vector (default:
+                     GaussianLikelihood(y, dy))
+    column         : output column of the predictions (see output.py)
+
+    Outside the prior or where AZURE2 fails, the log-posterior is -inf and the
+    prediction is NaN.
+    '''
+    def __init__(self, azr, log_prior, y=None, dy=None, log_likelihood=None,
+                 column=XS_COM_FIT_INDEX):
+        assert log_likelihood is not None or y is not None, \
+            'Either log_likelihood or y and dy are required.'
+        self.azr = azr
+        self.log_prior = log_prior
+        self.log_likelihood = (log_likelihood if log_likelihood is not None
+                               else GaussianLikelihood(y, dy))
+        self.column = column
+
+
+    def __call__(self, theta):
+        missing = np.full(self.azr.config.data.n_points, np.nan)
+        lnpi = self.log_prior(theta)
+        if lnpi == -np.inf:
+            return -np.inf, missing
+        try:
+            output = self.azr.predict(theta, dress_up=False)
+        except AZURE2Error:
+            return -np.inf, missing
+        mu = self.azr.config.data.concatenate(output, self.azr.output_filenames,
+                                              column=self.column)
+        return float(self.log_likelihood(theta, mu)) + lnpi, mu
+
+
+def from_backend(backend, discard=0, thin=1):
+    '''
+    Returns the flattened chain, log-posterior, and predictions (blobs)
+    stored in an emcee backend by a Recorder.
+    '''
+    return (backend.get_chain(flat=True, discard=discard, thin=thin),
+            backend.get_log_prob(flat=True, discard=discard, thin=thin),
+            backend.get_blobs(flat=True, discard=discard, thin=thin))
+
+
+def save_predictions(filename, chain, log_prob, predictions):
+    '''
+    Stores samples, their log-posterior, and their predictions (.npz).
+    '''
+    np.savez(filename, chain=chain, log_prob=log_prob, predictions=predictions)
+
+
+def load_predictions(filename):
+    '''
+    Returns chain, log_prob, predictions stored by save_predictions.
+    '''
+    with np.load(filename) as f:
+        return f['chain'], f['log_prob'], f['predictions']
+
+
+def pareto_khat(log_weights):
+    '''
+    Shape parameter of a generalized Pareto distribution fitted to the
+    largest weights (Zhang & Stephens 2009, with the weak prior used by PSIS).
+    Above MAX_KHAT, the variance of the weights is effectively infinite.
+    '''
+    lw = np.sort(log_weights[np.isfinite(log_weights)])
+    n = lw.size
+    m = int(min(0.2*n, 3*np.sqrt(n)))
+    if m < 5:
+        return np.inf
+    w = np.exp(lw - lw[-1])
+    x = w[-m:] - w[-m-1]
+    if x[-1] <= 0:
+        return 0.0
+
+    n_b = 30 + int(np.sqrt(m))
+    b = 1 - np.sqrt(n_b/(np.arange(1, n_b + 1) - 0.5))
+    b = b/(3*x[int(m/4 + 0.5) - 1]) + 1/x[-1]
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        k = np.mean(np.log1p(-b[:, None]*x), axis=1)
+        log_like = m*(np.log(-b/k) - k - 1)
+        # Candidates far less likely than the best get (numerically) zero
+        # weight.
+        weights = 1/np.sum(np.exp(log_like - log_like[:, None]), axis=1)
+    weights = np.nan_to_num(weights)
+    weights /= np.sum(weights)
+    b_post = np.sum(b*weights)
+    k_post = np.mean(np.log1p(-b_post*x))
+    return (m*k_post + 10*0.5)/(m + 10)
+
+
+class Reweighting:
+    '''
+    Result of reweight().
+
+    log_weights : log importance weights (unnormalized)
+    weights     : normalized weights
+    ess         : effective sample size, 1/sum(weights^2)
+    khat        : Pareto k-hat of the weights
+    degenerate  : Is the reweighted posterior unreliable (rerun instead)?
+    '''
+    def __init__(self, chain, log_weights, min_ess, max_khat):
+        self.chain = chain
+        self.log_weights = log_weights
+        finite = np.isfinite(log_weights)
+        self.weights = np.zeros(log_weights.size)
+        if np.any(finite):
+            w = np.exp(log_weights[finite] - np.max(log_weights[finite]))
+            self.weights[finite] = w/np.sum(w)
+        self.ess = 1/np.sum(self.weights**2) if np.any(finite) else 0.0
+        self.khat = pareto_khat(log_weights)
+        self.degenerate = bool(self.ess < min_ess or self.khat > max_khat)
+
+
+    def mean(self, values=None):
+        '''
+        Weighted mean of values (default: the chain).
+        '''
+        values = self.chain if values is None else values
+        return np.average(values, axis=0, weights=self.weights)
+
+
+    def quantiles(self, q, values=None):
+        '''
+        Weighted quantiles (q in [0, 1]) of values (default: the chain), per
+        column.
+        '''
+        values = self.chain if values is None else np.asarray(values)
+        values = values.reshape(len(self.weights), -1)
+        q = np.atleast_1d(q)
+        result = np.empty((q.size, values.shape[1]))
+        for j in range(values.shape[1]):
+            order = np.argsort(values[:, j])
+            cdf = np.cumsum(self.weights[order])
+            result[:, j] = np.interp(q, cdf - self.weights[order]/2,
+                                     values[order, j])
+        return result
+
+
+    def resample(self, n=None, seed=None):
+        '''
+        Returns the indices of n samples drawn according to the weights
+        (systematic resampling).
+        '''
+        n = n or int(self.ess)
+        rng = np.random.default_rng(seed)
+        positions = (rng.random() + np.arange(n))/n
+        return np.minimum(np.searchsorted(np.cumsum(self.weights), positions),
+                          len(self.weights) - 1)
+
+
+def log_prior_vector(log_prior, chain):
+    '''
+    Evaluates log_prior at every sample. log_prior is a function of theta or a
+    list of (frozen scipy.stats) distributions, one per parameter.
+    '''
+    if callable(log_prior):
+        return np.array([log_prior(theta) for theta in chain])
+    return np.sum([pi.logpdf(chain[:, i]) for (i, pi) in enumerate(log_prior)],
+                  axis=0)
+
+
+def reweight(chain, log_prob, predictions, log_prior, log_likelihood,
+             min_ess=None, max_khat=MAX_KHAT):
+    '''
+    Takes:
+        * chain          : samples, array (n, nd)
+        * log_prob       : the log-posterior they were sampled from
+        * predictions    : prediction vectors at the samples (n, n_points)
+        * log_prior      : new prior (function of theta, or a list of
+                           scipy.stats distributions)
+        * log_likelihood : new likelihood, a function of the samples and
+                           their predictions, vectorized over both (e.g.
+                           GaussianLikelihood with new uncertainties or
+                           excluded segments); theta carries the
+                           normalization factors
+        * min_ess        : smallest acceptable effective sample size (default:
+                           1% of the samples, at least 100)
+        * max_khat       : largest acceptable Pareto k-hat
+    Returns:
+        * Reweighting
+    '''
+    chain = np.asarray(chain, dtype=np.float64)
+    log_prob = np.asarray(log_prob, dtype=np.float64)
+    predictions = np.asarray(predictions, dtype=np.float64)
+    if min_ess is None:
+        min_ess = max(100, 0.01*len(chain))
+
+    # Samples the old posterior could not have produced carry no information.
+    valid = np.isfinite(log_prob) & np.all(np.isfinite(predictions), axis=1)
+    new = np.full(len(chain), -np.inf)
+    new[valid] = (log_prior_vector(log_prior, chain[valid]) +
+                  log_likelihood(chain[valid], predictions[valid]))
+    log_weights = np.where(valid, new - np.where(valid, log_prob, 0), -np.inf)
+    log_weights[np.isnan(log_weights)] = -np.inf
+    return Reweighting(chain, log_weights, min_ess, max_khat)
@@ -0,0 +1,495 @@
+'''
+Runs AZURE2 as a child process.
+
+A sampler can make hundreds of thousands of AZURE2 calls, so a single hung or
+crashing run must not take a worker down with it. Runner enforces a wall-clock
+limit (the whole process group is killed when it expires), an optional memory
+limit (set by the shell's ulimit just before AZURE2 is exec'd, so no Python
+runs in the forked child and Runner is safe to use from threads), and a
+configurable number of retries. stdout/stderr are spooled to temporary files
+and only a bounded tail is kept in memory unless the run fails.
+
+The child is reaped with os.wait4, so every run reports the resources AZURE2
+used (Usage: CPU time, peak memory, block I/O, and wall time). On Linux the
+peak memory is sampled from /proc while AZURE2 runs, since ru_maxrss also
+counts the launching process.
+'''
+
+import os
+import sys
+import signal
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from subprocess import Popen, PIPE, TimeoutExpired
+
+import numpy as np
+
+'''
+Environment variables added to every AZURE2 child launched from this process
+(e.g. OMP_NUM_THREADS in a pool worker). os.environ is never modified.
+'''
+DEFAULT_ENV = {}
+
+'''
+ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+'''
+MAXRSS_BYTES = 1 if sys.platform == 'darwin' else 1024
+
+'''
+Can the peak memory of a running child be read from /proc (Linux)?
+'''
+PROC_STATUS = os.path.exists('/proc/self/status')
+
+'''
+Usage instances that every run in this thread is added to (see collect()).
+'''
+_local = threading.local()
+
+'''
+Guards Usage.add and FailureMemo, which threads of one process share (e.g.
+through ThreadExecutor). Module-level, so the objects stay picklable.
+'''
+_lock = threading.Lock()
+
+
+def _collectors():
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    return _local.collectors
+
+
+class Usage:
+    '''
+    Resources used by one or more AZURE2 runs (summed, except max_rss).
+
+    calls        : number of AZURE2 processes launched
+    failures     : how many of them failed or timed out
+    user_time    : user CPU time (s)
+    system_time  : system CPU time (s)
+    wall_time    : wall-clock time (s)
+    max_rss      : largest peak resident set size of any run (bytes). On
+                   Linux, VmHWM of AZURE2 itself, sampled while it runs (see
+                   _wait; growth after the last sample is missed). Elsewhere
+                   ru_maxrss, which can include the footprint of the Python
+                   process that launched it.
+    block_input  : file system blocks read
+    block_output : file system blocks written
+    '''
+    SUMMED = ('calls', 'failures', 'user_time', 'system_time', 'wall_time',
+              'block_input', 'block_output')
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.user_time = 0.0
+        self.system_time = 0.0
+        self.wall_time = 0.0
+        self.max_rss = 0
+        self.block_input = 0
+        self.block_output = 0
+
+
+    @classmethod
+    def from_rusage(cls, rusage, wall_time, failed=False, peak_rss=None):
+        '''
+        Usage of one run. peak_rss (bytes) replaces ru_maxrss if given.
+        '''
+        usage = cls()
+        usage.calls = 1
+        usage.failures = int(failed)
+        usage.user_time = rusage.ru_utime
+        usage.system_time = rusage.ru_stime
+        usage.wall_time = wall_time
+        usage.max_rss = (rusage.ru_maxrss*MAXRSS_BYTES if peak_rss is None
+                         else peak_rss)
+        usage.block_input = rusage.ru_inblock
+        usage.block_output = rusage.ru_oublock
+        return usage
+
+
+    def add(self, other):
+        with _lock:
+            for name in self.SUMMED:
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+            self.max_rss = max(self.max_rss, other.max_rss)
+        return self
+
+
+    @property
+    def cpu_time(self):
+        return self.user_time + self.system_time
+
+
+    @property
+    def threads(self):
+        '''
+        CPU time per wall-clock second: about the number of cores AZURE2 kept
+        busy. Much less than OMP_NUM_THREADS suggests oversubscription.
+        '''
+        return self.cpu_time/self.wall_time if self.wall_time > 0 else 0.0
+
+
+    def as_dict(self):
+        d = {name: getattr(self, name) for name in self.SUMMED}
+        d['max_rss'] = self.max_rss
+        return d
+
+
+    def __repr__(self):
+        return f'Usage(calls={self.calls}, failures={self.failures}, \
+cpu={self.cpu_time:.3f} s, wall={self.wall_time:.3f} s, \
+max_rss={self.max_rss/2**20:.1f} MiB, blocks in/out={self.block_input}/\
+{self.block_output})'
+
+
+@contextmanager
+def collect():
+    '''
+    Yields a Usage that every AZURE2 run launched from this thread (in any
+    Runner) is added to until the block exits. Runs in other threads are not
+    counted, so concurrent tasks of a ThreadExecutor are measured separately.
+    '''
+    usage = Usage()
+    collectors = _collectors()
+    collectors.append(usage)
+    try:
+        yield usage
+    finally:
+        collectors.remove(usage)
+
+
+def report(usage):
+    '''
+    Adds usage to every collector open in this thread (see collect()). For
+    runs made on behalf of this thread in another one (e.g. by MultiAZR).
+    '''
+    for collector in _collectors():
+        collector.add(usage)
+
+
+class AZURE2Error(RuntimeError):
+    '''
+    Raised when AZURE2 does not execute properly (non-zero exit status,
+    killed by a signal, or timed out) on every attempt.
+
+    result    : RunResult of the last attempt (None if memoized)
+    memoized  : True if the failure was looked up rather than observed
+    '''
+    def __init__(self, message, result=None, memoized=False):
+        super().__init__(message)
+        self.result = result
+        self.memoized = memoized
+
+    @property
+    def timed_out(self):
+        return self.result is not None and self.result.timed_out
+
+
+class RunResult:
+    '''
+    Outcome of a single AZURE2 invocation.
+
+    returncode : exit status (negative if killed by a signal)
+    stdout     : decoded stdout (only the tail if the run succeeded)
+    stderr     : decoded stderr (only the tail if the run succeeded)
+    timed_out  : Was the process killed for exceeding the wall-clock limit?
+    attempts   : How many times was AZURE2 launched?
+    wall_time  : wall-clock time (s) of the last attempt
+    usage      : Usage of all attempts
+    '''
+    def __init__(self, returncode, stdout, stderr, timed_out=False,
+                 attempts=1, wall_time=0.0, usage=None):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.attempts = attempts
+        self.wall_time = wall_time
+        self.usage = Usage() if usage is None else usage
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __iter__(self):
+        # Unpacks like the (stdout, stderr) tuple run_AZURE2 used to return.
+        return iter((self.stdout, self.stderr))
+
+    def __repr__(self):
+        return f'RunResult(returncode={self.returncode}, \
+timed_out={self.timed_out}, attempts={self.attempts}, \
+wall_time={self.wall_time:.3f})'
+
+
+def command_line(input_filename, command='AZURE2', use_brune=False,
+                 use_gsl=False):
+    '''
+    Returns the list of command-line arguments used to run AZURE2.
+    '''
+    cl_args = [command, input_filename, '--no-gui', '--no-readline']
+    if use_brune:
+        cl_args += ['--use-brune']
+    if use_gsl:
+        cl_args += ['--gsl-coul']
+    return cl_args
+
+
+def stdin_options(choice=1, ext_par_file='\n', ext_capture_file='\n'):
+    '''
+    Returns the (encoded) responses AZURE2 expects on stdin.
+    '''
+    options = str(choice) + '\n' + ext_par_file + ext_capture_file
+    return options.encode('utf-8')
+
+
+def read_tail(f, nbytes=None):
+    '''
+    Reads (at most) the last nbytes of the binary file object, f.
+    If nbytes is None, the whole file is read.
+    '''
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if nbytes is None or size <= nbytes:
+        f.seek(0)
+    else:
+        f.seek(size - nbytes)
+    return f.read().decode('utf-8', errors='replace')
+
+
+def limit_memory(cl_args, memory_limit):
+    '''
+    Returns cl_args wrapped in a shell that caps the address space of the
+    command at memory_limit bytes (ulimit -v, in KiB) and then execs it, so
+    the command keeps the shell's PID.
+    '''
+    kib = max(1, int(memory_limit) // 1024)
+    return ['/bin/sh', '-c', f'ulimit -v {kib} && exec "$@"', 'sh'] + \
+        list(cl_args)
+
+
+def _reap(p, block=True):
+    '''
+    Waits for p with os.wait4 (Popen.wait discards the resource usage).
+    Returns the rusage, or None if p is still running and block is False.
+    '''
+    pid, status, rusage = os.wait4(p.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    # Tell Popen the child is gone so it doesn't wait for it again.
+    p.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+def peak_rss(pid):
+    '''
+    Returns the peak resident set size (bytes) of the running process pid
+    since its last exec (VmHWM in /proc/<pid>/status), or None if it cannot
+    be read (e.g. the process has exited).
+    '''
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _wait(p, timeout=None):
+    '''
+    Like p.wait(timeout), but returns the child's rusage. Where /proc is
+    available, the child's peak memory is sampled while it runs and kept in
+    p.peak_rss. ru_maxrss cannot be used for it on Linux: it includes the
+    memory the forked Python process had before exec.
+    '''
+    if timeout is None and not PROC_STATUS:
+        return _reap(p)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        if PROC_STATUS:
+            sample = peak_rss(p.pid)
+            if sample is not None:
+                p.peak_rss = max(getattr(p, 'peak_rss', 0), sample)
+        rusage = _reap(p, block=False)
+        if rusage is not None:
+            return rusage
+        if deadline is None:
+            delay = min(2*delay, 0.05)
+        else:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutExpired(p.args, timeout)
+            delay = min(2*delay, remaining, 0.05)
+        time.sleep(delay)
+
+
+def _kill(p):
+    '''
+    Kills the process group started for p (AZURE2 and anything it spawned)
+    and reaps it. Returns the child's rusage.
+    '''
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    return _reap(p)
+
+
+class Runner:
+    '''
+    Launches AZURE2 with resource limits.
+
+    command      : Name of AZURE2 binary.
+    timeout      : wall-clock limit (s) per attempt (None = no limit)
+    memory_limit : address-space limit (bytes) of the child (None = no limit)
+    retries      : number of additional attempts after a failure
+    tail_bytes   : number of bytes of stdout/stderr kept after a successful run
+    env          : environment variables added to the child's environment
+    '''
+    def __init__(self, command='AZURE2', timeout=None, memory_limit=None,
+                 retries=0, tail_bytes=4096, env=None):
+        self.command = command
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.retries = retries
+        self.tail_bytes = tail_bytes
+        self.env = {} if env is None else dict(env)
+
+
+    def child_env(self, env=None):
+        '''
+        Builds the child's environment without touching os.environ.
+        '''
+        if not DEFAULT_ENV and not self.env and not env:
+            return None
+        child = os.environ.copy()
+        child.update({k: str(v) for (k, v) in DEFAULT_ENV.items()})
+        child.update({k: str(v) for (k, v) in self.env.items()})
+        if env:
+            child.update({k: str(v) for (k, v) in env.items()})
+        return child
+
+
+    def run_once(self, cl_args, options, env=None):
+        '''
+        Single attempt. Returns a RunResult; never raises on AZURE2 failure.
+        '''
+        if self.memory_limit:
+            cl_args = limit_memory(cl_args, self.memory_limit)
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+            start = time.monotonic()
+            p = Popen(cl_args, stdin=PIPE, stdout=out, stderr=err,
+                      env=self.child_env(env), start_new_session=True)
+            p.peak_rss = 0 if PROC_STATUS else None
+            timed_out = False
+            try:
+                p.stdin.write(options)
+                p.stdin.close()
+            except BrokenPipeError:
+                # AZURE2 died before reading its options. The exit status
+                # tells the story.
+                pass
+            try:
+                rusage = _wait(p, timeout=self.timeout)
+            except TimeoutExpired:
+                timed_out = True
+                rusage = _kill(p)
+            except BaseException:
+                # Don't leave an orphan behind (e.g. KeyboardInterrupt).
+                _kill(p)
+                raise
+            wall_time = time.monotonic() - start
+
+            ok = p.returncode == 0 and not timed_out
+            usage = Usage.from_rusage(rusage, wall_time, failed=not ok,
+                                      peak_rss=p.peak_rss)
+            report(usage)
+            nbytes = self.tail_bytes if ok else None
+            return RunResult(p.returncode, read_tail(out, nbytes),
+                             read_tail(err, nbytes), timed_out=timed_out,
+                             wall_time=wall_time, usage=usage)
+
+
+    def run(self, input_filename, choice=1, use_brune=False, ext_par_file='\n',
+            ext_capture_file='\n', use_gsl=False, env=None):
+        '''
+        Runs AZURE2 with input_filename, retrying on failure.
+        Returns a RunResult.
+        Raises AZURE2Error if every attempt fails.
+        '''
+        cl_args = command_line(input_filename, command=self.command,
+                               use_brune=use_brune, use_gsl=use_gsl)
+        options = stdin_options(choice, ext_par_file, ext_capture_file)
+
+        usage = Usage()
+        for attempt in range(1, self.retries+2):
+            result = self.run_once(cl_args, options, env=env)
+            result.attempts = attempt
+            result.usage = usage.add(result.usage)
+            if result.ok:
+                return result
+
+        if result.timed_out:
+            message = f'AZURE2 timed out after {self.timeout} s \
+({result.attempts} attempt(s)).'
+        else:
+            message = f'AZURE2 exited with status {result.returncode} \
+({result.attempts} attempt(s)).'
+        raise AZURE2Error(message, result=result)
+
+
+class FailureMemo:
+    '''
+    Remembers the points in parameter space at which AZURE2 failed
+    deterministically, so that asking again fails immediately instead of
+    paying for the crash twice.
+
+    maxsize : maximum number of points remembered (oldest are forgotten first)
+    '''
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.failures = OrderedDict()
+
+
+    @staticmethod
+    def key(theta, tag=''):
+        return (tag, np.asarray(theta, dtype=np.float64).tobytes())
+
+
+    def __len__(self):
+        return len(self.failures)
+
+
+    def __contains__(self, item):
+        theta, tag = item
+        with _lock:
+            return self.key(theta, tag) in self.failures
+
+
+    def add(self, theta, tag='', message=''):
+        key = self.key(theta, tag)
+        with _lock:
+            self.failures[key] = message
+            self.failures.move_to_end(key)
+            while len(self.failures) > self.maxsize:
+                self.failures.popitem(last=False)
+
+
+    def check(self, theta, tag=''):
+        '''
+        Raises AZURE2Error (memoized=True) if theta is known to fail.
+        '''
+        with _lock:
+            message = self.failures.get(self.key(theta, tag))
+        if message is not None:
+            raise AZURE2Error('Known failure: ' + message, memoized=True)
+
+
+    def clear(self):
+        with _lock:
+            self.failures.clear()
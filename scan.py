@@ -0,0 +1,285 @@
+'''
+Profile likelihoods and grid scans over one or two parameters.
+
+The scanned parameters are given as Parameter instances, so any level energy
+or width (or ANC) can be scanned, and so can a channel radius
+(kind='channel_radius'), which is usually not sampled. At every grid point
+the scanned parameters are fixed and chi^2 is minimized over all the others
+(the sampled parameters of the AZR instance, including normalization
+factors).
+
+Grid points are fitted in parallel waves on an Executor, one grid point per
+task. The first wave starts from the reference theta at points spread over
+the grid; every later wave takes the points next to those already done, each
+starting from the best fit of its best finished neighbor (warm starts).
+'''
+
+import numpy as np
+from scipy import optimize
+
+import executor
+from azr import AZR
+from executor import Executor
+from multi import parameter_key
+from output import XS_COM_FIT_INDEX, XS_COM_DATA_INDEX, XS_ERR_COM_DATA_INDEX
+from runner import AZURE2Error
+
+
+def chi_squared(azr, theta):
+    '''
+    Returns chi^2 of the prediction at theta (the data and uncertainties are
+    read from AZURE2's output, so normalization factors are accounted for).
+    AZURE2 failures give np.inf.
+    '''
+    try:
+        output = azr.predict(theta, dress_up=False)
+    except AZURE2Error:
+        return np.inf
+    data = azr.config.data
+    filenames = azr.output_filenames
+    mu = data.concatenate(output, filenames, column=XS_COM_FIT_INDEX)
+    y = data.concatenate(output, filenames, column=XS_COM_DATA_INDEX)
+    dy = data.concatenate(output, filenames, column=XS_ERR_COM_DATA_INDEX)
+    return float(np.sum(((y - mu)/dy)**2))
+
+
+def extended_azr(azr, scan):
+    '''
+    Returns an AZR instance whose sampled parameters are those of azr plus the
+    scanned parameters that azr does not sample, and the indices (in its
+    theta) of the scanned parameters.
+    '''
+    keys = [parameter_key(p) for p in azr.parameters]
+    parameters = list(azr.parameters)
+    for p in scan:
+        if parameter_key(p) not in keys:
+            keys.append(parameter_key(p))
+            parameters.append(p)
+    extended = AZR(azr.config.input_filename, parameters=parameters,
+                   output_filenames=azr.output_filenames,
+                   extrap_filenames=azr.extrap_filenames)
+    for attribute in ('use_brune', 'use_gsl', 'ext_capture_file', 'command',
+                      'root_directory', 'timeout', 'memory_limit', 'retries'):
+        setattr(extended, attribute, getattr(azr, attribute))
+    indices = [keys.index(parameter_key(p)) for p in scan]
+    return extended, indices
+
+
+def _fit(args):
+    '''
+    Minimizes the objective over the free parameters with the scanned ones
+    fixed (runs in an Executor worker, on the worker's AZR instance).
+    '''
+    fixed_indices, fixed_values, start, objective, method, options = args
+    azr = executor._azr
+    theta = np.array(start, dtype=np.float64)
+    theta[fixed_indices] = fixed_values
+    free = np.setdiff1d(np.arange(theta.size), fixed_indices)
+    # Minimize in units of the starting values, so that widths (eV) and
+    # energies (MeV) are on the same footing.
+    scale = np.where(theta[free] != 0, np.abs(theta[free]), 1.0)
+
+    def f(x):
+        trial = theta.copy()
+        trial[free] = x*scale
+        return objective(azr, trial)
+
+    if free.size == 0:
+        return theta, f(np.zeros(0)), 1, True
+    result = optimize.minimize(f, theta[free]/scale, method=method,
+                               options=options)
+    best = theta.copy()
+    best[free] = result.x*scale
+    return best, float(result.fun), int(result.nfev), bool(result.success)
+
+
+class ProfileResult:
+    '''
+    Output of Profile.run.
+
+    grid        : list of the grid values of each scanned parameter
+    values      : minimized objective at each grid point (array with one axis
+                  per scanned parameter)
+    thetas      : best-fit theta at each grid point (values.shape + (nd,))
+    evaluations : objective evaluations at each grid point
+    success     : Did the minimizer converge at each grid point?
+    labels      : labels of the components of theta
+    '''
+    def __init__(self, grid, values, thetas, evaluations, success, labels):
+        self.grid = grid
+        self.values = values
+        self.thetas = thetas
+        self.evaluations = evaluations
+        self.success = success
+        self.labels = labels
+
+
+    def minimum(self):
+        '''
+        Returns the grid values and theta of the best grid point.
+        '''
+        i = np.unravel_index(np.nanargmin(self.values), self.values.shape)
+        return tuple(g[k] for (g, k) in zip(self.grid, i)), self.thetas[i]
+
+
+    def delta(self):
+        '''
+        Profile relative to its minimum (Delta chi^2).
+        '''
+        return self.values - np.nanmin(self.values)
+
+
+    def interval(self, level=1.0):
+        '''
+        For a one-parameter profile, returns the (linearly interpolated)
+        bounds where Delta chi^2 crosses level (1 for 68% confidence). A bound
+        that lies outside the grid is None.
+        '''
+        assert len(self.grid) == 1, 'interval is for one-parameter profiles.'
+        x, d = self.grid[0], self.delta()
+        best = int(np.nanargmin(d))
+        bounds = []
+        for step in (-1, 1):
+            bound = None
+            i = best
+            while 0 <= i + step < len(x):
+                if d[i + step] >= level:
+                    bound = np.interp(level, [d[i], d[i + step]],
+                                      [x[i], x[i + step]])
+                    break
+                i += step
+            bounds.append(bound)
+        return tuple(bounds)
+
+
+class Profile:
+    '''
+    Takes:
+        * azr       : AZR instance
+        * scan      : one or two Parameter instances (the scanned parameters)
+        * grid      : list with the grid values of each scanned parameter
+        * theta     : reference point, as in azr's theta (default: the values
+                      in the input file)
+        * objective : picklable function of (azr, theta) to minimize
+                      (default: chi_squared)
+        * method    : scipy.optimize.minimize method
+        * options   : options of the method
+        * seeds     : number of grid points in the first wave (default: the
+                      number of processes)
+        * executor  : Executor to use; it must have been created with
+                      self.azr (default: a temporary one per run)
+        * processes : number of processes of the temporary Executor
+
+    self.azr is the AZR instance the fits use: azr extended by the scanned
+    parameters it does not sample (see extended_azr).
+    '''
+    def __init__(self, azr, scan, grid, theta=None, objective=chi_squared,
+                 method='Powell', options=None, seeds=None, executor=None,
+                 processes=None):
+        assert len(scan) in (1, 2), 'Scan one or two parameters.'
+        assert len(grid) == len(scan), 'Give one grid per scanned parameter.'
+        self.azr, self.indices = extended_azr(azr, scan)
+        self.grid = [np.asarray(g, dtype=np.float64) for g in grid]
+        self.shape = tuple(g.size for g in self.grid)
+
+        # The reference theta of the extended AZR: azr's theta, with the
+        # added parameters (taken from the input file) before the
+        # normalization factors.
+        values = np.asarray(self.azr.config.get_input_values(),
+                            dtype=np.float64)
+        if theta is not None:
+            n1 = len(azr.parameters)
+            theta = np.asarray(theta, dtype=np.float64)
+            values[:n1] = theta[:n1]
+            values[self.azr.config.n1:] = theta[n1:]
+        self.theta = values
+
+        self.objective = objective
+        self.method = method
+        self.options = options
+        self.seeds = seeds
+        self.executor = executor
+        self.processes = processes
+
+
+    def point(self, index):
+        return np.array([g[k] for (g, k) in zip(self.grid, index)])
+
+
+    def neighbors(self, index):
+        '''
+        Grid points adjacent to index (including diagonals).
+        '''
+        result = []
+        for offset in np.ndindex(*(3,)*len(self.shape)):
+            other = tuple(k + o - 1 for (k, o) in zip(index, offset))
+            if other != index and all(0 <= k < n for (k, n) in
+                                      zip(other, self.shape)):
+                result.append(other)
+        return result
+
+
+    def task(self, index, start):
+        return (self.indices, self.point(index), start, self.objective,
+                self.method, self.options)
+
+
+    def run(self, verbose=False):
+        '''
+        Fits every grid point. Returns a ProfileResult.
+        '''
+        pool = self.executor
+        if pool is None:
+            pool = Executor(self.azr, processes=self.processes)
+        try:
+            return self.scan(pool, verbose)
+        finally:
+            if self.executor is None:
+                pool.close()
+
+
+    def scan(self, pool, verbose=False):
+        nd = self.theta.size
+        values = np.full(self.shape, np.nan)
+        thetas = np.full(self.shape + (nd,), np.nan)
+        evaluations = np.zeros(self.shape, dtype=int)
+        success = np.zeros(self.shape, dtype=bool)
+        done = np.zeros(self.shape, dtype=bool)
+
+        n = int(np.prod(self.shape))
+        seeds = min(self.seeds or pool.processes, n)
+        flat = np.unique(np.linspace(0, n - 1, seeds).round().astype(int))
+        wave = [(np.unravel_index(i, self.shape), self.theta) for i in flat]
+
+        while wave:
+            results = pool.map(_fit, [self.task(tuple(int(k) for k in index),
+                                                start)
+                                      for (index, start) in wave])
+            for ((index, _), (theta, value, nfev, ok)) in zip(wave, results):
+                index = tuple(int(k) for k in index)
+                thetas[index] = theta
+                values[index] = value
+                evaluations[index] = nfev
+                success[index] = ok
+                done[index] = True
+            if verbose:
+                print(f'{np.count_nonzero(done)}/{n} grid points done')
+
+            # Next wave: the points next to finished ones, warm-started from
+            # their best finished neighbor.
+            wave = []
+            for index in zip(*np.nonzero(~done)):
+                index = tuple(int(k) for k in index)
+                finished = [other for other in self.neighbors(index)
+                            if done[other] and np.isfinite(values[other])]
+                if finished:
+                    best = min(finished, key=lambda other: values[other])
+                    wave.append((index, thetas[best]))
+            if not wave and not np.all(done):
+                # Only points next to failed fits are left: start them over
+                # from the reference point.
+                wave = [(tuple(int(k) for k in index), self.theta)
+                        for index in zip(*np.nonzero(~done))]
+
+        return ProfileResult(self.grid, values, thetas, evaluations, success,
+                             self.azr.config.labels)
@@ -0,0 +1,162 @@
+'''
+Load balancing of batched evaluations (see Executor).
+
+AZURE2 run times vary a lot: extrapolations over long test grids cost more
+than predictions, and points near narrow resonances cost more than others.
+Equal chunks leave workers idle at the end of every batch, so the executors
+schedule by expected cost instead:
+
+1. CostModel learns the wall time of every task, per job type (e.g.
+   "predict", "extrapolate", or the function handed to map), and predicts
+   the cost of a new task from the tasks nearest to it in parameter space.
+2. plan() orders the tasks longest-expected-first and groups them into
+   chunks whose expected cost is a fixed fraction of the work still to be
+   handed out (guided self-scheduling): big chunks first, single tasks at the
+   end.
+3. Workers pull the chunks from the pool's shared queue whenever they go
+   idle, so a worker that finishes early takes work that would otherwise
+   wait for a busy one.
+
+Every batch is summarized by a BatchReport (including the fraction of
+worker time spent idle).
+'''
+
+from collections import deque
+
+import numpy as np
+
+
+class CostModel:
+    '''
+    Runtime model of tasks, learned from their timing history.
+
+    neighbors : number of nearest past tasks (in feature space, i.e. theta)
+                whose times are averaged
+    capacity  : number of tasks remembered per job type (oldest are
+                forgotten first)
+
+    Without features (e.g. map over something other than points in
+    parameter space), or before a job type has any history, every task of
+    the job type is expected to take the median (or, with no history, the
+    same) time.
+    '''
+    def __init__(self, neighbors=8, capacity=2000):
+        self.neighbors = neighbors
+        self.capacity = capacity
+        self.history = {}
+
+
+    def add(self, job, features, seconds):
+        if job not in self.history:
+            self.history[job] = deque(maxlen=self.capacity)
+        self.history[job].append((features, seconds))
+
+
+    def count(self, job):
+        return len(self.history.get(job, ()))
+
+
+    def predict(self, job, features):
+        '''
+        Takes:
+            * job      : job type
+            * features : list with one feature vector (or None) per task
+        Returns:
+            * expected seconds of each task (ones if the job type has no
+              history yet)
+        '''
+        n = len(features)
+        history = self.history.get(job)
+        if not history:
+            return np.ones(n)
+        seconds = np.array([s for (_, s) in history])
+        typical = max(float(np.median(seconds)), 1e-9)
+
+        past = [f for (f, _) in history]
+        shapes = {np.shape(f) for f in past + list(features) if f is not None}
+        if (any(f is None for f in past + list(features)) or len(shapes) != 1
+                or len(past) < 2):
+            return np.full(n, typical)
+
+        H = np.array(past, dtype=np.float64)
+        Q = np.array(features, dtype=np.float64)
+        scale = H.std(axis=0)
+        scale[scale == 0] = 1
+        H = H/scale
+        Q = Q/scale
+        distances = ((Q**2).sum(axis=1)[:, None] + (H**2).sum(axis=1)[None, :]
+                     - 2*Q @ H.T)
+        k = min(self.neighbors, len(past))
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        return np.maximum(seconds[nearest].mean(axis=1), 1e-9)
+
+
+def plan(costs, workers, factor=2.0):
+    '''
+    Takes:
+        * costs   : expected cost of each task
+        * workers : number of workers
+        * factor  : each chunk gets 1/(factor workers) of the expected work
+                    not yet handed out
+    Returns:
+        * list of chunks (lists of task indices), longest-expected tasks
+          first
+    '''
+    costs = np.asarray(costs, dtype=np.float64)
+    order = np.argsort(-costs, kind='stable')
+    remaining = costs.sum()
+    chunks = []
+    chunk, total, target = [], 0.0, 0.0
+    for i in order:
+        if not chunk:
+            target = remaining/(factor*workers)
+        chunk.append(int(i))
+        total += costs[i]
+        if total >= target:
+            chunks.append(chunk)
+            remaining -= total
+            chunk, total = [], 0.0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class BatchReport:
+    '''
+    Summary of one batch (one map, predict_matrix, or imap_or_none call).
+
+    job       : job type
+    tasks     : number of tasks
+    chunks    : number of chunks they were handed out in
+    workers   : number of workers
+    wall_time : time from handing out the first chunk to receiving the last
+                result (s)
+    busy_time : summed wall time of the tasks (s)
+    expected  : summed expected cost of the tasks (s; ones if the job type
+                had no history)
+    '''
+    def __init__(self, job, tasks, chunks, workers, wall_time, busy_time,
+                 expected):
+        self.job = job
+        self.tasks = tasks
+        self.chunks = chunks
+        self.workers = workers
+        self.wall_time = wall_time
+        self.busy_time = busy_time
+        self.expected = expected
+
+
+    @property
+    def idle(self):
+        '''
+        Percentage of the workers' time (workers x wall time) spent idle.
+        '''
+        capacity = self.workers*self.wall_time
+        if capacity <= 0:
+            return 0.0
+        return max(0.0, 100*(1 - self.busy_time/capacity))
+
+
+    def __repr__(self):
+        return f'BatchReport(job={self.job}, tasks={self.tasks}, \
+chunks={self.chunks}, wall={self.wall_time:.3f} s, idle={self.idle:.1f}%)'
@@ -0,0 +1,314 @@
+'''
+Global sensitivity analysis of AZR predictions with respect to the sampled
+parameters (level parameters and normalization factors).
+
+Two designs are available over a prior box (bounds for every sampled
+parameter, in the order of Config.labels):
+    * Morris elementary effects (morris_design/morris_indices): a cheap
+      screening, r(d+1) evaluations
+    * Saltelli/Sobol (saltelli_design/sobol_indices): first- and total-order
+      variance-based indices, N(d+2) evaluations
+
+The design points are evaluated in parallel on an Executor (Evaluator).
+Results are cached by theta, so refining an analysis (or running Morris and
+then Sobol over the same box) does not repeat AZURE2 runs.
+
+Indices are reported per group of outputs: one group per included data
+segment (the segment's points are combined by weighting each point with its
+variance) and one group per extrapolation energy.
+'''
+
+import numpy as np
+
+from executor import Executor
+from output import XS_COM_FIT_INDEX, XS_COM_DATA_INDEX, XS_ERR_COM_DATA_INDEX
+
+'''
+Column of the extrapolation files that is analyzed (cross section).
+'''
+EXTRAP_XS_INDEX = 3
+
+
+def default_bounds(azr, fraction=0.1, floor=1e-3):
+    '''
+    Returns a prior box around the values in the input file: each parameter
+    may vary by fraction of its value (at least floor).
+    '''
+    values = np.asarray(azr.config.get_input_values(), dtype=np.float64)
+    half = np.maximum(np.abs(values)*fraction, floor)
+    return np.column_stack((values - half, values + half))
+
+
+def scale(unit, bounds):
+    '''
+    Maps points in the unit cube to the box bounds (shape (d, 2)).
+    '''
+    bounds = np.asarray(bounds, dtype=np.float64)
+    return bounds[:, 0] + unit*(bounds[:, 1] - bounds[:, 0])
+
+
+def morris_design(bounds, trajectories=10, levels=4, seed=None):
+    '''
+    Takes:
+        * bounds       : array (d, 2) of lower and upper bounds
+        * trajectories : number of Morris trajectories, r
+        * levels       : number of grid levels, p (even)
+    Returns:
+        * array (r(d+1), d) of points; every trajectory is d+1 consecutive
+          rows, each differing from the previous one in a single parameter
+    '''
+    rng = np.random.default_rng(seed)
+    d = len(bounds)
+    delta = levels/(2*(levels - 1))
+    grid = np.arange(levels//2)/(levels - 1)
+
+    points = []
+    for _ in range(trajectories):
+        x = rng.choice(grid, size=d)
+        signs = rng.choice([-1, 1], size=d)
+        # Start from the end of each step that keeps us inside [0, 1].
+        x = np.where(signs < 0, x + delta, x)
+        trajectory = [x.copy()]
+        for i in rng.permutation(d):
+            x[i] += signs[i]*delta
+            trajectory.append(x.copy())
+        points.append(trajectory)
+    return scale(np.concatenate(points), bounds)
+
+
+def saltelli_design(bounds, n=256, seed=None):
+    '''
+    Takes:
+        * bounds : array (d, 2) of lower and upper bounds
+        * n      : base sample size, N
+    Returns:
+        * array (N(d+2), d) of points: A (N rows), B (N rows), then AB_i
+          (N rows each; A with column i taken from B) for i = 1, ..., d
+    '''
+    rng = np.random.default_rng(seed)
+    d = len(bounds)
+    a = rng.random((n, d))
+    b = rng.random((n, d))
+    blocks = [a, b]
+    for i in range(d):
+        ab = a.copy()
+        ab[:, i] = b[:, i]
+        blocks.append(ab)
+    return scale(np.concatenate(blocks), bounds)
+
+
+def output_groups(azr, energies=None):
+    '''
+    Returns the labels and slices of the output groups: one per included data
+    segment (in Data order), then one per extrapolation energy (if energies,
+    a list of (extrapolation file, energies) pairs, is given).
+    '''
+    data = azr.config.data
+    labels = [f'segment {seg.index}' for seg in data.segments]
+    slices = list(data.slices)
+    start = data.n_points
+    for (of, e) in energies or []:
+        for energy in e:
+            labels.append(f'{of} E={energy:.6g}')
+            slices.append(slice(start, start + 1))
+            start += 1
+    return labels, slices
+
+
+def group_ratio(numerator, variance, slices):
+    '''
+    Combines per-output indices into per-group indices: the sum of the
+    numerators over the sum of the variances of each group's outputs.
+    numerator has shape (d, n_outputs); variance has shape (n_outputs,).
+    '''
+    ratios = np.full((len(slices), numerator.shape[0]), np.nan)
+    for (g, s) in enumerate(slices):
+        total = np.sum(variance[s])
+        if total > 0:
+            ratios[g] = np.sum(numerator[:, s], axis=1)/total
+    return ratios
+
+
+class Evaluator:
+    '''
+    Evaluates the outputs analyzed for sensitivity at many points, in
+    parallel, caching the results by theta.
+
+    azr         : AZR instance
+    column      : output column of the data points (see output.py); use
+                  'residual' for (calculated - data)/uncertainty, which also
+                  responds to normalization factors
+    extrapolate : Also analyze the extrapolations (one output per energy)?
+    executor    : Executor to use (default: a temporary one per call)
+    processes   : number of processes of the temporary Executor
+
+    Points at which AZURE2 fails give NaN outputs.
+    '''
+    def __init__(self, azr, column=XS_COM_FIT_INDEX, extrapolate=None,
+                 executor=None, processes=None):
+        self.azr = azr
+        self.column = column
+        if extrapolate is None:
+            extrapolate = len(azr.extrap_filenames) > 0
+        self.extrapolate = extrapolate
+        self.executor = executor
+        self.processes = processes
+        self.cache = {}
+        self.energies = None
+
+
+    def key(self, theta):
+        return np.asarray(theta, dtype=np.float64).tobytes()
+
+
+    def data_vector(self, output):
+        data = self.azr.config.data
+        filenames = self.azr.output_filenames
+        if self.column == 'residual':
+            fit = data.concatenate(output, filenames, column=XS_COM_FIT_INDEX)
+            y = data.concatenate(output, filenames, column=XS_COM_DATA_INDEX)
+            dy = data.concatenate(output, filenames,
+                                  column=XS_ERR_COM_DATA_INDEX)
+            return (fit - y)/dy
+        return data.concatenate(output, filenames, column=self.column)
+
+
+    def evaluate(self, thetas):
+        '''
+        Returns an array (len(thetas), number of outputs).
+        '''
+        thetas = np.asarray(thetas, dtype=np.float64)
+        missing = list({self.key(t): t for t in thetas
+                        if self.key(t) not in self.cache}.values())
+
+        if missing:
+            executor = self.executor
+            if executor is None:
+                executor = Executor(self.azr, processes=self.processes)
+            try:
+                predictions = executor.imap_or_none('predict', missing,
+                                                    dress_up=False)
+                extrapolations = (executor.imap_or_none('extrapolate', missing)
+                                  if self.extrapolate else None)
+                for theta in missing:
+                    self.cache[self.key(theta)] = self.outputs(
+                        next(predictions),
+                        next(extrapolations) if extrapolations else None)
+            finally:
+                if self.executor is None:
+                    executor.close()
+
+        n = max((v.size for v in self.cache.values() if v is not None),
+                default=0)
+        results = np.full((len(thetas), n), np.nan)
+        for (i, theta) in enumerate(thetas):
+            values = self.cache[self.key(theta)]
+            if values is not None:
+                results[i] = values
+        return results
+
+
+    def outputs(self, prediction, extrapolation):
+        if prediction is None or (self.extrapolate and extrapolation is None):
+            return None
+        values = [self.data_vector(prediction)]
+        if self.extrapolate:
+            extrapolation = [np.atleast_2d(e) for e in extrapolation]
+            if self.energies is None:
+                self.energies = [(of, e[:, 0]) for (of, e) in
+                                 zip(self.azr.extrap_filenames, extrapolation)]
+            values += [e[:, EXTRAP_XS_INDEX] for e in extrapolation]
+        return np.concatenate(values)
+
+
+    def groups(self):
+        return output_groups(self.azr, self.energies)
+
+
+def morris_indices(evaluator, bounds, trajectories=10, levels=4, seed=None):
+    '''
+    Takes:
+        * evaluator : Evaluator
+        * bounds    : prior box, array (d, 2)
+    Returns a dictionary with:
+        * mu_star : array (groups, d), mean absolute elementary effect
+        * sigma   : array (groups, d), standard deviation of the elementary
+                    effects
+        * groups  : labels of the groups (see output_groups)
+    Elementary effects are taken in units of the parameter ranges and of each
+    output's spread over the design, then averaged over a group's outputs.
+    Trajectories with a failed point are dropped.
+    '''
+    bounds = np.asarray(bounds, dtype=np.float64)
+    d = len(bounds)
+    x = morris_design(bounds, trajectories, levels, seed)
+    y = evaluator.evaluate(x)
+    labels, slices = evaluator.groups()
+
+    spread = np.nanstd(y, axis=0)
+    spread[spread == 0] = np.inf
+    width = bounds[:, 1] - bounds[:, 0]
+
+    effects = [[] for _ in range(d)]
+    for t in range(trajectories):
+        xt = x[t*(d+1):(t+1)*(d+1)]
+        yt = y[t*(d+1):(t+1)*(d+1)]
+        if np.any(np.isnan(yt)):
+            continue
+        for k in range(d):
+            dx = (xt[k+1] - xt[k])/width
+            i = int(np.argmax(np.abs(dx)))
+            effects[i].append((yt[k+1] - yt[k])/spread/dx[i])
+
+    mu_star = np.full((len(slices), d), np.nan)
+    sigma = np.full((len(slices), d), np.nan)
+    for i in range(d):
+        if not effects[i]:
+            continue
+        ee = np.array(effects[i])
+        for (g, s) in enumerate(slices):
+            mu_star[g, i] = np.mean(np.abs(ee[:, s]))
+            sigma[g, i] = np.mean(np.std(ee[:, s], axis=0))
+    return {'mu_star': mu_star, 'sigma': sigma, 'groups': labels}
+
+
+def sobol_indices(evaluator, bounds, n=256, seed=None):
+    '''
+    Takes:
+        * evaluator : Evaluator
+        * bounds    : prior box, array (d, 2)
+        * n         : base sample size (N(d+2) evaluations)
+    Returns a dictionary with:
+        * S1     : array (groups, d), first-order indices (Saltelli 2010)
+        * ST     : array (groups, d), total-order indices (Jansen)
+        * groups : labels of the groups (see output_groups)
+    For a group of several outputs, the indices are the sums of the partial
+    variances over the sum of the total variances. Rows of the design with a
+    failed point are dropped.
+    '''
+    bounds = np.asarray(bounds, dtype=np.float64)
+    d = len(bounds)
+    x = saltelli_design(bounds, n, seed)
+    y = evaluator.evaluate(x).reshape(d+2, n, -1)
+    labels, slices = evaluator.groups()
+
+    ok = ~np.any(np.isnan(y), axis=(0, 2))
+    assert np.any(ok), 'AZURE2 failed at every row of the design.'
+    y = y[:, ok]
+    fa, fb, fab = y[0], y[1], y[2:]
+
+    variance = np.var(np.concatenate((fa, fb)), axis=0)
+    first = np.mean(fb*(fab - fa), axis=1)
+    total = 0.5*np.mean((fa - fab)**2, axis=1)
+    return {'S1': group_ratio(first, variance, slices),
+            'ST': group_ratio(total, variance, slices),
+            'groups': labels}
+
+
+def insensitive(indices, threshold=0.01, key='ST'):
+    '''
+    Returns the indices of the parameters whose index (key) is below
+    threshold for every group: candidates for fixing.
+    '''
+    values = np.nan_to_num(indices[key], nan=0.0)
+    return [int(i) for i in np.flatnonzero(np.all(values < threshold, axis=0))]
@@ -0,0 +1,223 @@
+'''
+Shares the (immutable) input-file data of an AZR instance with worker
+processes through multiprocessing.shared_memory.
+
+Pickling an AZR instance for every worker copies every Segment array into
+every process. Instead, the arrays of the AzrDocument are published once into
+a single shared-memory block. Workers receive a small handle (block name,
+array layout, and the text of the input file) and attach to it by name, so
+per-worker memory and start-up time do not grow with the size of the data.
+'''
+
+import sys
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from document import AzrDocument
+
+'''
+Arrays in the shared block are aligned to this many bytes.
+'''
+ALIGNMENT = 64
+
+'''
+Attributes that are rebuilt in the worker rather than copied from the parent.
+'''
+REBUILT_ATTRIBUTES = ('config', 'failures', 'parameters', 'output_filenames',
+                      'extrap_filenames', 'usage')
+
+
+def attach(name):
+    '''
+    Attaches to the shared-memory block name without taking ownership of it
+    (so the resource tracker does not unlink it when this process exits).
+    Before Python 3.13, attaching registers the block with the tracker, so
+    the registration is dropped right away. Pool workers share their
+    parent's tracker, which then forgets the owner's registration too;
+    destroy() registers the block again before unlinking it.
+    '''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def destroy(shm):
+    '''
+    Closes and unlinks the block of shm (owner only).
+    '''
+    if sys.version_info < (3, 13):
+        # unlink() unregisters the block, which fails in the tracker if an
+        # attaching worker already did (see attach).
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.close()
+    shm.unlink()
+
+
+class SharedArrays:
+    '''
+    A dictionary of NumPy arrays stored in one shared-memory block.
+
+    Only the layout (name, offsets, shapes, dtypes) is pickled, so a
+    SharedArrays can be sent to workers cheaply. The process that called
+    publish() owns the block and must call unlink() when it's done.
+    '''
+    def __init__(self, name, layout):
+        self.name = name
+        self.layout = layout
+        self.shm = None
+
+
+    @classmethod
+    def publish(cls, arrays):
+        '''
+        Copies arrays (dict) into a new shared-memory block.
+        '''
+        layout = {}
+        offset = 0
+        for (key, a) in arrays.items():
+            a = np.ascontiguousarray(a)
+            layout[key] = (offset, a.shape, a.dtype.str)
+            offset += -(-a.nbytes // ALIGNMENT) * ALIGNMENT
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        shared = cls(shm.name, layout)
+        shared.shm = shm
+        for (key, view) in shared.views(writeable=True).items():
+            view[...] = arrays[key]
+        return shared
+
+
+    def views(self, writeable=False):
+        '''
+        Returns the arrays as views into the shared block (attaching to it
+        if necessary). The views are read-only unless writeable is True.
+        '''
+        if self.shm is None:
+            self.shm = attach(self.name)
+        views = {}
+        for (key, (offset, shape, dtype)) in self.layout.items():
+            a = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf,
+                           offset=offset)
+            a.flags.writeable = writeable
+            views[key] = a
+        return views
+
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+
+    def unlink(self):
+        '''
+        Releases the block (owner only).
+        '''
+        destroy(self.shm or shared_memory.SharedMemory(name=self.name))
+        self.shm = None
+
+
+    def __getstate__(self):
+        return {'name': self.name, 'layout': self.layout}
+
+
+    def __setstate__(self, state):
+        self.name = state['name']
+        self.layout = state['layout']
+        self.shm = None
+
+
+class SharedMatrix:
+    '''
+    2D float64 array in shared memory. Workers write rows into it; only the
+    name and shape are pickled.
+    '''
+    def __init__(self, name, shape):
+        self.name = name
+        self.shape = tuple(shape)
+        self.shm = None
+
+
+    @classmethod
+    def create(cls, shape):
+        nbytes = int(np.prod(shape))*np.dtype(np.float64).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        matrix = cls(shm.name, shape)
+        matrix.shm = shm
+        return matrix
+
+
+    @property
+    def array(self):
+        if self.shm is None:
+            self.shm = attach(self.name)
+        return np.ndarray(self.shape, dtype=np.float64, buffer=self.shm.buf)
+
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+
+    def unlink(self):
+        destroy(self.shm or shared_memory.SharedMemory(name=self.name))
+        self.shm = None
+
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape}
+
+
+    def __setstate__(self, state):
+        self.name = state['name']
+        self.shape = state['shape']
+        self.shm = None
+
+
+class SharedAZR:
+    '''
+    Handle from which a worker rebuilds an AZR instance without copying its
+    data arrays.
+
+    Takes an AZR instance. Its AzrDocument data arrays are published to
+    shared memory; everything else (input file contents, parameters, and
+    settings like command and timeout) travels with the handle.
+    '''
+    def __init__(self, azr):
+        document = azr.config.document
+        self.input_filename = azr.config.input_filename
+        self.contents = document.contents
+        self.digest = document.digest
+        self.key = document.key
+        self.parameters = azr.config.parameters
+        self.output_filenames = azr.output_filenames
+        self.extrap_filenames = azr.extrap_filenames
+        self.settings = {k: v for (k, v) in azr.__dict__.items()
+                         if k not in REBUILT_ATTRIBUTES}
+        self.arrays = SharedArrays.publish(document.values)
+
+
+    def attach(self):
+        '''
+        Returns an AZR instance whose data arrays are read-only views into
+        shared memory.
+        '''
+        # Imported here to avoid a circular import (azr -> tuning -> executor
+        # -> shared).
+        from azr import AZR
+
+        document = AzrDocument(self.input_filename, self.contents,
+                               values=self.arrays.views(), digest=self.digest,
+                               key=self.key)
+        azr = AZR(self.input_filename, parameters=self.parameters,
+                  output_filenames=self.output_filenames,
+                  extrap_filenames=self.extrap_filenames, document=document)
+        azr.__dict__.update(self.settings)
+        return azr
+
+
+    def unlink(self):
+        self.arrays.unlink()
@@ -0,0 +1,114 @@
+'''
+Exploratory fits on a subset of the data segments.
+
+AZR.predict(theta, segments=[...]) runs AZURE2 on a variant of the input
+file in which only those segments are included, so a pass over the capture
+data alone costs a fraction of a full evaluation. SubsetPosterior is a
+log-posterior whose likelihood covers the segments it is currently set to
+(all included segments by default). switch() changes them under a running
+sampler: explore on a few segments, then continue from the same walkers on
+the full likelihood.
+
+    posterior = SubsetPosterior(azr, log_prior, segments=[0])
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, posterior, pool=executor)
+    sampler.run_mcmc(p0, 500)
+    p = switch(sampler, posterior, None)
+    sampler.run_mcmc(p, 2000)
+
+The steps taken before the switch sample a different posterior, so they
+belong to the burn-in (discard them).
+'''
+
+import numpy as np
+
+from output import XS_COM_FIT_INDEX, XS_COM_DATA_INDEX, XS_ERR_COM_DATA_INDEX
+from runner import AZURE2Error
+
+
+class SubsetPosterior:
+    '''
+    log_prior plus the Gaussian log-likelihood of the points of segments.
+
+    azr       : AZR instance
+    log_prior : function of theta
+    segments  : indices (as in Data.all_segments) of the included segments
+                in the likelihood (None: all of them)
+    column    : output column compared to the data (see output.py)
+
+    The data and their uncertainties are read from AZURE2's output, so
+    normalization factors in theta are accounted for. Stored external capture
+    integrals (ext_capture_file) are for the full data, so AZR.predict refuses
+    a subset unless AZURE2 calculates them (ext_capture_file='\\n').
+    '''
+    def __init__(self, azr, log_prior, segments=None,
+                 column=XS_COM_FIT_INDEX):
+        self.azr = azr
+        self.log_prior = log_prior
+        self.column = column
+        self.segments = None
+        self.set_segments(segments)
+
+
+    def set_segments(self, segments):
+        '''
+        Restricts the likelihood to segments (None: all included segments).
+        '''
+        if segments is not None:
+            segments = self.azr.config.data.subset(segments).indices
+        self.segments = segments
+
+
+    @property
+    def fraction(self):
+        '''
+        Fraction of the data points in the likelihood (roughly the cost of
+        an evaluation relative to a full one).
+        '''
+        data = self.azr.config.data
+        if data.n_points == 0:
+            return 1.0
+        return data.subset(self.segments).n_points/data.n_points
+
+
+    def __call__(self, theta):
+        lnpi = self.log_prior(theta)
+        if lnpi == -np.inf:
+            return -np.inf
+        try:
+            output = self.azr.predict(theta, dress_up=False,
+                                      segments=self.segments)
+        except AZURE2Error:
+            return -np.inf
+        mu = self.azr.concatenate(output, self.column, self.segments)
+        y = self.azr.concatenate(output, XS_COM_DATA_INDEX, self.segments)
+        dy = self.azr.concatenate(output, XS_ERR_COM_DATA_INDEX, self.segments)
+        return lnpi + float(np.sum(-np.log(np.sqrt(2*np.pi)*dy) -
+                                   0.5*((y - mu)/dy)**2))
+
+
+def switch(sampler, posterior, segments=None):
+    '''
+    Takes:
+        * sampler   : emcee.EnsembleSampler or DelayedAcceptanceSampler whose
+                      log-probability function is posterior
+        * posterior : SubsetPosterior
+        * segments  : segments of the new likelihood (None: all of them)
+    Does:
+        * switches posterior to segments
+        * recalculates the log-posteriors of the current walkers
+          (DelayedAcceptanceSampler; emcee does it when run_mcmc starts from
+          the positions)
+    Returns:
+        * positions of the walkers, to continue from (emcee:
+          sampler.run_mcmc(positions, nsteps); DelayedAcceptanceSampler:
+          sampler.run(nsteps))
+    The log-probability function is looked up on every step (and pickled
+    with every batch sent to an Executor), so the switch takes effect
+    immediately, in the workers too.
+    '''
+    posterior.set_segments(segments)
+    if hasattr(sampler, 'get_last_sample'):
+        return np.array(sampler.get_last_sample().coords)
+    positions = sampler.x.copy()
+    sampler.initialize(positions)
+    return positions
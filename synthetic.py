@@ -0,0 +1,161 @@
+'''
+Synthesizes AZURE2 input files (and their data files) of any size, for
+testing and benchmarking pyazr on inputs as large as production ones.
+
+The rows follow the layout of test/12C+p.azr (p + 12C with a capture
+channel): every level has one row per particle pair, and the columns pyazr
+reads (J, parity, energies, widths, pairs, masses, charges, separation
+energies, channel radii) are filled in. The physics is made up; the files
+are meant for pyazr (and the fake AZURE2 of the smoke tests), not for
+fitting.
+'''
+
+import os
+
+import numpy as np
+
+import utility
+
+CONFIG = '''<config>
+true
+output/
+checks/
+none
+none
+none
+none
+none
+none
+none
+none
+</config>'''
+
+'''
+Level row of a particle pair and of the capture (photon) pair, as in
+test/12C+p.azr, with the fields filled in by level_row.
+'''
+PARTICLE_ROW = ('{J} {pi} {E} {E_fixed} 1 {pair} 1 0 {level} 1 {G_fixed} '
+                '{G} 0.5 1 0 1 0 {m1} {m2} {z1} {z2} {S} {S} 0 0 0.0 0 '
+                '{radius} 5.5857 0 0')
+CAPTURE_ROW = ('{J} {pi} {E} {E_fixed} 1 {pair} 1 2 {level} 1 {G_fixed} '
+               '{G} 1 1 0.5 -1 0 0 {m2} 0 {z2} {S} 0 0 0 0.0 10 0 0 0 7')
+
+LAST_RUN = '''<lastRun>
+10057
+"output/param.sav"
+"output/intEC.dat"
+1 1
+0 ""
+1 1 0
+</lastRun>'''
+
+'''
+Spins (J) the levels cycle through.
+'''
+SPINS = (0.5, 1.5, 2.5, 3.5)
+
+
+def pairs(n_channels, capture=True):
+    '''
+    Returns the particle pairs: (light mass, heavy mass, light charge, heavy
+    charge, separation energy) for pairs 1, ..., n_channels (particles) and,
+    if capture, one more with a photon.
+    '''
+    result = []
+    for k in range(n_channels):
+        # p + 12C, then heavier ejectiles with smaller separation energies
+        # (so every reaction is open at all energies).
+        result.append((1.00728*(k + 1), 12.0, 1, 6, 1.94351 - 0.2*k))
+    if capture:
+        result.append((0.0, 13.0, 0, 7, 1.94351))
+    return result
+
+
+def level_row(pair_index, pair, level, spin, parity, energy, width):
+    m1, m2, z1, z2, separation = pair
+    template = CAPTURE_ROW if m1 == 0 else PARTICLE_ROW
+    return template.format(J=spin, pi=parity, E=energy, E_fixed=0,
+                           pair=pair_index, level=level, G_fixed=0, G=width,
+                           m1=m1, m2=m2, z1=z1, z2=z2, S=separation,
+                           radius=3.4)
+
+
+def segment_data(n_points, e_min, e_max, rng):
+    '''
+    Returns a data array (lab energy, lab angle, cross section, uncertainty)
+    with n_points points.
+    '''
+    energies = np.linspace(e_min, e_max, n_points)
+    angles = rng.choice([0.0, 55.0, 90.0, 135.0], size=n_points)
+    xs = 1e-8*(1 + energies)*np.exp(-energies)
+    return np.column_stack((energies, angles, xs, 0.1*xs))
+
+
+def generate(directory, n_levels=10, n_channels=1, n_segments=10,
+             n_points=50, capture=True, vary_norm=0.5, excluded=0.0,
+             seed=None, name='synthetic.azr'):
+    '''
+    Writes a synthetic input file and its data files.
+    Takes:
+        * directory  : where the .azr file goes (data files go to
+                       directory/data/)
+        * n_levels   : number of levels (all energies and widths free)
+        * n_channels : number of particle pairs (plus a capture pair if
+                       capture)
+        * n_segments : number of data segments
+        * n_points   : points per data segment
+        * vary_norm  : fraction of the segments with a varied normalization
+                       factor
+        * excluded   : fraction of the segments that are excluded
+    Returns:
+        * filename of the .azr file (data paths in it are relative to
+          directory, like those of the example inputs)
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+    pair_list = pairs(n_channels, capture)
+
+    rows = ['<levels>']
+    for i in range(n_levels):
+        spin = SPINS[i % len(SPINS)]
+        parity = 1 if (i // len(SPINS)) % 2 == 0 else -1
+        energy = round(2.0 + 0.1*i, 4)
+        for (k, pair) in enumerate(pair_list):
+            width = 1e4*(1 + i) if pair[0] > 0 else 0.5*(1 + k)
+            rows.append(level_row(k + 1, pair, i + 1, spin, parity, energy,
+                                  width))
+        rows.append('')
+    rows.append('</levels>')
+
+    rows.append('<segmentsData>')
+    outgoing = list(range(1, len(pair_list) + 1))
+    n_varied = int(round(vary_norm*n_segments))
+    n_excluded = int(round(excluded*n_segments))
+    for j in range(n_segments):
+        filepath = f'data/segment{j}.dat'
+        np.savetxt(os.path.join(directory, filepath),
+                   segment_data(n_points, 0.1, 4.0, rng))
+        include = 0 if j < n_excluded else 1
+        out = outgoing[j % len(outgoing)]
+        data_type = 0 if pair_list[out - 1][0] == 0 else 1
+        # Excluded segments come first, segments with varied normalization
+        # factors last.
+        vary = 1 if j >= n_segments - n_varied else 0
+        rows.append(f'{include} 1 {out} 0 50 0 180 {data_type} 1 {vary} 10 '
+                    f'{filepath}')
+    rows.append('</segmentsData>')
+
+    rows.append('<segmentsTest>')
+    for out in outgoing:
+        rows.append(f'1 1 {out} 0.1 4.0 0.01 0 0 0 0')
+    rows.append('</segmentsTest>')
+
+    rows.append('<targetInt>')
+    rows.append(f'0 "{utility.format_ranges(range(1, n_segments + 1))}" 10 '
+                '0 0 0 0 "" 0 1 1 1 1')
+    rows.append('</targetInt>')
+
+    filename = os.path.join(directory, name)
+    with open(filename, 'w') as f:
+        f.write('\n'.join([CONFIG] + rows + [LAST_RUN]) + '\n')
+    return filename
@@ -2,8 +2,7 @@
 Analyzes output of test_mcmc.py.
 1. Read in test_mcmc.h5.
 2. Produce a corner plot.
-3. Produce a band (or "brush") of curves to show the uncertainty in the capture
-cross section.
+3. Produce a band to show the uncertainty in the capture cross section.
 4. Extrapolate to low energy.
 
 The default parameters of test_mcmc.py will not produce a converged run, so
@@ -11,7 +10,6 @@ these plots will not look very good. The user will undoubtedly need to run
 longer.
 '''
 
-import os
 import sys
 
 import emcee
@@ -20,8 +18,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 import model
-
-os.environ['OMP_NUM_THREADS'] = '4'
+from bands import Band
+from executor import ThreadExecutor
 
 ########################################
 # 1. Read in test_mcmc.h5.
@@ -38,7 +36,7 @@ fig.patch.set_facecolor('white')
 plt.savefig('corner.pdf')
 
 ########################################
-# 3. Produce a band (or "brush") of curves to show the uncertainty.
+# 3. Produce a band to show the uncertainty.
 
 def mu(theta):
     '''
@@ -55,25 +53,36 @@ energies = output.e_com
 vogl = output.xs_com_data
 vogl_err = output.xs_err_com_data
 
-# The default parameters of test_mcmc.py produce a short chain. When analyzing a
-# longer run, one may want to do the evaluation on a subset of the chain.
-brush = np.array([mu(theta) for theta in chain])
+# The band is computed from a subsample of the chain (thinned by its
+# autocorrelation time), evaluated in batches until the 16th, 50th, and 84th
+# percentiles are known to within 5% of the band width at every energy.
+# mu runs on model.azr in 4 threads, so each AZURE2 run gets one core.
+model.azr.omp_threads = 1
+with ThreadExecutor(model.azr, threads=4) as executor:
+    band = Band(model.azr, backend.get_chain(), function=mu,
+                executor=executor, tolerance=0.05).run(verbose=True)
+print(f'Band from {band.samples.size} samples ({band.runs} AZURE2 runs).')
+lower, median, upper = band.bands
 
 fig, ax = plt.subplots()
 fig.patch.set_facecolor('white')
 
-for stroke in brush:
-    ax.plot(energies, stroke, color='C0', alpha=0.1)
+ax.fill_between(energies, lower, upper, color='C0', alpha=0.3)
+ax.plot(energies, median, color='C0')
 
 ax.errorbar(energies, vogl, yerr=vogl_err, linestyle='', capsize=2, color='C1')
 ax.set_xlabel(r'$E$ (MeV, COM)')
 ax.set_ylabel(r'$\sigma$ (b)')
 ax.set_yscale('log')
-plt.savefig('brush.pdf')
+plt.savefig('band.pdf')
 
 ########################################
 # 4. Extrapolate to low energy.
 
+# Evaluations below are serial, so let AZURE2 use several threads. (Only the
+# AZURE2 processes see this setting.)
+model.azr.omp_threads = 4
+
 def extrapolate(theta):
     '''
     Runs AZURE2 with the single test segment in the input file. 
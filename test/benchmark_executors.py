@@ -0,0 +1,80 @@
+'''
+Compares the process pool (executor.Executor) with the thread pool
+(executor.ThreadExecutor) on the same batch of points.
+
+    python benchmark_executors.py [--workers 4] [--points 64] [--repeats 3]
+
+For each executor, the time to start it and the throughput of predict_matrix
+(points per second) are reported, and the predictions of the two are checked
+against each other. Run it from test/ (it uses 12C+p.azr).
+'''
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+# Import pyazr classes from the parent directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from azr import AZR
+from executor import Executor, ThreadExecutor
+
+
+def points(azr, n, seed=0):
+    '''
+    n points scattered (1%) around the input values.
+    '''
+    rng = np.random.default_rng(seed)
+    theta0 = np.array(azr.config.get_input_values())
+    return [theta0*(1 + 0.01*rng.standard_normal(theta0.size)) for _ in
+            range(n)]
+
+
+def benchmark(cls, azr, thetas, workers, repeats):
+    '''
+    Returns the start-up time (s), the best throughput (points/s), and the
+    predictions of cls(azr, workers).
+    '''
+    start = time.perf_counter()
+    with cls(azr, workers, 1) as executor:
+        startup = time.perf_counter() - start
+        best = np.inf
+        for _ in range(repeats):
+            start = time.perf_counter()
+            results = executor.predict_matrix(thetas)
+            best = min(best, time.perf_counter() - start)
+        results = results.copy()
+    return startup, len(thetas)/best, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--input', default='12C+p.azr')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--points', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    azr = AZR(args.input)
+    thetas = points(azr, args.points)
+
+    rows = []
+    for (name, cls) in [('processes', Executor), ('threads', ThreadExecutor)]:
+        startup, throughput, results = benchmark(cls, azr, thetas,
+                                                 args.workers, args.repeats)
+        rows.append((name, startup, throughput, results))
+
+    print(f'{args.points} points, {args.workers} workers')
+    print(f'  {"executor":10s} {"start (s)":>10s} {"points/s":>10s}')
+    for (name, startup, throughput, _) in rows:
+        print(f'  {name:10s} {startup:10.3f} {throughput:10.1f}')
+
+    same = np.allclose(rows[0][3], rows[1][3], equal_nan=True)
+    print('Predictions agree.' if same else 'Predictions DIFFER.')
+    return 0 if same else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+'''
+Measures how the pyazr stages scale with the size of the input file, on
+synthetic inputs (see synthetic.py), and fails if a stage grows faster than
+linearly.
+
+    python benchmark_scaling.py [--sweep levels segments] [--threshold 1.3]
+
+Each sweep doubles one size (levels, particle pairs, segments, or points per
+segment) with the others fixed. The exponent of a stage is the slope of
+log(time) against log(size) over the larger half of the sweep (the smaller
+sizes are dominated by fixed costs). An exponent above the threshold fails
+the benchmark (exit status 1). No AZURE2 run is made.
+
+Stages that take microseconds are called in a loop until each timing lasts
+at least --min-time, so the fit is not driven by timer noise. Every size is
+timed in --rounds interleaved passes and the shortest time counts, so a burst
+of load on the machine does not show up as growth. The sizes are large
+enough that the arrays of the fitted half do not fit in a typical L2 cache;
+the step when they stop fitting would otherwise look super-linear.
+'''
+
+import gc
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+# Import pyazr classes from the parent directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utility
+import synthetic
+from data import Data
+from document import AzrDocument
+from configuration import Config
+from output import XS_COM_DATA_INDEX
+
+'''
+Fixed sizes of each sweep, and the sizes the swept one takes.
+'''
+BASE = {'n_levels': 20, 'n_channels': 2, 'n_segments': 20, 'n_points': 400}
+SWEEPS = {
+    'levels': ('n_levels', [25, 50, 100, 200, 400]),
+    'channels': ('n_channels', [2, 4, 8, 16, 32]),
+    'segments': ('n_segments', [50, 100, 200, 400, 800]),
+    'points': ('n_points', [800, 1600, 3200, 6400, 12800]),
+}
+
+
+def loop_time(fn, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return time.perf_counter() - start
+
+
+def best_time(fn, repeats, min_time=0.01):
+    '''
+    Shortest wall time (s) per call of fn over repeats timings (with the
+    garbage collector off, as in timeit). Each timing calls fn as many times
+    as it takes to last at least min_time (the number is doubled until it
+    does, like timeit's autorange).
+    '''
+    times = []
+    gc.collect()
+    gc.disable()
+    try:
+        number = 1
+        while True:
+            t = loop_time(fn, number)
+            if t >= min_time:
+                break
+            number *= 2
+        times.append(t/number)
+        for _ in range(repeats - 1):
+            times.append(loop_time(fn, number)/number)
+    finally:
+        gc.enable()
+    return min(times)
+
+
+def stage_times(filename, repeats, min_time=0.01):
+    '''
+    Returns a dictionary mapping each stage to its time (s) on filename.
+    '''
+    times = {}
+    document = AzrDocument.load(filename, snapshot=False)
+    contents = document.contents
+    times['document'] = best_time(
+        lambda: AzrDocument.load(filename, snapshot=False), repeats,
+        min_time)
+    times['data'] = best_time(
+        lambda: Data(filename, contents=contents, values=document.values),
+        repeats, min_time)
+    times['config'] = best_time(
+        lambda: Config(filename, document=document), repeats, min_time)
+
+    config = Config(filename, document=document)
+    theta = np.array(config.get_input_values())
+    times['levels'] = best_time(
+        lambda: config.generate_levels(theta[:config.n1]), repeats,
+        min_time)
+
+    def norm_factors():
+        config.data.update_norm_factors(theta[config.n1:], contents.copy())
+    times['norm_factors'] = best_time(norm_factors, repeats, min_time)
+    times['compile'] = best_time(
+        lambda: config.compile_contents(contents, test=True), repeats,
+        min_time)
+
+    levels = config.generate_levels(theta[:config.n1])
+    input_filename, output_dir = utility.random_output_dir_filename()
+    times['write_input'] = best_time(
+        lambda: utility.write_input_file(contents, levels, input_filename,
+                                         output_dir), repeats, min_time)
+    os.remove(input_filename)
+    os.rmdir(output_dir)
+
+    data = config.data
+
+    def observed():
+        data.observed_cache = None
+        data.observed_matrix()
+    times['observed'] = best_time(observed, repeats, min_time)
+
+    outputs = data.observed_outputs()
+    times['concatenate'] = best_time(
+        lambda: data.concatenate(outputs, column=XS_COM_DATA_INDEX), repeats,
+        min_time)
+    return times
+
+
+def exponent(sizes, times):
+    '''
+    Slope of log(time) against log(size) over the larger half of the sizes.
+    '''
+    k = len(sizes)//2
+    x, y = np.log(sizes[k:]), np.log(np.maximum(times[k:], 1e-9))
+    return np.polyfit(x, y, 1)[0]
+
+
+def run_sweep(name, repeats, directory, min_time=0.01, rounds=3):
+    '''
+    Times every stage at every size of the sweep, rounds times over, and keeps
+    the shortest time of each. The sizes are interleaved, so a burst of load
+    on the machine slows one size in one round rather than all the timings
+    of a size.
+    '''
+    key, sizes = SWEEPS[name]
+    filenames = []
+    for size in sizes:
+        sizes_now = dict(BASE, **{key: size})
+        subdirectory = os.path.join(directory, f'{name}{size}')
+        filenames.append(synthetic.generate(subdirectory, seed=0,
+                                            **sizes_now))
+
+    times = {}
+    cwd = os.getcwd()
+    try:
+        for _ in range(rounds):
+            for (k, filename) in enumerate(filenames):
+                os.chdir(os.path.dirname(filename))
+                result = stage_times(os.path.basename(filename), repeats,
+                                     min_time)
+                os.chdir(cwd)
+                for (stage, t) in result.items():
+                    times.setdefault(stage, np.full(len(sizes), np.inf))
+                    times[stage][k] = min(times[stage][k], t)
+    finally:
+        os.chdir(cwd)
+        for filename in filenames:
+            shutil.rmtree(os.path.dirname(filename))
+    return sizes, times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sweep', nargs='+', choices=list(SWEEPS),
+                        default=list(SWEEPS))
+    parser.add_argument('--threshold', type=float, default=1.3,
+                        help='largest acceptable exponent')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='passes over the sizes of a sweep')
+    parser.add_argument('--min-time', type=float, default=0.01,
+                        help='shortest timing (s) of each stage')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='pyazr_benchmark_')
+    failures = []
+    try:
+        for name in args.sweep:
+            sizes, times = run_sweep(name, args.repeats, directory,
+                                     args.min_time, args.rounds)
+            print(f'\n{name}: ' + ' '.join(f'{s:>9d}' for s in sizes) +
+                  '  exponent')
+            for (stage, t) in times.items():
+                p = exponent(sizes, t)
+                flag = '  <-- super-linear' if p > args.threshold else ''
+                print(f'  {stage:12s}' + ' '.join(f'{1e3*ti:8.2f}m'
+                                                   for ti in t) +
+                      f'  {p:8.2f}{flag}')
+                if p > args.threshold:
+                    failures.append((name, stage, p))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if failures:
+        print('\nSuper-linear stages:')
+        for (name, stage, p) in failures:
+            print(f'  {stage} in {name} (exponent {p:.2f})')
+        return 1
+    print('\nAll stages scale at most linearly.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+'''
+Round-trips chains through the emcee HDF5 backends written by pyazr.
+
+    python check_backends.py
+
+Needs emcee and h5py. AZURE2 is not run.
+'''
+
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+# Import pyazr classes from the parent directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nested import save_samples
+from delayed import DelayedAcceptanceSampler
+
+
+def log_prob(theta):
+    return -0.5*np.sum(theta**2)
+
+
+def check_save_samples(directory):
+    rng = np.random.default_rng(0)
+    samples = rng.normal(size=(50, 3))
+    log_prob = rng.normal(size=50)
+    backend = save_samples(os.path.join(directory, 'nested.h5'), samples,
+                           log_prob)
+    assert np.array_equal(backend.get_chain(flat=True), samples)
+    assert np.array_equal(backend.get_log_prob(flat=True), log_prob)
+    print('nested.save_samples: ok')
+
+
+def check_delayed_save(directory):
+    sampler = DelayedAcceptanceSampler(log_prob, log_prob, 8, 2, seed=0)
+    sampler.run(20, p0=np.random.default_rng(1).normal(size=(8, 2)))
+    backend = sampler.save(os.path.join(directory, 'delayed.h5'))
+    assert np.array_equal(backend.get_chain(flat=True),
+                          sampler.get_chain(flat=True))
+    assert np.array_equal(backend.get_log_prob(flat=True),
+                          sampler.get_log_prob(flat=True))
+    print('DelayedAcceptanceSampler.save: ok')
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        check_save_samples(directory)
+        check_delayed_save(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,6 +15,7 @@ i = pwd.find('/test')
 sys.path.append(pwd[:i])
 from azr import AZR
 from parameter import Parameter
+from runner import AZURE2Error
 ########################################
 # Set up AZR object and data.
 
@@ -27,9 +28,9 @@ output_files = ['AZUREOut_aa=1_R=2.out']
 azr = AZR('12C+p.azr')
 azr.root_directory = '/tmp/'
 
-# We'll read the data from the output file since it's already in the
-# center-of-mass frame.
-data = np.loadtxt('output/' + output_files[0])
+# The data in the center-of-mass frame, laid out like the output file
+# (computed from the data files; no AZURE2 run needed).
+data, = azr.config.data.observed_outputs(output_files)
 x = data[:, 0] # energies
 y = data[:, 5] # cross sections
 dy = data[:, 6] # cross section uncertainties
@@ -72,5 +73,10 @@ def lnP(theta):
     # calling it with a parameter value that will throw an error.
     if lnpi == -np.inf:
         return lnpi
-    return lnL(theta) + lnpi
+    # AZURE2 failures (including points already known to fail) are treated as
+    # having zero posterior probability.
+    try:
+        return lnL(theta) + lnpi
+    except AZURE2Error:
+        return -np.inf
 
@@ -0,0 +1,164 @@
+'''
+Chooses how to split the cores of this machine between worker processes and
+AZURE2's OpenMP threads.
+
+calibrate() runs short batches of the user's actual calculation for several
+(processes, OpenMP threads) combinations, picks the best one, and stores it
+per host and input file. AZR looks the stored result up when it is created,
+so Executors built from it use the tuned split automatically.
+'''
+
+import os
+import json
+import time
+import socket
+import hashlib
+
+from executor import Executor
+
+OBJECTIVES = ('throughput', 'latency')
+
+
+def tuning_file():
+    '''
+    Where calibration results are stored. Override with $PYAZR_TUNING_FILE.
+    '''
+    return os.environ.get('PYAZR_TUNING_FILE',
+        os.path.join(os.path.expanduser('~'), '.pyazr', 'tuning.json'))
+
+
+def tuning_key(input_filename, digest=None):
+    '''
+    Calibrations are specific to the host and the contents of the input file.
+    digest : SHA-1 of the input file, if it's already known
+    '''
+    if digest is None:
+        with open(input_filename, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    return f'{socket.gethostname()}|{os.path.abspath(input_filename)}|{digest}'
+
+
+def _read_all(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load(input_filename, digest=None):
+    '''
+    Returns the stored calibration (dict) for input_filename on this host, or
+    None.
+    '''
+    try:
+        key = tuning_key(input_filename, digest=digest)
+    except OSError:
+        return None
+    return _read_all(tuning_file()).get(key)
+
+
+def save(input_filename, result):
+    '''
+    Stores the calibration result (dict) for input_filename on this host.
+    '''
+    filename = tuning_file()
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    results = _read_all(filename)
+    results[tuning_key(input_filename)] = result
+    # Write-then-rename so that concurrent readers never see a partial file.
+    tmp = f'{filename}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(results, f, indent=1)
+    os.replace(tmp, filename)
+
+
+def candidates(ncpu=None):
+    '''
+    Returns the (processes, omp_threads) combinations worth trying: powers of
+    two (and the full count) for the number of processes, with the cores
+    split evenly among them.
+    '''
+    ncpu = ncpu or os.cpu_count()
+    counts = sorted({2**k for k in range(ncpu.bit_length()) if 2**k <= ncpu}
+                    | {ncpu})
+    return [(p, ncpu // p) for p in counts]
+
+
+def calibrate(azr, theta=None, objective='throughput', rounds=2,
+              combinations=None, persist=True, verbose=False):
+    '''
+    Takes:
+        * azr          : AZR instance (its input file is what gets timed)
+        * theta        : point in parameter space (default: input file values)
+        * objective    : 'throughput' (evaluations per second; samplers) or
+                         'latency' (seconds per evaluation; serial optimizers)
+        * rounds       : evaluations per worker for each combination
+        * combinations : list of (processes, omp_threads) (default:
+                         candidates())
+        * persist      : Store the result for this host and input file?
+    Does:
+        * times a batch of azr.predict(theta) for every combination
+        * sets azr.processes and azr.omp_threads to the best one
+    Returns:
+        * dict describing the best combination (and all timings)
+    '''
+    assert objective in OBJECTIVES, f'objective must be one of {OBJECTIVES}'
+    if theta is None:
+        theta = azr.config.get_input_values()
+    if combinations is None:
+        combinations = candidates()
+
+    # Make sure the calculation works at all before timing it.
+    azr.predict(theta)
+
+    timings = []
+    for (processes, omp_threads) in combinations:
+        n = processes*rounds
+        with Executor(azr, processes=processes,
+                      omp_threads=omp_threads) as executor:
+            # Pool start-up is not part of the steady state we're tuning.
+            executor.predict([theta]*processes)
+            start = time.monotonic()
+            executor.predict([theta]*n)
+            elapsed = time.monotonic() - start
+        timing = {
+            'processes': processes,
+            'omp_threads': omp_threads,
+            'throughput': n/elapsed,
+            'latency': elapsed/rounds
+        }
+        timings.append(timing)
+        if verbose:
+            print(f'{processes:3d} processes x {omp_threads:3d} threads | \
+{timing["throughput"]:8.3f} eval/s | {timing["latency"]:8.3f} s/eval')
+
+    if objective == 'throughput':
+        best = max(timings, key=lambda t: t['throughput'])
+    else:
+        best = min(timings, key=lambda t: t['latency'])
+
+    result = dict(best)
+    result.update({
+        'objective': objective,
+        'host': socket.gethostname(),
+        'input_filename': os.path.abspath(azr.config.input_filename),
+        'cpu_count': os.cpu_count(),
+        'time': time.time(),
+        'timings': timings
+    })
+
+    apply(azr, result)
+    if persist:
+        save(azr.config.input_filename, result)
+    return result
+
+
+def apply(azr, result):
+    '''
+    Sets the pool size and OpenMP threads of azr from a calibration result.
+    '''
+    azr.processes = result['processes']
+    azr.omp_threads = result['omp_threads']
@@ -2,12 +2,11 @@
 Utility functions stored here to keep other class definitions uncluttered.
 '''
 
-import string
-import random
-import os
-from subprocess import Popen, PIPE
+import re
 import numpy as np
-from level import Level
+from level import Level, Pair
+from runner import Runner
+import workspace
 
 '''
 The rows of levels in the .azr file are converted to list of strings. These
@@ -20,6 +19,10 @@ ENERGY_FIXED_INDEX = 3
 CHANNEL_INDEX = 5
 WIDTH_INDEX = 11
 WIDTH_FIXED_INDEX = 10
+LIGHT_MASS_INDEX = 17
+HEAVY_MASS_INDEX = 18
+LIGHT_CHARGE_INDEX = 19
+HEAVY_CHARGE_INDEX = 20
 SEPARATION_ENERGY_INDEX = 21
 CHANNEL_RADIUS_INDEX = 27
 OUTPUT_DIR_INDEX = 2
@@ -36,24 +39,26 @@ def read_input_file(filename):
     return contents
 
 
-def read_level_contents(infile):
+def read_level_contents(infile, contents=None):
     '''
     Reads rows between <levels> and </levels>.
+    If contents (see read_input_file) is provided, infile is not read.
     '''
-    contents = read_input_file(infile)
+    if contents is None:
+        contents = read_input_file(infile)
     start = contents.index('<levels>')+1
     stop = contents.index('</levels>')
     return contents[start:stop]
 
 
-def read_levels(infile):
+def read_levels(infile, contents=None):
     '''
     Packages the contents of the input file (infile, str) into instances of
     Level.
-    Takes an input filename (str).
+    Takes an input filename (str) and, optionally, its contents.
     Returns a list of Level instances.
     '''
-    level_contents = read_level_contents(infile)
+    level_contents = read_level_contents(infile, contents=contents)
 
     levels = []
     sublevels = []
@@ -79,31 +84,71 @@ def read_levels(infile):
     return levels
 
 
-LETTERS = string.ascii_lowercase
-NUMBERS = ''.join(map(str, range(10)))
-CHARACTERS = LETTERS+NUMBERS
-
-
-def random_string(length=8):
-    return ''.join(random.choice(CHARACTERS) for i in range(length))
+def read_pairs(infile, contents=None):
+    '''
+    Reads the particle pairs referenced in the <levels> section.
+    Takes an input filename (str) and, optionally, its contents.
+    Returns a dictionary mapping the pair index (one-based, as in AZURE2) to
+    a Pair instance.
+    '''
+    pairs = {}
+    for row in read_level_contents(infile, contents=contents):
+        if row != '':
+            row = row.split()
+            index = int(row[CHANNEL_INDEX])
+            if index not in pairs:
+                pairs[index] = Pair(index, float(row[LIGHT_MASS_INDEX]),
+                                    float(row[HEAVY_MASS_INDEX]),
+                                    int(float(row[LIGHT_CHARGE_INDEX])),
+                                    int(float(row[HEAVY_CHARGE_INDEX])),
+                                    float(row[SEPARATION_ENERGY_INDEX]))
+    return pairs
 
 
-def random_output_dir_filename():
-    s = 'mcazure_' + random_string()
-    output_dir = 'output_' + s
-    os.mkdir(output_dir)
-    input_filename = s + '.azr'
+def random_output_dir_filename(prepend=''):
+    '''
+    Returns a new input filename and output directory (created). The names
+    are unique across processes (see workspace.allocate).
+    '''
+    input_filename, output_dir, _ = workspace.allocate(prepend=prepend)
     return input_filename, output_dir
 
 
 def random_workspace(prepend=''):
-    s = 'mcazure_' + random_string()
-    output_dir = prepend + 'output_' + s
-    data_dir = prepend + 'data_' + s
-    os.mkdir(output_dir)
-    os.mkdir(data_dir)
-    input_filename = prepend + s + '.azr'
-    return input_filename, output_dir, data_dir
+    '''
+    Like random_output_dir_filename, with a data directory as well.
+    '''
+    return workspace.allocate(prepend=prepend, data=True)
+
+
+def parse_ranges(text):
+    '''
+    Parses a list of (one-based) segment numbers like "1-2,30-34".
+    '''
+    numbers = []
+    for part in text.split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            numbers += list(range(int(first), int(last)+1))
+        else:
+            numbers.append(int(part))
+    return numbers
+
+
+def format_ranges(numbers):
+    '''
+    Inverse of parse_ranges: [1, 2, 30, 31, 32] -> "1-2,30-32".
+    '''
+    parts = []
+    for n in sorted(set(numbers)):
+        if parts and n == parts[-1][1] + 1:
+            parts[-1][1] = n
+        else:
+            parts.append([n, n])
+    return ','.join(str(a) if a == b else f'{a}-{b}' for (a, b) in parts)
 
 
 def update_segmentsData_dir(contents0, data_dir):
@@ -139,7 +184,9 @@ def write_input_file(old_input_file_contents, new_levels, input_filename,
     nlines = len(old_levels)
     level_indices = [i for (i, line) in enumerate(old_levels) if line != '']
     nlevels = len(level_indices)
-    blank_indices = [i for i in range(nlines) if i not in level_indices]
+    # A set, so that the membership tests below don't grow with the number of
+    # rows.
+    blank_indices = {i for (i, line) in enumerate(old_levels) if line == ''}
     assert (nlevels == len(new_levels)), '''
 The number of levels passed in does not match the number of existing levels.'''
 
@@ -205,6 +252,44 @@ def read_rwas_jpi(output_dir):
     return rwas
 
 
+'''
+Reduced width amplitudes as read by read_rwas_structured: J^pi of the level,
+channel (one-based), and internal reduced width amplitude (MeV^(1/2)).
+'''
+RWA_DTYPE = np.dtype([('jpi', 'U8'), ('channel', 'i4'), ('g_int', 'f8')])
+
+RWA_PATTERN = re.compile(r'^J = (\S+)|^\s*R =\s*(\d+).*?g_int =\s*(\S+)',
+                         re.MULTILINE)
+
+
+def read_rwas_structured(output_dir):
+    '''
+    Same information as read_rwas_jpi, parsed in a single pass over
+    parameters.out.
+    Returns a structured array (dtype RWA_DTYPE) with one entry per channel
+    of every level.
+    '''
+    with open(output_dir + '/parameters.out', 'r') as f:
+        pars = f.read()
+    rwas = []
+    jpi = ''
+    for (j, channel, g_int) in RWA_PATTERN.findall(pars):
+        if j:
+            jpi = j
+        else:
+            rwas.append((jpi, int(channel), float(g_int)))
+    return np.array(rwas, dtype=RWA_DTYPE)
+
+
+def rwas_to_list(rwas):
+    '''
+    Converts the output of read_rwas_structured to the nested lists returned
+    by read_rwas_jpi.
+    '''
+    return [[str(r['jpi']), int(r['channel']), float(r['g_int'])] for r in
+            rwas]
+
+
 def read_ext_capture_file(filename):
     ext_capture_data = []
     with open(filename, 'r') as f:
@@ -229,13 +314,16 @@ def write_ext_capture_file(filename, data):
         
     
 def run_AZURE2(input_filename, choice=1, use_brune=False, ext_par_file='\n',
-        ext_capture_file='\n', use_gsl=False, command='AZURE2'):
-    cl_args = [command, input_filename, '--no-gui', '--no-readline']
-    if use_brune:
-        cl_args += ['--use-brune']
-    if use_gsl:
-        cl_args += ['--gsl-coul']
-    p = Popen(cl_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    options = str(choice) + '\n' + ext_par_file + ext_capture_file
-    response = p.communicate(options.encode('utf-8'))
-    return (response[0].decode('utf-8'), response[1].decode('utf-8'))
+        ext_capture_file='\n', use_gsl=False, command='AZURE2', timeout=None,
+        memory_limit=None, retries=0, env=None):
+    '''
+    Runs AZURE2 once (see runner.Runner for the limits and retries).
+    Returns a RunResult, which unpacks as (stdout, stderr).
+    Raises runner.AZURE2Error if AZURE2 does not execute properly.
+    '''
+    runner = Runner(command=command, timeout=timeout,
+                    memory_limit=memory_limit, retries=retries)
+    return runner.run(input_filename, choice=choice, use_brune=use_brune,
+                      ext_par_file=ext_par_file,
+                      ext_capture_file=ext_capture_file, use_gsl=use_gsl,
+                      env=env)
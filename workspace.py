@@ -0,0 +1,213 @@
+'''
+Workspaces (input file, output directory, and data directory) for AZURE2
+runs.
+
+Names are built from a hash of the host name, the process ID, the worker
+index, and a per-process counter, and the output directory is created with
+os.mkdir, which fails if the name is taken. So names never collide, even
+between forked pool workers that share the state of the random module.
+
+Removing a workspace is deferred to a background thread (Cleaner) that
+deletes in batches, off the path of the calculation. Workspaces left behind by
+processes that died (e.g. killed jobs) are reaped by reap(), which runs the
+first time a process allocates a workspace in a directory.
+'''
+
+import os
+import re
+import queue
+import shutil
+import socket
+import hashlib
+import itertools
+import threading
+import multiprocessing
+from multiprocessing import util
+
+PREFIX = 'mcazure_'
+
+'''
+Identifies this host in workspace names, so processes on other hosts that
+share the filesystem are never mistaken for dead ones.
+'''
+HOST = hashlib.sha1(socket.gethostname().encode()).hexdigest()[:6]
+
+'''
+Matches the host and PID in the name of any workspace file or directory.
+'''
+NAME_PATTERN = re.compile(PREFIX + r'([0-9a-f]{6})_(\d+)_')
+
+_counter = itertools.count()
+_counter_pid = os.getpid()
+_reaped = set()
+_lock = threading.Lock()
+
+
+def worker_id():
+    '''
+    Index of the current pool worker (0 in the main process).
+    '''
+    identity = multiprocessing.current_process()._identity
+    return identity[-1] if identity else 0
+
+
+def next_stem():
+    '''
+    Returns a name that no other process (or thread) generates.
+    '''
+    global _counter, _counter_pid
+    with _lock:
+        # A forked child starts with a copy of its parent's counter; the PID
+        # already makes its names unique, but start over for readability.
+        if _counter_pid != os.getpid():
+            _counter, _counter_pid = itertools.count(), os.getpid()
+        n = next(_counter)
+    return f'{PREFIX}{HOST}_{os.getpid()}_{worker_id()}_{n}'
+
+
+def allocate(prepend='', data=False):
+    '''
+    Creates a workspace.
+    Takes:
+        * prepend : prefix of the paths (e.g. '/tmp/')
+        * data    : Create a data directory too?
+    Returns:
+        * input filename, output directory (created), and data directory
+          (created, or None)
+    '''
+    directory = os.path.dirname(prepend) or '.'
+    if directory not in _reaped:
+        _reaped.add(directory)
+        reap(directory)
+
+    while True:
+        stem = next_stem()
+        output_dir = prepend + 'output_' + stem
+        try:
+            os.mkdir(output_dir)
+        except FileExistsError:
+            # Left behind by an earlier process with the same PID.
+            continue
+        break
+
+    data_dir = None
+    if data:
+        data_dir = prepend + 'data_' + stem
+        os.mkdir(data_dir)
+    return prepend + stem + '.azr', output_dir, data_dir
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, but belongs to someone else.
+        return True
+    return True
+
+
+def reap(directory='.'):
+    '''
+    Removes the workspaces in directory whose process (on this host) is no
+    longer running. Returns the number of paths removed.
+    '''
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+
+    removed = 0
+    alive = {}
+    for name in names:
+        match = NAME_PATTERN.search(name)
+        if match is None or match.group(1) != HOST:
+            continue
+        pid = int(match.group(2))
+        if pid not in alive:
+            alive[pid] = pid_alive(pid)
+        if not alive[pid]:
+            remove(os.path.join(directory, name))
+            removed += 1
+    return removed
+
+
+def remove(path):
+    '''
+    Deletes a file or directory; missing paths are ignored.
+    '''
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Cleaner:
+    '''
+    Background thread that deletes workspace paths handed to discard().
+
+    The thread is started on first use (and restarted in forked children,
+    which do not inherit threads). flush() waits until everything discarded
+    so far is deleted; it runs when the process exits (including pool
+    workers that are closed normally). Anything a killed process leaves
+    behind is removed by reap().
+    '''
+    def __init__(self, batch_size=64):
+        self.batch_size = batch_size
+        self.pid = None
+        self.queue = None
+        self.thread = None
+
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.work, daemon=True,
+                                       name='pyazr-cleaner')
+        self.thread.start()
+        util.Finalize(self, self.flush, exitpriority=10)
+
+
+    def discard(self, *paths):
+        '''
+        Schedules paths (None entries are ignored) for deletion.
+        '''
+        with _lock:
+            if self.pid != os.getpid():
+                self.start()
+        for path in paths:
+            if path is not None:
+                self.queue.put(path)
+
+
+    def work(self):
+        while True:
+            batch = [self.queue.get()]
+            # Collect whatever else is waiting, up to batch_size.
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for path in batch:
+                remove(path)
+                self.queue.task_done()
+
+
+    def flush(self):
+        if self.pid == os.getpid():
+            self.queue.join()
+
+
+cleaner = Cleaner()
+
+
+def discard(*paths):
+    '''
+    Deletes paths in the background (see Cleaner).
+    '''
+    cleaner.discard(*paths)